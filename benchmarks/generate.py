@@ -0,0 +1,284 @@
+#!/usr/bin/python
+'''
+Synthetic trees and counts for the benchmarks.
+
+Trees are generated in four shapes:
+    balanced    -- a complete binary tree (the depth is log n)
+    caterpillar -- every inner node has a leaf child (the depth is n)
+    random      -- random pairs of subtrees are joined until one is left
+    taxonomy    -- leaves are grouped by rank (domain down to genus) into
+                   groups of random size, like the trees requested from
+                   NCBI; groups of one make unary chains, larger groups
+                   are resolved into binary nodes
+
+Every tree is written as a single Newick string. The parser only takes
+letters (and a few punctuation characters) in names, so leaves and inner
+nodes are named with letter codes (Taxonab, Cladeab, ...). For a tree,
+a condensed counts file with a column for every leaf can be written,
+along with an OTU table and an RDP taxa file that condense.py turns
+into the same columns.
+
+Nothing here recurses, so trees of 10^6 leaves (and a depth of 10^6
+for caterpillars) can be generated.
+
+Ex:
+    python generate.py taxonomy 10000 out_dir --samples 30
+'''
+import argparse
+import os
+import random
+import string
+import numpy
+
+SHAPES = ['balanced', 'caterpillar', 'random', 'taxonomy']
+RANKS  = ['domain', 'phylum', 'class', 'order', 'family', 'genus']
+
+#the largest group of a rank in taxonomy trees
+MAX_GROUP = 8
+
+#the name of the empty column around the counts
+UNCLASSIFIED = 'Unclassified'
+
+
+def letter_code(i):
+    '''
+    Name an integer with lowercase letters (0 -> a, 26 -> ba).
+    '''
+    code = string.ascii_lowercase[i % 26]
+    i  //= 26
+    while i > 0:
+        code = string.ascii_lowercase[i % 26] + code
+        i  //= 26
+    return code
+
+
+class SyntheticTree():
+    '''
+    A rooted tree kept as lists of children and names, with
+    the leaves numbered first.
+    '''
+
+    def __init__(self, leaf_count):
+        self.children = [[] for i in range(leaf_count)]
+        self.names    = ['Taxon' + letter_code(i) for i in range(leaf_count)]
+        self.root     = 0 if leaf_count == 1 else None
+
+    def add_node(self, children, name=None):
+        node = len(self.children)
+        self.children.append(children)
+        self.names.append(name if name != None else 'Clade' + letter_code(node))
+        self.root = node
+        return node
+
+    def get_leaf_names(self):
+        return [self.names[i] for i in range(len(self.children))
+                if len(self.children[i]) == 0]
+
+    def get_node_count(self):
+        return len(self.children)
+
+    def to_newick(self):
+        '''
+        Write the tree as a Newick string, walking it with a stack.
+        Like the trees requested from NCBI, the tree is wrapped in an
+        extra pair of parentheses, which NewickTree re-roots.
+        '''
+        parts = []
+        stack = [(self.root, 0)]
+        while len(stack) > 0:
+            node, child = stack.pop()
+            kids = self.children[node]
+            if len(kids) == 0:
+                parts.append(self.names[node])
+            elif child == len(kids):
+                parts.append(')' + self.names[node])
+            else:
+                parts.append('(' if child == 0 else ',')
+                stack.append((node, child + 1))
+                stack.append((kids[child], 0))
+        return '(' + ''.join(parts) + ');'
+
+
+def balanced_tree(leaf_count, rng=None):
+    tree  = SyntheticTree(leaf_count)
+    level = list(range(leaf_count))
+    while len(level) > 1:
+        joined = [tree.add_node([level[i], level[i + 1]])
+                  for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            joined.append(level[-1])
+        level = joined
+    return tree
+
+
+def caterpillar_tree(leaf_count, rng=None):
+    tree = SyntheticTree(leaf_count)
+    node = 0
+    for leaf in range(1, leaf_count):
+        node = tree.add_node([node, leaf])
+    return tree
+
+
+def random_tree(leaf_count, rng):
+    tree  = SyntheticTree(leaf_count)
+    nodes = list(range(leaf_count))
+    while len(nodes) > 1:
+        #take two random subtrees out (swapping with the end)
+        picked = []
+        for k in range(2):
+            i = rng.randrange(len(nodes))
+            nodes[i], nodes[-1] = nodes[-1], nodes[i]
+            picked.append(nodes.pop())
+        nodes.append(tree.add_node(picked))
+    return tree
+
+
+def taxonomy_tree(leaf_count, rng):
+    tree   = SyntheticTree(leaf_count)
+    groups = list(range(leaf_count))
+    for rank in reversed(RANKS[:-1]):
+        ranked = []
+        i      = 0
+        while i < len(groups):
+            size   = min(rng.randint(1, MAX_GROUP), len(groups) - i)
+            nodes  = groups[i:i + size]
+            i     += size
+
+            #resolve the group into binary nodes under the taxon
+            while len(nodes) > 2:
+                nodes = [tree.add_node(nodes[j:j + 2], '') if j + 1 < len(nodes)
+                         else nodes[j] for j in range(0, len(nodes), 2)]
+            name = rank.capitalize() + letter_code(len(tree.children))
+            ranked.append(tree.add_node(nodes, name))
+        groups = ranked
+
+    #join whatever is left at the top under a single root
+    while len(groups) > 1:
+        groups = [tree.add_node(groups[j:j + 2]) if j + 1 < len(groups)
+                  else groups[j] for j in range(0, len(groups), 2)]
+    return tree
+
+
+GENERATORS = {'balanced'    : balanced_tree,
+              'caterpillar' : caterpillar_tree,
+              'random'      : random_tree,
+              'taxonomy'    : taxonomy_tree}
+
+
+def generate_tree(shape, leaf_count, seed=0):
+    if shape not in GENERATORS:
+        print('ERROR: unknown tree shape ' + str(shape))
+        return None
+    return GENERATORS[shape](leaf_count, random.Random(seed))
+
+
+def synthetic_counts(leaf_count, samples, seed=0):
+    '''
+    Get (samples x leaves) counts. Abundances are log-normal, with
+    a third of the counts zeroed, and every sample keeps at least
+    one count.
+    '''
+    rng    = numpy.random.RandomState(seed)
+    counts = numpy.floor(rng.lognormal(2.0, 1.5, (samples, leaf_count))).astype(numpy.int64)
+    counts[rng.random_sample((samples, leaf_count)) < 1.0/3.0] = 0
+    counts[:, 0] += 1
+    return counts
+
+
+def write_counts(path, names, counts):
+    '''
+    Write a condensed counts file, laid out as condense.py writes it.
+    CountsMap leaves the first name out of its dictionary, and only
+    works because genera repeat in condense.py's output, so an empty
+    UNCLASSIFIED column is written first and last.
+    '''
+    out_f = open(path, 'w')
+    out_f.write(', '.join([UNCLASSIFIED] + list(names) + [UNCLASSIFIED]) + '\n')
+    for i, row in enumerate(counts):
+        out_f.write('Sample' + letter_code(i) + ', 0, '
+                    + ', '.join([str(c) for c in row.tolist()]) + ', 0\n')
+    out_f.close()
+
+
+def write_otu_tables(counts_path, taxa_path, names, counts, seed=0):
+    '''
+    Write an OTU table and an RDP taxa file for condense.py. Every
+    genus is split over one to three OTUs whose counts add up to the
+    genus counts.
+    '''
+    rng      = numpy.random.RandomState(seed)
+    per_otu  = rng.randint(1, 4, len(names))
+    genus_of = numpy.repeat(numpy.arange(len(names)), per_otu)
+
+    #split the counts of every genus over its OTUs
+    otu_counts = numpy.zeros((len(counts), len(genus_of)), dtype=numpy.int64)
+    firsts     = numpy.concatenate(([0], numpy.cumsum(per_otu)[:-1]))
+    remaining  = counts.copy()
+    for k in range(per_otu.max() - 1):
+        split   = per_otu > k + 1
+        share   = rng.binomial(remaining[:, split], .5)
+        otu_counts[:, firsts[split] + k] = share
+        remaining[:, split] -= share
+    otu_counts[:, firsts + per_otu - 1] = remaining
+
+    out_f = open(counts_path, 'w')
+    out_f.write('\t' + '\t'.join(['OTU%d' % i for i in range(len(genus_of))]) + '\n')
+    for i, row in enumerate(otu_counts):
+        out_f.write('Sample' + letter_code(i) + '\t'
+                    + '\t'.join([str(c) for c in row.tolist()]) + '\n')
+    out_f.close()
+
+    out_f = open(taxa_path, 'w')
+    for otu, genus in enumerate(genus_of.tolist()):
+        ranks = ['Root\trootrank\t1.0']
+        for rank in RANKS[:-1]:
+            ranks.append('%s%s\t%s\t1.0' % (rank.capitalize(), letter_code(genus//MAX_GROUP),
+                                            rank))
+        ranks.append('%s\tgenus\t1.0' % names[genus])
+        out_f.write('OTU%d\t\t%s\n' % (otu, '\t'.join(ranks)))
+    out_f.close()
+
+
+def write_dataset(out_dir, shape, leaf_count, samples, seed=0, otu_tables=True):
+    '''
+    Write a tree with its counts (and OTU tables) to out_dir,
+    and get a dictionary of the paths written.
+    '''
+    tree = generate_tree(shape, leaf_count, seed)
+    if tree == None:
+        return None
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    base  = os.path.join(out_dir, '%s_%d' % (shape, leaf_count))
+    paths = {'newick' : base + '.tree', 'counts' : base + '_counts.txt'}
+    out_f = open(paths['newick'], 'w')
+    out_f.write(tree.to_newick() + '\n')
+    out_f.close()
+
+    names  = tree.get_leaf_names()
+    counts = synthetic_counts(len(names), samples, seed)
+    write_counts(paths['counts'], names, counts)
+    if otu_tables:
+        paths['otu_counts'] = base + '_otu_counts.txt'
+        paths['otu_taxa']   = base + '_otu_taxa.txt'
+        write_otu_tables(paths['otu_counts'], paths['otu_taxa'], names, counts, seed)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('shape', type=str, choices=SHAPES)
+    parser.add_argument('leaf_count', type=int)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--samples', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-otu', action='store_true',
+                        help="don't write the OTU table and taxa file")
+    args = parser.parse_args()
+
+    paths = write_dataset(args.out_dir, args.shape, args.leaf_count, args.samples,
+                          args.seed, not args.no_otu)
+    if paths != None:
+        for kind in sorted(paths):
+            print('%s: %s' % (kind, paths[kind]))
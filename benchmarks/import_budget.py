@@ -0,0 +1,129 @@
+#!/usr/bin/python
+'''
+Check the import time of the modules in src against a budget.
+
+Every module is imported in a fresh interpreter with -X importtime,
+and its cumulative import time (the fastest of --repeat runs) is
+compared against its budget. The modules that build or load scenes
+must also stay clear of the heavy dependencies: matplotlib is not
+used at all, and OpenGL is only imported by the viewer once a GL
+context is set up (see phylo_viewer.load_gl).
+
+The exit status is 1 when a module goes over its budget or imports
+a module it shouldn't.
+
+Ex:
+    python import_budget.py
+    python import_budget.py --scale 2 --out imports.json
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+#the import time budget of each module, in milliseconds
+BUDGETS = {'colormap'     : 250,
+           'counts_map'   : 100,
+           'input_files'  : 100,
+           'condense'     : 100,
+           'prune_taxa'   : 100,
+           'lca'          : 250,
+           'newick_tree'  : 250,
+           'scene'        : 300,
+           'render'       : 100,
+           'culling'      : 300,
+           'picking'      : 250,
+           'comparison'   : 300,
+           'tree_views'   : 300,
+           'lod'          : 300,
+           'frame_stats'  : 100,
+           'profiling'    : 100,
+           'pipeline'     : 100,
+           'scene_server' : 350,
+           'startup'      : 300,
+           'watch'        : 300,
+           'phylo_viewer' : 400}
+
+#modules no module in src may import at import time
+FORBIDDEN = ['matplotlib', 'pylab', 'OpenGL']
+
+
+def import_times(module):
+    '''
+    Import module in a fresh interpreter, and get its cumulative
+    import time (in ms) along with the names of every module
+    imported with it.
+    '''
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=SRC_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        print('ERROR: unable to import ' + module)
+        print(err)
+        return None, []
+
+    total    = None
+    imported = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        name   = fields[2].rstrip()
+        if not fields[1].strip().isdigit():
+            continue
+        imported.append(name.strip())
+        if name.strip() == module and not name.startswith('  '):
+            total = int(fields[1])/1000.0
+    return total, imported
+
+
+def check(modules, repeat, scale):
+    results = []
+    for module in modules:
+        best     = None
+        imported = []
+        for i in range(repeat):
+            total, imported = import_times(module)
+            if total != None and (best == None or total < best):
+                best = total
+        budget    = BUDGETS.get(module, 250)*scale
+        forbidden = sorted(set([m.split('.')[0] for m in imported
+                                if m.split('.')[0] in FORBIDDEN]))
+        results.append({'module'    : module,
+                        'ms'        : best,
+                        'budget_ms' : budget,
+                        'forbidden' : forbidden,
+                        'ok'        : best != None and best <= budget
+                                      and len(forbidden) == 0})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', type=str, nargs='*', default=sorted(BUDGETS),
+                        help="the modules to check (every module with a budget by default)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="scale every budget (for slow machines)")
+    parser.add_argument('--out', type=str, help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = check(args.modules, args.repeat, args.scale)
+    for r in results:
+        line = '%-14s %8s ms (budget %d ms)' % (r['module'],
+               '%.1f' % r['ms'] if r['ms'] != None else '-', r['budget_ms'])
+        if len(r['forbidden']) > 0:
+            line += ' imports ' + ', '.join(r['forbidden'])
+        print(('OK    ' if r['ok'] else 'OVER  ') + line)
+
+    if args.out != None:
+        out_f = open(args.out, 'w')
+        json.dump(results, out_f, indent=1)
+        out_f.close()
+
+    if not all([r['ok'] for r in results]):
+        sys.exit(1)
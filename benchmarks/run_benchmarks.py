@@ -0,0 +1,229 @@
+#!/usr/bin/python
+'''
+Time the stages of the pipeline on synthetic trees.
+
+For every tree shape and size (see generate.py), a tree with its
+counts and OTU tables is written to a work directory, and these
+stages are timed separately:
+
+    counts  -- loading the condensed counts into a CountsMap
+    parse   -- parsing the Newick string into a NewickTree
+    layout  -- the circular layout of the tree (coordinates and edges)
+    condense-- condense.py aggregating the OTU table by genus (run
+               as a script, so this includes starting python)
+    scene   -- building the viewer's geometry with SceneBuilder
+
+Every stage is run --repeat times and the fastest time is kept. The
+scene is only built up to --scene-max-leaves leaves, as the geometry
+of the largest trees doesn't fit in memory.
+
+The results are written as JSON. Given a --baseline (the JSON of an
+earlier run), every stage is compared against it, and the stages that
+got slower by more than --tolerance are flagged as regressions (and
+the exit status is 1).
+
+Ex:
+    python run_benchmarks.py --sizes 100 1000 10000 --out baseline.json
+    python run_benchmarks.py --sizes 100 1000 10000 --baseline baseline.json
+    python run_benchmarks.py --sizes 1000000 --stages counts parse layout
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from generate import SHAPES, write_dataset
+from counts_map import CountsMap
+from newick_tree import NewickTree
+from scene import SceneBuilder
+
+STAGES = ['counts', 'parse', 'layout', 'condense', 'scene']
+
+#caterpillars are as deep as they have leaves, and the tree
+#code recurses over the depth
+RECURSION_LIMIT = 10**7
+
+#timings below this many seconds are too noisy to flag
+MIN_SECONDS = .01
+
+
+class TimedNewickTree(NewickTree):
+    '''
+    A NewickTree that times its parsing and its layout.
+    '''
+
+    def __init__(self, newick, counts_map):
+        self.timings = {'parse' : 0.0, 'layout' : 0.0}
+        NewickTree.__init__(self, newick, counts_map)
+
+    def timed(self, stage, method, *args):
+        start  = time.time()
+        result = method(self, *args)
+        self.timings[stage] += time.time() - start
+        return result
+
+    def parse_newick(self, newick):
+        return self.timed('parse', NewickTree.parse_newick, newick)
+
+    def init_sphere_coordinates(self):
+        return self.timed('layout', NewickTree.init_sphere_coordinates)
+
+    def finalize_coordinates(self):
+        return self.timed('layout', NewickTree.finalize_coordinates)
+
+
+def time_condense(paths, work_dir):
+    '''
+    Time condense.py, which writes condensed_counts.txt to
+    the directory it's run from.
+    '''
+    run_dir = os.path.join(work_dir, 'condense')
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+    start = time.time()
+    subprocess.check_call([sys.executable, os.path.join(SRC_DIR, 'condense.py'),
+                           os.path.abspath(paths['otu_counts']),
+                           os.path.abspath(paths['otu_taxa'])], cwd=run_dir)
+    return time.time() - start
+
+
+def time_stages(paths, args, work_dir):
+    '''
+    Time the chosen stages once, and get a dictionary of
+    the stage timings (in seconds). The counts and the tree
+    are always loaded, as the scene is built from them.
+    '''
+    timings = {}
+    start   = time.time()
+    c_map   = CountsMap(paths['counts'])
+    timings['counts'] = time.time() - start
+
+    newick_f = open(paths['newick'], 'r')
+    newick_s = newick_f.readlines()[0]
+    newick_f.close()
+    tree     = TimedNewickTree(newick_s, c_map)
+    timings.update(tree.timings)
+
+    if 'condense' in args.stages:
+        timings['condense'] = time_condense(paths, work_dir)
+
+    if 'scene' in args.stages and tree.get_num_leaves() <= args.scene_max_leaves:
+        start = time.time()
+        SceneBuilder(tree, args.layers, args.workers).build()
+        timings['scene'] = time.time() - start
+    return timings
+
+
+def run(args, work_dir):
+    results = []
+    for shape in args.shapes:
+        for size in args.sizes:
+            paths = write_dataset(os.path.join(work_dir, 'data'), shape, size,
+                                  args.samples, args.seed, 'condense' in args.stages)
+            best  = {}
+            for i in range(args.repeat):
+                for stage, seconds in time_stages(paths, args, work_dir).items():
+                    best[stage] = min(best.get(stage, seconds), seconds)
+            for stage in STAGES:
+                if stage in best and stage in args.stages:
+                    results.append({'shape' : shape, 'leaves' : size,
+                                    'stage' : stage, 'seconds' : best[stage]})
+                    print('%-12s %8d %-9s %10.4f s' % (shape, size, stage, best[stage]))
+                    sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compare results against a baseline, and get the list of
+    regressions (the stages slower than the baseline by more
+    than the tolerance, a fraction of the baseline time).
+    '''
+    base = {}
+    for r in baseline['results']:
+        base[(r['shape'], r['leaves'], r['stage'])] = r['seconds']
+
+    regressions = []
+    for r in results:
+        key = (r['shape'], r['leaves'], r['stage'])
+        if key not in base:
+            continue
+        r['baseline'] = base[key]
+        r['change']   = (r['seconds'] - base[key])/max(base[key], 1e-9)
+        if (r['seconds'] > base[key]*(1.0 + tolerance)
+                and r['seconds'] - base[key] > MIN_SECONDS):
+            r['regression'] = True
+            regressions.append(r)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shapes', type=str, nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help="the leaf counts of the trees (up to 10^6)")
+    parser.add_argument('--stages', type=str, nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--samples', type=int, default=30,
+                        help="the number of samples in the counts")
+    parser.add_argument('--layers', type=int, default=10,
+                        help="the number of layers of the scene")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used to build the scene")
+    parser.add_argument('--scene-max-leaves', type=int, default=10000,
+                        help="the largest tree to build a scene for")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', type=str,
+                        help="where to write the synthetic data (a temporary "
+                             "directory by default)")
+    parser.add_argument('--out', type=str, help="write the results as JSON")
+    parser.add_argument('--baseline', type=str,
+                        help="the JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=.25,
+                        help="the slowdown (a fraction of the baseline) flagged as a regression")
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(RECURSION_LIMIT)
+    work_dir = args.work_dir if args.work_dir != None else tempfile.mkdtemp()
+    try:
+        results = run(args, work_dir)
+    finally:
+        if args.work_dir == None:
+            shutil.rmtree(work_dir)
+
+    output = {'python'   : platform.python_version(),
+              'platform' : platform.platform(),
+              'samples'  : args.samples,
+              'layers'   : args.layers,
+              'workers'  : args.workers,
+              'results'  : results}
+
+    regressions = []
+    if args.baseline != None:
+        baseline_f = open(args.baseline, 'r')
+        baseline   = json.load(baseline_f)
+        baseline_f.close()
+        regressions = compare(results, baseline, args.tolerance)
+        output['baseline']    = args.baseline
+        output['regressions'] = len(regressions)
+        for r in regressions:
+            print('REGRESSION: %s %d %s %.4f s (baseline %.4f s, %+.0f%%)' % (r['shape'],
+                  r['leaves'], r['stage'], r['seconds'], r['baseline'], 100.0*r['change']))
+
+    if args.out != None:
+        out_f = open(args.out, 'w')
+        json.dump(output, out_f, indent=1)
+        out_f.close()
+    else:
+        print(json.dumps(output, indent=1))
+
+    if len(regressions) > 0:
+        sys.exit(1)
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+'''
+The colormap the leaves are colored with, without matplotlib.
+
+matplotlib's 'rainbow' colormap comes from gnuplot's palette
+functions (red = |2x - 1/2|, green = sin(pi x), blue = cos(pi x/2)),
+sampled at 256 points. The same 256 colors are kept here as a uint8
+rgba lookup table, and lookup maps values in [0, 1] onto it the way
+matplotlib does, so leaves keep the colors they always had.
+'''
+import numpy
+
+LUT_SIZE = 256
+
+
+def rainbow_lut(size=LUT_SIZE):
+    '''
+    Get the rainbow colormap as a (size x 4) uint8 rgba table.
+    '''
+    x   = numpy.linspace(0.0, 1.0, size)
+    lut = numpy.ones((size, 4))
+    lut[:, 0] = numpy.abs(2.0*x - 0.5)
+    lut[:, 1] = numpy.sin(x*numpy.pi)
+    lut[:, 2] = numpy.cos(x*numpy.pi/2.0)
+    return numpy.round(numpy.clip(lut, 0.0, 1.0)*255.0).astype(numpy.uint8)
+
+RAINBOW = rainbow_lut()
+
+
+def lookup(values, lut=RAINBOW):
+    '''
+    Get the uint8 rgba colors of values in [0, 1].
+    '''
+    values = numpy.asarray(values, dtype=numpy.float64)
+    index  = numpy.clip((values*len(lut)).astype(numpy.int64), 0, len(lut) - 1)
+    return lut[index]
+
+
+def leaf_colors(count, num_leaves=None):
+    '''
+    Get the colors of the first count of num_leaves leaves
+    (every leaf by default), spread over the colormap.
+    '''
+    if num_leaves == None:
+        num_leaves = count
+    return lookup(numpy.arange(count)/float(max(num_leaves, 1)))
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+'''
+Compare many trees (one per sample) stacked as the layers of a
+single scene.
+
+Laying every tree out on its own would put the same leaf at a
+different angle in every layer. Instead, one global leaf order is
+worked out once from the leaf names of all the trees (a reference
+tree's leaf order, with the leaves only found in the other trees
+after it), and a LeafIndex maps every leaf name to its global slot
+and angle with a single dictionary lookup. Each tree is then laid
+out with its leaves pinned to their global angles (see NewickTree's
+leaf_index), so a leaf sits at the same place in every layer and
+only the inner nodes of a tree are placed tree by tree.
+
+The leaves of every layer share one AbundanceTable over the global
+leaves, where a leaf that is missing from a tree has no abundance
+on that tree's layer.
+'''
+from counts_map import CountsMap
+from newick_tree import NewickTree
+from input_files import read_newick
+from scene import (SceneBuilder, AbundanceTable, NodeTable, SPACING, NODE_RADIUS,
+                   NODE_COLOR, BRANCH_OFFSET, BRANCH_COLOR, PRIMITIVE_PARAMS,
+                   to_rgba8, section_vertices, arena_section, edge_ends, save_scene)
+from colormap import leaf_colors
+import argparse
+import math
+import os
+import profiling
+import re
+import numpy
+
+#a leaf name follows an opening parenthesis or a comma
+#(inner node names follow a closing parenthesis)
+LEAF_PATTERN = re.compile(r'[(,]([^(),;]+)')
+
+#the sample number at the end of a per-sample tree's file name
+SAMPLE_PATTERN = re.compile(r'_(\d+)$')
+
+
+def newick_leaf_names(newick):
+    '''
+    Get the names of the leaves of a newick string in the
+    order they appear, without building the tree.
+    '''
+    names = [name.strip() for name in LEAF_PATTERN.findall(newick)]
+    return [name for name in names if name != '']
+
+
+def tree_sample(path, default):
+    '''
+    Get the sample (counts row) of a per-sample tree from
+    its file name. tree_N holds the Nth sample, which is
+    row N - 1 of the counts.
+    '''
+    match = SAMPLE_PATTERN.search(os.path.basename(path))
+    if match == None:
+        return default
+    return int(match.group(1)) - 1
+
+
+class LeafIndex():
+    '''
+    A global order of leaf names shared by many trees. Every
+    name has a slot, and the slots are spread evenly around the
+    circle in order, the way NewickTree places the leaves of a
+    single tree.
+    '''
+
+    def __init__(self, names):
+        self.names = []
+        self.slots = {}
+        for name in names:
+            if name not in self.slots:
+                self.slots[name] = len(self.names)
+                self.names.append(name)
+        self.angles = (2.0*math.pi/max(len(self.names), 1))*numpy.arange(len(self.names))
+
+    def get_names(self):
+        return self.names
+
+    def get_leaf_count(self):
+        return len(self.names)
+
+    def get_radius(self):
+        return self.get_leaf_count()*.1
+
+    def get_slot(self, name):
+        '''
+        Get the global slot of a leaf name, or -1 for
+        a name that isn't in the index.
+        '''
+        return self.slots.get(name, -1)
+
+    def get_angle(self, name, default=None):
+        slot = self.get_slot(name)
+        if slot < 0:
+            return default
+        return float(self.angles[slot])
+
+    def get_slots(self, names):
+        '''
+        Get the global slots of a list of leaf names (a hash
+        join of the names against the index).
+        '''
+        return numpy.array([self.slots.get(name, -1) for name in names], dtype=numpy.int64)
+
+
+def load_trees(paths, counts_map, reference=None):
+    '''
+    Load a list of newick files as trees laid out against one
+    LeafIndex, and return the index along with the trees. The
+    leaf order of the reference newick file (if any) comes first.
+    '''
+    newicks = [read_newick(path) for path in paths]
+    names   = []
+    if reference != None:
+        names.extend(newick_leaf_names(read_newick(reference)))
+    for newick_s in newicks:
+        names.extend(newick_leaf_names(newick_s))
+
+    leaf_index = LeafIndex(names)
+    trees      = [NewickTree(newick_s, counts_map, leaf_index) for newick_s in newicks]
+    return leaf_index, trees
+
+
+class ComparisonBuilder(SceneBuilder):
+    '''
+    Build the scene of a list of trees laid out against one
+    LeafIndex, with one tree (and sample) per layer. Unlike
+    the SceneBuilder, the branches of every tree are drawn on
+    its own layer, and the leaves of all the layers are rows of
+    one AbundanceTable over the global leaves.
+    '''
+    instanced_branches = False
+
+    def __init__(self, leaf_index, trees, samples, workers=1):
+        self.leaf_index  = leaf_index
+        self.trees       = trees
+        self.samples     = samples
+        self.layer_count = len(trees)
+        self.workers     = workers
+        self.num_leaves  = leaf_index.get_leaf_count()
+        self.radius      = leaf_index.get_radius()
+        self.start_z     = -1*SPACING*(self.layer_count//2)
+
+    def build(self):
+        scene = SceneBuilder.build(self)
+        scene.get_info()['samples'] = list(self.samples)
+        return scene
+
+    def inner_xy(self, tree):
+        return numpy.array([n.get_coords()[:2] for n in tree.get_nodes() if not n.is_leaf()],
+                           dtype=numpy.float64).reshape((-1, 2))
+
+    def count_nodes(self):
+        return sum([len([n for n in tree.get_nodes() if not n.is_leaf()])
+                    for tree in self.trees])
+
+    def count_branches(self):
+        return sum([len(tree.get_edges()) for tree in self.trees])*2
+
+    def plan_nodes(self):
+        '''
+        Plan the inner node discs of every tree on its own layer.
+        The owner of a disc is a running index over the inner
+        nodes of all the trees.
+        '''
+        xy     = [self.inner_xy(tree) for tree in self.trees]
+        count  = sum([len(tree_xy) for tree_xy in xy])
+        params = numpy.empty((count, PRIMITIVE_PARAMS['nodes']))
+        start  = 0
+        for i, tree_xy in enumerate(xy):
+            rows = params[start:start + len(tree_xy)]
+            rows[:, 0:2] = tree_xy
+            rows[:, 2]   = self.start_z + i*SPACING
+            rows[:, 3]   = NODE_RADIUS
+            start += len(tree_xy)
+        return (params, numpy.repeat(to_rgba8(NODE_COLOR), count, axis=0),
+                numpy.arange(count, dtype=numpy.int32))
+
+    def build_branches(self, out=None):
+        '''
+        Build the branches of every tree on its own layer, as
+        pairs of lines slightly above and below the layer.
+        '''
+        vertices = section_vertices(out, self.count_branches()*2)
+        points   = vertices['position'].reshape((-1, 2, 2, 3))
+        j        = 0
+        for i, tree in enumerate(self.trees):
+            cur_z = self.start_z + i*SPACING
+            edges = points[j:j + len(tree.get_edges())]
+            edges[:, :, :, 0:2] = edge_ends(tree.get_edges())[:, None, :, :]
+            edges[:, 0, :, 2]   = cur_z + BRANCH_OFFSET
+            edges[:, 1, :, 2]   = cur_z - BRANCH_OFFSET
+            j += len(edges)
+        vertices['color'] = to_rgba8(BRANCH_COLOR)[0]
+        return arena_section('branches', vertices, 2)
+
+    def leaf_xy(self):
+        '''
+        Get the x, y coordinates of the global leaves.
+        '''
+        angle = self.leaf_index.angles
+        return (self.radius*numpy.column_stack((numpy.cos(angle), numpy.sin(angle)))
+                ).astype(numpy.float32).reshape((-1, 2))
+
+    def build_abundance(self):
+        '''
+        Build the AbundanceTable over the global leaves, with a
+        column for every layer holding the abundance of the tree's
+        leaves in its sample. The global slots are already in
+        order of their angle.
+        '''
+        leaf_xy = self.leaf_xy()
+        colors  = leaf_colors(self.num_leaves)
+        counts  = numpy.zeros((self.num_leaves, self.layer_count), dtype=numpy.float32)
+        for i, tree in enumerate(self.trees):
+            leaves = [n for n in tree.get_nodes() if n.is_leaf()]
+            slots  = self.leaf_index.get_slots([n.get_name() for n in leaves])
+            for slot, leaf in zip(slots, leaves):
+                counts_list = leaf.get_counts_list()
+                if slot >= 0 and self.samples[i] < len(counts_list):
+                    counts[slot, i] = counts_list[self.samples[i]]
+        return AbundanceTable(leaf_xy, colors, counts,
+                              numpy.arange(self.num_leaves, dtype=numpy.int32))
+
+    def build_node_table(self):
+        '''
+        Build a NodeTable of the global leaves. The inner nodes
+        differ from tree to tree, so only the leaves are picked.
+        '''
+        xy      = self.leaf_xy()
+        parents = numpy.full(self.num_leaves, -1, dtype=numpy.int32)
+        return NodeTable(xy, parents, list(self.leaf_index.get_names()))
+
+
+if __name__ == '__main__':
+    '''
+    Build a comparison scene offline and write it to a
+    scene file that phylo_viewer.py can load with --scene.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('condensed_counts_file', type=str)
+    parser.add_argument('out_file', type=str)
+    parser.add_argument('--trees', type=str, nargs='+', required=True,
+                        help="the newick files of the trees, one per layer")
+    parser.add_argument('--reference', type=str,
+                        help="a newick file whose leaf order comes first")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used to build the inner node discs")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    c_map              = CountsMap(args.condensed_counts_file)
+    leaf_index, trees  = load_trees(args.trees, c_map, args.reference)
+    samples            = [tree_sample(path, i) for i, path in enumerate(args.trees)]
+    scene              = ComparisonBuilder(leaf_index, trees, samples, args.workers).build()
+    save_scene(scene, args.out_file)
+    print('wrote ' + str(scene.get_vertex_count()) + ' vertices ('
+          + str(scene.get_nbytes()) + ' bytes) to ' + args.out_file)
@@ -8,7 +8,9 @@ a file that maps genus names to their counts
 for each experiment. 
 '''
 
+from input_files import open_input
 import argparse
+import profiling
 
 def is_number(s):
     try:
@@ -21,46 +23,48 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("counts_file")
     parser.add_argument("taxa_file")
+    parser.add_argument("--out", default="condensed_counts.txt",
+                        help="where to write the condensed counts")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
+    profiling.enable_from_args(args)
 
-    taxa_f   = open(args.taxa_file, "r")
-    counts_f = open(args.counts_file, "r")
+    taxa_f   = open_input(args.taxa_file)
+    counts_f = open_input(args.counts_file)
 
     condensed_counts = []
     genus_dct = {}
     genus_lst = []
     count_lst = []
     count_dct = {}
-    taxa      = taxa_f.readlines()
-    counts    = counts_f.readlines()
 
-    for c in counts:
+    for c in counts_f:
        count_lst.append(c.split())
 
     #create a dictionary that associates
     #experiment IDs with lists for counts
-    c_size = len(counts)
+    c_size = len(count_lst)
     for i in range(1, c_size):
         count_dct[count_lst[i][0]] = []
         
   
     #retrieve the genus names and their
     #associated OTU values (look for repeats)
-    for i in range(len(taxa)):
-        taxa[i] = taxa[i].split() 
+    for line in taxa_f:
+        taxa = line.split() 
         j = -3
-        genus = taxa[i][j]
+        genus = taxa[j]
         j -= 1
         #condense genus names that have been 
         #split into pieces
-        while not is_number(taxa[i][j]):
-            genus = taxa[i][j] + " " + genus
+        while not is_number(taxa[j]):
+            genus = taxa[j] + " " + genus
             j -= 1
         #if genus in exempt:
         #    continue
         if genus not in genus_dct:
             genus_dct[genus] = []
-        genus_dct[genus].append(taxa[i][0])
+        genus_dct[genus].append(taxa[0])
         genus_lst.append(genus)
             
 
@@ -82,7 +86,7 @@ if __name__ == "__main__":
             condensed_counts[j-1][0] = count_lst[j][0]
             condensed_counts[j-1][i] = total 
 
-    genus_counts_f = open("condensed_counts.txt", "w+")
+    genus_counts_f = open(args.out, "w+")
     
 
     #Write the new file that assoicates genus names
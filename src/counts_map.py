@@ -9,7 +9,9 @@ sample taken. The first in the list is the first
 sample and so forth. 
 
 '''
+from input_files import open_input
 import argparse
+import profiling
 
 
 class CountsMap():
@@ -23,12 +25,12 @@ class CountsMap():
     the first sample.
     '''
 
+    @profiling.profiled()
     def __init__(self, counts_file):
-        counts_f = open(counts_file, "r")
-        counts   = counts_f.readlines()
+        counts_f = open_input(counts_file)
 
         #create a list of all the genus types
-        self.genus_lst = counts[0].rstrip('\n').split(',')
+        self.genus_lst = counts_f.readline().rstrip('\n').split(',')
 
         #create a list of all the sample counts
         #the counts are lined up with the genus list
@@ -38,7 +40,8 @@ class CountsMap():
         #following: counts_lst[j][i+1]
         #i+1 because the first entry is the name
         #of the experiment.
-        self.counts_lst = [line.rstrip('\n').split(',') for line in counts[1:]]
+        self.counts_lst = [line.rstrip('\n').split(',') for line in counts_f]
+        counts_f.close()
 
         self.num_samples = len(self.counts_lst[0])-1
 
@@ -83,7 +86,9 @@ if __name__ == "__main__":
     ''' For testing purposes'''
     parser = argparse.ArgumentParser()
     parser.add_argument('condensed_counts')
+    profiling.add_arguments(parser)
     args      = parser.parse_args()
+    profiling.enable_from_args(args)
     c_map     = CountsMap(args.condensed_counts)
     '''
     for key in c_map.counts_dict:
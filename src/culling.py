@@ -0,0 +1,197 @@
+#!/usr/bin/python
+'''
+View frustum culling for the TreeViewer.
+
+The scene is bucketed by layer and by angular sector around the
+center of the tree. Every bucket has an axis aligned bounding box,
+and each frame the boxes are tested against the view frustum on
+the cpu, so that the viewer only hands the visible buckets to the
+gpu. When zoomed in on a clade, the draw work then scales with the
+part of the tree that is on screen.
+
+Primitives in the static sections are bucketed by the layer and
+angle of their centers. The leaves are kept in order of their angle
+(see SceneBuilder.build_abundance), so a leaf sector is a run of
+leaves, and a run of visible buckets is a run of leaf instances.
+'''
+from scene import angles
+import math
+import numpy
+
+SECTORS = 32
+
+#the corners of a unit box, used to expand bounds into corners
+BOX_CORNERS = numpy.array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)])
+
+
+def sector_of(x, y, sectors=SECTORS):
+    '''
+    Get the angular sector of points around the center of the tree.
+    '''
+    sector = (angles(x, y)*(sectors/(2.0*math.pi))).astype(numpy.int64)
+    return numpy.minimum(sector, sectors - 1)
+
+
+def layer_of(z, layer_count, start_z, spacing):
+    '''
+    Get the nearest layer of z values.
+    '''
+    layer = numpy.rint((z - start_z)/float(spacing)).astype(numpy.int64)
+    return numpy.clip(layer, 0, max(layer_count - 1, 0))
+
+
+def frustum_visible(bounds, matrix):
+    '''
+    Test bounding boxes (boxes x min/max x xyz) against the view
+    frustum of a combined modelview-projection matrix, as handed
+    back by glGetFloatv (row vectors, v*matrix). A box is culled
+    when all of its corners are outside the same clip plane, and
+    empty boxes (min > max) are always culled.
+    '''
+    if len(bounds) == 0:
+        return numpy.zeros(0, dtype=bool)
+    filled  = (bounds[:, 0, :] <= bounds[:, 1, :]).all(axis=1)
+    lo      = numpy.where(filled[:, None], bounds[:, 0, :], 0)
+    hi      = numpy.where(filled[:, None], bounds[:, 1, :], 0)
+    corners = lo[:, None, :] + BOX_CORNERS[None, :, :]*(hi - lo)[:, None, :]
+    corners = numpy.concatenate((corners, numpy.ones(corners.shape[:2] + (1,))), axis=2)
+    clip    = numpy.dot(corners, matrix)
+    w       = clip[:, :, 3:4]
+    outside = ((clip[:, :, 0:3] < -w).all(axis=1).any(axis=1)
+               | (clip[:, :, 0:3] > w).all(axis=1).any(axis=1))
+    return ~outside & filled
+
+
+class SectionBuckets():
+    '''
+    The primitives of a scene section bucketed by layer and
+    angular sector, along with the bounds of every bucket.
+    '''
+
+    def __init__(self, section, layer_count, start_z, spacing, sectors=SECTORS):
+        self.layer_count = max(layer_count, 1)
+        self.sectors     = sectors
+        buckets          = self.layer_count*sectors
+
+        #the bounds of every primitive (primitives are laid
+        #out one after the other in the section's vertices)
+        positions = numpy.asarray(section.get_positions(), dtype=numpy.float32)
+        firsts    = numpy.asarray(section.get_firsts())
+        if len(firsts) > 0:
+            prim_lo = numpy.minimum.reduceat(positions, firsts, axis=0)
+            prim_hi = numpy.maximum.reduceat(positions, firsts, axis=0)
+        else:
+            prim_lo = prim_hi = numpy.zeros((0, 3), dtype=numpy.float32)
+        center = (prim_lo + prim_hi)/2.0
+
+        bucket = (layer_of(center[:, 2], self.layer_count, start_z, spacing)*sectors
+                  + sector_of(center[:, 0], center[:, 1], sectors))
+        self.order = numpy.argsort(bucket, kind='mergesort')
+        self.sizes = numpy.bincount(bucket, minlength=buckets)
+
+        self.bounds = numpy.empty((buckets, 2, 3), dtype=numpy.float32)
+        self.bounds[:, 0, :] = numpy.inf
+        self.bounds[:, 1, :] = -numpy.inf
+        if len(bucket) > 0:
+            filled = numpy.nonzero(self.sizes)[0]
+            starts = numpy.concatenate(([0], numpy.cumsum(self.sizes)[:-1]))[filled]
+            self.bounds[filled, 0] = numpy.minimum.reduceat(prim_lo[self.order], starts)
+            self.bounds[filled, 1] = numpy.maximum.reduceat(prim_hi[self.order], starts)
+
+    def get_bounds(self):
+        return self.bounds
+
+    def get_primitive_count(self):
+        return len(self.order)
+
+    def select(self, visible):
+        '''
+        Get a mask over the section's primitives (in their
+        original order) for a mask over the buckets.
+        '''
+        mask = numpy.zeros(len(self.order), dtype=bool)
+        mask[self.order[numpy.repeat(visible, self.sizes)]] = True
+        return mask
+
+
+class LeafBuckets():
+    '''
+    The leaves of an AbundanceTable bucketed by layer and angular
+    sector. As leaves are sorted by angle, every sector is a run
+    of leaves, and the bounds of a bucket come from the largest
+    leaf in it on that layer or the next (cylinders lead up to
+    the next layer).
+    '''
+
+    def __init__(self, abundance, sectors=SECTORS):
+        leaf_xy      = numpy.asarray(abundance.get_leaf_xy(), dtype=numpy.float32)
+        self.sectors = sectors
+        sector       = sector_of(leaf_xy[:, 0], leaf_xy[:, 1], sectors)
+        self.starts  = numpy.searchsorted(sector, numpy.arange(sectors + 1))
+        self.filled  = numpy.nonzero(numpy.diff(self.starts))[0]
+
+        self.xy_bounds = numpy.empty((sectors, 2, 2), dtype=numpy.float32)
+        self.xy_bounds[:, 0, :] = numpy.inf
+        self.xy_bounds[:, 1, :] = -numpy.inf
+        if len(self.filled) > 0:
+            starts = self.starts[self.filled]
+            self.xy_bounds[self.filled, 0] = numpy.minimum.reduceat(leaf_xy, starts)
+            self.xy_bounds[self.filled, 1] = numpy.maximum.reduceat(leaf_xy, starts)
+
+    def get_bounds(self, radii, scale, start_z, spacing):
+        '''
+        Get the bounds of every bucket (layers x sectors) for
+        the radii (layers x leaves) on display. Buckets without
+        any leaves present are empty.
+        '''
+        layers = len(radii)
+        peak   = numpy.zeros((layers, self.sectors), dtype=numpy.float32)
+        if len(self.filled) > 0 and layers > 0:
+            peak[:, self.filled] = numpy.maximum.reduceat(radii, self.starts[self.filled],
+                                                         axis=1)
+        reach = peak.copy()
+        reach[:-1] = numpy.maximum(peak[:-1], peak[1:])
+        reach *= scale
+
+        bounds = numpy.empty((layers, self.sectors, 2, 3), dtype=numpy.float32)
+        bounds[:, :, 0, 0:2] = self.xy_bounds[None, :, 0, :] - reach[:, :, None]
+        bounds[:, :, 1, 0:2] = self.xy_bounds[None, :, 1, :] + reach[:, :, None]
+        bounds[:, :, 0, 2]   = (start_z + spacing*numpy.arange(layers))[:, None]
+        bounds[:, :, 1, 2]   = bounds[:, :, 0, 2] + spacing
+        bounds[peak <= 0]    = [[numpy.inf]*3, [-numpy.inf]*3]
+        return bounds.reshape((-1, 2, 3))
+
+    def select_runs(self, visible, leaves, firsts, lengths):
+        '''
+        Get a mask over tube runs (see scene.tube_runs) that
+        reach into the visible buckets. A run of n layers covers
+        the buckets of its leaf's sector on its first n - 1 layers
+        (as their bounds reach up to the next layer).
+        '''
+        layers  = len(visible)//self.sectors
+        sector  = numpy.searchsorted(self.starts, leaves, side='right') - 1
+        covered = numpy.zeros((layers + 1, self.sectors), dtype=numpy.int64)
+        covered[1:] = numpy.cumsum(visible.reshape((layers, self.sectors)), axis=0)
+        last    = numpy.minimum(firsts + lengths - 1, layers)
+        return covered[last, sector] > covered[firsts, sector]
+
+    def instance_ranges(self, visible, num_leaves, limit):
+        '''
+        Get the (first, count) runs of leaf instances (layer*leaves
+        + leaf) covered by the visible buckets, cut off at limit.
+        '''
+        layers = len(visible)//self.sectors
+        firsts = (numpy.arange(layers)[:, None]*num_leaves + self.starts[None, :-1]).ravel()
+        lasts  = (numpy.arange(layers)[:, None]*num_leaves + self.starts[None, 1:]).ravel()
+
+        #neighboring visible buckets are neighboring runs of instances
+        edges  = numpy.diff(numpy.concatenate(([0], visible.astype(numpy.int8), [0])))
+        begins = numpy.nonzero(edges == 1)[0]
+        ends   = numpy.nonzero(edges == -1)[0] - 1
+        ranges = []
+        for begin, end in zip(begins, ends):
+            first = int(firsts[begin])
+            last  = min(int(lasts[end]), limit)
+            if last > first:
+                ranges.append((first, last - first))
+        return ranges
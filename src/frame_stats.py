@@ -0,0 +1,190 @@
+#!/usr/bin/python
+'''
+Per-frame timing and scene statistics for the TreeViewer.
+
+With --stats, every frame records its cpu time, its gpu time (from
+GL_TIME_ELAPSED timer queries, where the driver has them), its draw
+calls, and the vertices and primitives drawn for every category of
+geometry. The size of the scene and of its gpu buffers is recorded
+once. The statistics can be dumped as CSV (one row per frame) or
+as JSON (the scene, the phases of the startup and every frame).
+
+Timer queries are read back a few frames late, from a small ring of
+queries, so that timing never stalls the pipeline. OpenGL is only
+imported once the queries are set up, in a GL context.
+'''
+import csv
+import ctypes
+import json
+import time
+
+#the categories geometry is counted in, and the
+#category of every section of a scene
+CATEGORIES = ['circles', 'edges', 'cylinders', 'plates', 'rims']
+SECTION_CATEGORIES = {'nodes'     : 'circles',
+                      'discs'     : 'circles',
+                      'branches'  : 'edges',
+                      'cylinders' : 'cylinders',
+                      'plates'    : 'plates',
+                      'rims'      : 'rims'}
+
+QUERY_RING = 4
+
+
+def frame_columns():
+    columns = ['frame', 'cpu_ms', 'gpu_ms', 'draw_calls']
+    for category in CATEGORIES:
+        columns += [category + '_vertices', category + '_primitives']
+    return columns
+
+
+class FrameStats():
+    '''
+    Collect statistics for every frame drawn between
+    begin_frame and end_frame.
+    '''
+
+    def __init__(self):
+        self.GL           = None
+        self.query_result = None
+        self.frames       = []
+        self.scene        = {}
+        self.startup      = []
+        self.current      = None
+        self.start        = 0.0
+        self.query        = None
+        self.queries      = []
+        self.pending      = []
+
+    def init_gl(self):
+        '''
+        Set up the timer queries. GPU times are left out when
+        the driver doesn't support timer queries.
+        '''
+        from OpenGL import GL
+        from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v
+        self.GL = GL
+
+        #PyOpenGL's wrapper has no array type for the 64 bit
+        #result, so the raw function is called
+        self.query_result = glGetQueryObjectui64v
+        try:
+            self.queries = list(GL.glGenQueries(QUERY_RING))
+        except Exception:
+            self.queries = []
+
+    def set_scene(self, scene):
+        '''
+        Record the size of the scene. scene is a dictionary of
+        the gpu buffer bytes along with the vertex and primitive
+        counts of every category.
+        '''
+        self.scene = scene
+
+    def get_scene(self):
+        return self.scene
+
+    def set_startup(self, phases):
+        '''
+        Record the phases of the viewer's startup (see
+        startup.StartupTimes).
+        '''
+        self.startup = phases
+
+    def get_frames(self):
+        return self.frames
+
+    def begin_frame(self):
+        self.current = {'frame'      : len(self.frames),
+                        'cpu_ms'     : 0.0,
+                        'gpu_ms'     : None,
+                        'draw_calls' : 0}
+        for category in CATEGORIES:
+            self.current[category + '_vertices']   = 0
+            self.current[category + '_primitives'] = 0
+
+        self.query = None
+        if len(self.queries) > 0:
+            self.query = self.queries.pop(0)
+            try:
+                self.GL.glBeginQuery(self.GL.GL_TIME_ELAPSED, self.query)
+            except Exception:
+                #timer queries aren't supported after all
+                self.query   = None
+                self.queries = []
+        self.start = time.time()
+
+    def count_draw(self, section, vertices, primitives, calls=1):
+        '''
+        Count a draw of a section's geometry.
+        '''
+        if self.current == None:
+            return
+        category = SECTION_CATEGORIES.get(section, section)
+        self.current['draw_calls'] += calls
+        self.current[category + '_vertices']   += int(vertices)
+        self.current[category + '_primitives'] += int(primitives)
+
+    def end_frame(self):
+        self.current['cpu_ms'] = (time.time() - self.start)*1000.0
+        if self.query != None:
+            self.GL.glEndQuery(self.GL.GL_TIME_ELAPSED)
+            self.pending.append((self.current, self.query))
+        self.frames.append(self.current)
+        self.current = None
+        self.collect()
+
+    def collect(self):
+        '''
+        Read back the timer queries that are ready.
+        '''
+        GL = self.GL
+        while len(self.pending) > 0:
+            frame, query = self.pending[0]
+            if not GL.glGetQueryObjectiv(query, GL.GL_QUERY_RESULT_AVAILABLE):
+                break
+            result = ctypes.c_uint64()
+            self.query_result(query, GL.GL_QUERY_RESULT, ctypes.byref(result))
+            frame['gpu_ms'] = result.value/1.0e6
+            self.pending.pop(0)
+            self.queries.append(query)
+
+    def average(self, key, count=60):
+        values = [f[key] for f in self.frames[-count:] if f[key] != None]
+        if len(values) == 0:
+            return None
+        return sum(values)/float(len(values))
+
+    def summary(self, count=60):
+        '''
+        Describe the last count frames in a line.
+        '''
+        if len(self.frames) == 0:
+            return 'no frames'
+        last     = self.frames[-1]
+        cpu_ms   = self.average('cpu_ms', count)
+        gpu_ms   = self.average('gpu_ms', count)
+        vertices = sum([last[c + '_vertices'] for c in CATEGORIES])
+        line     = 'cpu %.2f ms' % cpu_ms
+        if gpu_ms != None:
+            line += ', gpu %.2f ms' % gpu_ms
+        line += ', %d draws, %d vertices' % (last['draw_calls'], vertices)
+        if 'buffer_bytes' in self.scene:
+            line += ', %.1f MB on the gpu' % (self.scene['buffer_bytes']/1.0e6)
+        return line
+
+    def dump(self, path):
+        '''
+        Write the statistics to path, as JSON if it ends
+        in .json and as CSV (frames only) otherwise.
+        '''
+        out_f = open(path, 'w')
+        if path.endswith('.json'):
+            json.dump({'scene' : self.scene, 'startup' : self.startup,
+                       'frames' : self.frames}, out_f, indent=1)
+        else:
+            writer = csv.DictWriter(out_f, fieldnames=frame_columns())
+            writer.writeheader()
+            for frame in self.frames:
+                writer.writerow(frame)
+        out_f.close()
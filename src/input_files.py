@@ -0,0 +1,97 @@
+#!/usr/bin/python
+'''
+Open the inputs of the viewer and its scripts (counts, taxa and
+newick files) whether or not they are compressed.
+
+Studies are often archived gzip, bz2 or xz compressed. open_input
+tells these apart by the magic bytes at the start of the file (not
+by its name), and hands back a file object that decompresses as it
+is read, in large buffered chunks. The parsers then read the inputs
+line by line, as they would a plain file, without the whole file
+(or a decompressed copy of it on disk) ever being around at once.
+'''
+import bz2
+import gzip
+import io
+
+try:
+    import lzma
+except ImportError:
+    #python 2
+    lzma = None
+
+#inputs are read (and decompressed) this many bytes at a time
+READ_BUFFER = 1 << 20
+
+MAGIC = [(b'\x1f\x8b', 'gzip'),
+         (b'BZh', 'bz2'),
+         (b'\xfd7zXZ\x00', 'xz')]
+
+
+def compression(path):
+    '''
+    Get the compression of a file from its magic bytes: gzip,
+    bz2, xz, or None for a file that isn't compressed.
+    '''
+    in_f  = open(path, 'rb')
+    start = in_f.read(6)
+    in_f.close()
+    for magic, name in MAGIC:
+        if start.startswith(magic):
+            return name
+    return None
+
+
+def open_input(path, binary=False):
+    '''
+    Open an input for reading, decompressing it on the fly when it
+    is compressed. The file is read as text unless binary is set.
+    '''
+    kind = compression(path)
+    if kind == None:
+        if binary:
+            return open(path, 'rb', READ_BUFFER)
+        return open(path, 'r', READ_BUFFER)
+
+    raw_f = open(path, 'rb', READ_BUFFER)
+    if kind == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw_f, mode='rb')
+    elif kind == 'bz2':
+        stream = bz2.BZ2File(raw_f, 'rb')
+    elif lzma != None:
+        stream = lzma.LZMAFile(raw_f, 'rb')
+    else:
+        raw_f.close()
+        raise IOError('%s is xz compressed, which needs python 3' % path)
+
+    #closing the decompressor leaves the file it reads open
+    stream = ClosingReader(stream, raw_f)
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream)
+
+
+class ClosingReader(io.BufferedReader):
+    '''
+    A buffered reader over a decompressor that also closes
+    the compressed file underneath it.
+    '''
+
+    def __init__(self, stream, raw_f):
+        io.BufferedReader.__init__(self, stream, READ_BUFFER)
+        self.raw_f = raw_f
+
+    def close(self):
+        io.BufferedReader.close(self)
+        self.raw_f.close()
+
+
+def read_newick(path):
+    '''
+    Read the newick string of a tree (the first line
+    of its file).
+    '''
+    newick_f = open_input(path)
+    newick_s = newick_f.readline()
+    newick_f.close()
+    return newick_s
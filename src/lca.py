@@ -0,0 +1,171 @@
+#!/usr/bin/python
+'''
+Lowest common ancestors and path lengths between the nodes of a tree.
+
+Walking up the parents of two nodes takes time in the depth of the
+tree, for every pair. An LCAIndex is built once instead, from the
+parent of every node (as a NodeTable or NewickTree.get_lca_index
+gives them): an Euler tour of the tree (every node, listed again
+each time the tour comes back up to it) along with the depth at every
+step, and a sparse table of the shallowest step in every run of 2^k
+steps. The ancestor of two nodes is the shallowest step between
+their first visits, the smaller of two overlapping runs of the table,
+so any pair is answered in constant time, and whole arrays of pairs
+are answered at once with numpy. The path length between two nodes
+is the number of edges between them.
+
+A forest (say, the node table of a comparison scene) is joined under
+a virtual root, and nodes of different trees have no ancestor (-1)
+and no path between them (-1).
+
+Ex:
+    python lca.py ../trees/full_tree ../data/condensed_counts.txt --pairs Bilophila Desulfovibrio Nannocystis Cystobacter
+    python lca.py ../trees/full_tree ../data/condensed_counts.txt --random 1000000
+'''
+import argparse
+import time
+import numpy
+
+
+class LCAIndex():
+    '''
+    An Euler tour and sparse table over a tree given as the
+    index of every node's parent (-1 for a root).
+    '''
+
+    def __init__(self, parents):
+        parents         = numpy.asarray(parents, dtype=numpy.int64).reshape(-1)
+        node_count      = len(parents)
+        self.node_count = node_count
+
+        #every root hangs from a virtual root, numbered node_count
+        root  = node_count
+        up    = numpy.where(parents < 0, root, parents)
+        order = numpy.argsort(up, kind='mergesort').tolist()
+        ends  = numpy.cumsum(numpy.bincount(up, minlength=node_count + 1)).tolist()
+
+        #the tour, with ~node marking a return to node once
+        #the subtree of one of its children is done
+        tour  = []
+        stack = [root]
+        while len(stack) > 0:
+            cur = stack.pop()
+            if cur < 0:
+                tour.append(~cur)
+                continue
+            tour.append(cur)
+            first = ends[cur - 1] if cur > 0 else 0
+            for child in reversed(order[first:ends[cur]]):
+                stack.append(~cur)
+                stack.append(child)
+        self.tour = numpy.array(tour, dtype=numpy.int64)
+
+        #the tour goes one level down at the first visit
+        #of a node, and one level up everywhere else
+        nodes, self.first = numpy.unique(self.tour, return_index=True)
+        if len(nodes) != node_count + 1:
+            print('ERROR: the parents don\'t form a tree; some nodes are unreachable')
+        steps = -1*numpy.ones(len(self.tour), dtype=numpy.int64)
+        steps[self.first] = 1
+        steps[0]          = 0
+        self.tour_depth   = numpy.cumsum(steps)
+        self.depth        = self.tour_depth[self.first] - 1
+
+        #level k holds the step of the shallowest node in
+        #the 2^k steps from every step (where they fit)
+        size       = len(self.tour)
+        levels     = max(int(size).bit_length(), 1)
+        self.table = numpy.zeros((levels, size), dtype=numpy.int32 if size < 2**31
+                                 else numpy.int64)
+        self.table[0] = numpy.arange(size)
+        for k in range(1, levels):
+            half  = 1 << (k - 1)
+            count = size - (1 << k) + 1
+            left  = self.table[k - 1, :count]
+            right = self.table[k - 1, half:half + count]
+            self.table[k, :count] = numpy.where(self.tour_depth[right] < self.tour_depth[left],
+                                                right, left)
+
+    def get_node_count(self):
+        return self.node_count
+
+    def get_depth(self):
+        '''
+        Get the depth of every node (0 for a root).
+        '''
+        return self.depth[:self.node_count]
+
+    def get_tour(self):
+        return self.tour
+
+    def lca(self, u, v):
+        '''
+        Get the lowest common ancestor of every pair of nodes in u
+        and v (scalars or arrays of node indices, broadcast against
+        each other), or -1 for nodes of different trees.
+        '''
+        first_u = self.first[u]
+        first_v = self.first[v]
+        lo      = numpy.minimum(first_u, first_v)
+        hi      = numpy.maximum(first_u, first_v) + 1
+
+        #floor(log2(hi - lo)), as the bit length less one
+        k       = numpy.frexp(hi - lo)[1] - 1
+        left    = self.table[k, lo]
+        right   = self.table[k, hi - (1 << k)]
+        steps   = numpy.where(self.tour_depth[right] < self.tour_depth[left], right, left)
+        nodes   = self.tour[steps]
+        return numpy.where(nodes == self.node_count, -1, nodes)
+
+    def distance(self, u, v):
+        '''
+        Get the number of edges on the path between every pair
+        of nodes in u and v, or -1 for nodes of different trees.
+        '''
+        ancestor = self.lca(u, v)
+        lengths  = self.depth[u] + self.depth[v] - 2*self.depth[ancestor]
+        return numpy.where(ancestor < 0, -1, lengths)
+
+
+if __name__ == '__main__':
+    from counts_map import CountsMap
+    from newick_tree import NewickTree
+    from input_files import read_newick
+    import profiling
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('newick_file', type=str)
+    parser.add_argument('condensed_counts_file', type=str)
+    parser.add_argument('--pairs', type=str, nargs='+', default=[],
+                        help="print the common ancestor and path length of these "
+                             "pairs of nodes, by name")
+    parser.add_argument('--random', type=int, default=0,
+                        help="time this many queries between random pairs of leaves")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    tree  = NewickTree(read_newick(args.newick_file), CountsMap(args.condensed_counts_file))
+    start = time.time()
+    index = tree.get_lca_index()
+    print('indexed %d nodes in %.3f s' % (index.get_node_count(), time.time() - start))
+
+    if len(args.pairs) % 2 != 0:
+        parser.error('--pairs takes an even number of names')
+    nodes = tree.get_nodes()
+    for a, b in zip(args.pairs[0::2], args.pairs[1::2]):
+        u = tree.get_node_index(a)
+        v = tree.get_node_index(b)
+        if u == None or v == None:
+            print('ERROR: no node named ' + (a if u == None else b))
+            continue
+        print('%s, %s: ancestor %s, %d edges apart' % (a, b,
+              nodes[index.lca(u, v)].get_name() or '(unnamed)', index.distance(u, v)))
+
+    if args.random > 0:
+        leaves = numpy.array([i for i, n in enumerate(nodes) if n.is_leaf()])
+        u      = leaves[numpy.random.randint(len(leaves), size=args.random)]
+        v      = leaves[numpy.random.randint(len(leaves), size=args.random)]
+        start  = time.time()
+        index.distance(u, v)
+        print('%d random leaf pairs in %.3f s' % (args.random, time.time() - start))
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+'''
+Level of detail for the leaves of very large trees.
+
+With hundreds of thousands of leaves, most leaves are far smaller
+than a pixel, yet every leaf is drawn on every layer. Here the leaf
+range of every clade is worked out once in a single postorder pass
+(the leaves are sorted by angle, so the leaves below a node are a
+run of rows in the AbundanceTable), along with cumulative sums of the
+leaf positions and abundances over the rows. For a view, every clade
+whose leaves span fewer than a few pixels on screen is collapsed into
+a single disc, sitting at the middle of its leaves and sized by their
+summed abundance (the difference of two cumulative sums), and only
+the outermost such clades are kept. The
+result is a smaller AbundanceTable that the viewer draws in place of
+the full one, so the number of leaves drawn is bounded by the size
+of the window rather than the size of the tree, and leaves come back
+as the view zooms in on them.
+'''
+from scene import AbundanceTable
+import numpy
+
+#clades that span fewer pixels than this are drawn as one disc
+LOD_PIXELS = 4.0
+
+
+class CladeIndex():
+    '''
+    The rows (in an AbundanceTable) of the leaves below every
+    node of a NodeTable, to collapse clades by.
+    '''
+
+    def __init__(self, node_table, abundance):
+        self.abundance = abundance
+        parents        = numpy.asarray(node_table.get_parents())
+        node_count     = len(parents)
+        leaf_nodes     = numpy.asarray(abundance.get_leaf_nodes())
+
+        children = [[] for i in range(node_count)]
+        for child, parent in enumerate(parents):
+            if parent >= 0:
+                children[parent].append(child)
+
+        #every node covers rows lo to hi (exclusive); as a clade's
+        #leaves are a run of rows, these are the smallest and the
+        #largest rows below it
+        self.lo = numpy.full(node_count, len(leaf_nodes), dtype=numpy.int64)
+        self.hi = numpy.zeros(node_count, dtype=numpy.int64)
+        self.lo[leaf_nodes] = numpy.arange(len(leaf_nodes))
+        self.hi[leaf_nodes] = numpy.arange(1, len(leaf_nodes) + 1)
+
+        #postorder: a node is finished once its children are
+        stack = [(root, False) for root in numpy.nonzero(parents < 0)[0]]
+        while len(stack) > 0:
+            cur, done = stack.pop()
+            if not done:
+                stack.append((cur, True))
+                stack.extend([(child, False) for child in children[cur]])
+            else:
+                for child in children[cur]:
+                    self.lo[cur] = min(self.lo[cur], self.lo[child])
+                    self.hi[cur] = max(self.hi[cur], self.hi[child])
+
+        #only clades of more than one leaf collapse
+        self.clades = numpy.nonzero(self.hi - self.lo > 1)[0]
+        self.inner  = numpy.array([len(c) > 0 for c in children], dtype=bool)
+        self.leaf_z = 0.0
+
+        #cumulative sums over the rows (with a leading zero row), so
+        #a group's sums cost one difference whatever its size
+        leaf_xy          = numpy.asarray(abundance.get_leaf_xy(), dtype=numpy.float64)
+        self.xy_sums     = prefix_sums(leaf_xy)
+        self.reach_sums  = prefix_sums(numpy.hypot(leaf_xy[:, 0], leaf_xy[:, 1]))
+        self.count_sums  = prefix_sums(abundance.get_counts())
+
+    def set_leaf_z(self, z):
+        '''
+        Set the height at which clades are measured on screen.
+        '''
+        self.leaf_z = z
+
+    def screen_positions(self, matrix, viewport):
+        '''
+        Get the window coordinates of every leaf row through a
+        modelview-projection matrix (row vectors), along with
+        whether the leaf is in front of the camera.
+        '''
+        leaf_xy = numpy.asarray(self.abundance.get_leaf_xy(), dtype=numpy.float64)
+        points  = numpy.empty((len(leaf_xy), 4))
+        points[:, 0:2] = leaf_xy
+        points[:, 2]   = self.leaf_z
+        points[:, 3]   = 1.0
+        clip  = numpy.dot(points, matrix)
+        front = clip[:, 3] > 1e-9
+        w     = numpy.where(front, clip[:, 3], 1.0)
+        x     = viewport[0] + (clip[:, 0]/w + 1.0)*.5*viewport[2]
+        y     = viewport[1] + (clip[:, 1]/w + 1.0)*.5*viewport[3]
+        return numpy.column_stack((x, y)), front
+
+    def cut(self, matrix, viewport, pixels=LOD_PIXELS):
+        '''
+        Get the starting rows of the groups of leaves drawn for a
+        view: a group is either a single leaf or the leaves of the
+        outermost clade that spans fewer than pixels on screen.
+        '''
+        rows          = self.abundance.get_num_leaves()
+        screen, front = self.screen_positions(matrix, viewport)
+        lo            = self.lo[self.clades]
+        hi            = self.hi[self.clades]
+        mid           = (lo + hi - 1)//2
+
+        #a clade's leaves lie on an arc, so its first, middle and last
+        #leaves span it (the first and last alone meet around the circle)
+        extent = numpy.maximum(numpy.hypot(*(screen[mid] - screen[lo]).T),
+                               numpy.hypot(*(screen[hi - 1] - screen[mid]).T))
+        extent = numpy.maximum(extent, numpy.hypot(*(screen[hi - 1] - screen[lo]).T))
+        small  = (extent < pixels) & front[lo] & front[mid] & front[hi - 1]
+        lo     = lo[small]
+        hi     = hi[small]
+
+        #clades are nested or apart, so a clade within another
+        #starts after it, and ends no later than it
+        order  = numpy.lexsort((-hi, lo))
+        lo     = lo[order]
+        hi     = hi[order]
+        before = numpy.concatenate(([0], numpy.maximum.accumulate(hi)[:-1]))
+        outer  = hi > before
+        lo     = lo[outer]
+        hi     = hi[outer]
+
+        #every row starts a group, except those within a clade
+        cover = numpy.zeros(rows + 1, dtype=numpy.int64)
+        numpy.add.at(cover, lo + 1, 1)
+        numpy.add.at(cover, hi, -1)
+        return numpy.nonzero(numpy.cumsum(cover)[:rows] == 0)[0]
+
+    def hidden_nodes(self, starts):
+        '''
+        Get a mask over the nodes below the collapsed clades of
+        a cut, whose inner node markers needn't be drawn.
+        '''
+        rows  = self.abundance.get_num_leaves()
+        group = numpy.searchsorted(starts, numpy.minimum(self.lo, rows - 1), side='right') - 1
+        sizes = numpy.diff(numpy.append(starts, rows))[group]
+        return (sizes > 1) & (self.hi - self.lo < sizes)
+
+    def node_mask(self, starts, layers):
+        '''
+        Get the mask over the inner node discs of a scene (every
+        layer of every inner node in turn, as the SceneBuilder plans
+        them) of the nodes outside the collapsed clades of a cut.
+        '''
+        shown = ~self.hidden_nodes(starts)
+        return numpy.repeat(shown[self.inner], layers)
+
+    def table(self, starts):
+        '''
+        Get the AbundanceTable of the groups of leaves starting at
+        starts. A group is drawn at the middle of its leaves (on
+        the rim of the tree), with the color of its middle leaf
+        and the summed abundance of its leaves.
+        '''
+        abundance = self.abundance
+        rows      = abundance.get_num_leaves()
+        if len(starts) == rows:
+            return abundance
+        ends      = numpy.append(starts[1:], rows)
+        sizes     = (ends - starts)[:, None]
+
+        middle = (self.xy_sums[ends] - self.xy_sums[starts])/sizes
+        reach  = self.reach_sums[ends] - self.reach_sums[starts]
+        norm   = numpy.hypot(middle[:, 0], middle[:, 1])
+        scale  = numpy.where(norm > 0, (reach/sizes[:, 0])/numpy.maximum(norm, 1e-12), 1.0)
+        group_xy = (middle*scale[:, None]).astype(numpy.float32)
+
+        counts = self.count_sums[ends] - self.count_sums[starts]
+        mid    = (starts + ends - 1)//2
+        return AbundanceTable(group_xy, abundance.get_leaf_colors()[mid],
+                              counts.astype(numpy.float32),
+                              numpy.asarray(abundance.get_leaf_nodes())[mid])
+
+
+def prefix_sums(values):
+    '''
+    Get the cumulative sums (float64) of the rows of values,
+    with a row of zeros in front.
+    '''
+    values = numpy.asarray(values, dtype=numpy.float64)
+    sums   = numpy.zeros((len(values) + 1,) + values.shape[1:])
+    numpy.cumsum(values, axis=0, out=sums[1:])
+    return sums
@@ -20,19 +20,61 @@ recognitions:
 
 from node import Node, Edge
 from counts_map import CountsMap
+from input_files import read_newick
+from lca import LCAIndex
 import argparse
 import math
+import numpy
+import profiling
+
+
+def clade_matrix(parents, leaf_nodes, counts):
+    '''
+    Sum the rows of counts (one per leaf, the leaf of row i being
+    node leaf_nodes[i]) over the leaves below every node, as a
+    (nodes x columns) float32 matrix. The nodes must be in
+    preorder (children after their parents, as the nodes of a
+    NewickTree and a NodeTable are), so the nodes below a node
+    are the run of nodes right after it, and every row of the
+    matrix is the difference of two rows of one cumulative sum
+    of the counts over the nodes.
+    '''
+    parents = numpy.asarray(parents, dtype=numpy.int64).tolist()
+    size    = len(parents)
+    sizes   = [1]*size
+    for i in range(size - 1, 0, -1):
+        if parents[i] >= 0:
+            sizes[parents[i]] += sizes[i]
+
+    counts = numpy.asarray(counts, dtype=numpy.float64).reshape((len(leaf_nodes), -1))
+    nodes  = numpy.zeros((size + 1, counts.shape[1]))
+    nodes[numpy.asarray(leaf_nodes, dtype=numpy.int64) + 1] = counts
+    prefix = numpy.cumsum(nodes, axis=0)
+    starts = numpy.arange(size)
+    ends   = starts + numpy.array(sizes, dtype=numpy.int64)
+    return (prefix[ends] - prefix[starts]).astype(numpy.float32)
+
 
 class NewickTree():
 
-    def __init__(self, newick, counts_map):
+    @profiling.profiled()
+    def __init__(self, newick, counts_map, leaf_index=None):
         self.total_leaves = 0
         self.root         = Node()
         self.counts_map   = counts_map
         self.radius       = 0 
 
+        #An optional LeafIndex (see comparison.py) that places
+        #leaves at fixed angles shared between many trees.
+        self.leaf_index   = leaf_index
+
+        #The clade abundances and the LCAIndex, built on first use.
+        self.clade_matrix = None
+        self.lca_index    = None
+        self.name_index   = None
+
         #A list of odd characters I've found in newick strings. 
-	self.odd_chars    = ['.', ' ', '_', '/', '-', '+', '*']
+        self.odd_chars    = ['.', ' ', '_', '/', '-', '+', '*']
         self.nodes        = [self.root]
         self.edges        = []
         self.height       = 1
@@ -76,6 +118,7 @@ class NewickTree():
             parent.get_right().depth = d1
             d2 = self.cascade_depth(parent.get_right())
             return d2 if d2 >= d1 else d1
+        return parent.depth
         
 
     def preorder(self):
@@ -114,6 +157,74 @@ class NewickTree():
     def get_edges(self):
         return self.edges
 
+    def get_node_index(self, name):
+        '''
+        Get the index (into the node list) of the first
+        node with the given name, or None.
+        '''
+        if self.name_index == None:
+            self.name_index = {}
+            for i, node in enumerate(self.nodes):
+                self.name_index.setdefault(node.get_name(), i)
+        return self.name_index.get(name)
+
+    def get_clade_matrix(self):
+        '''
+        Get the summed abundance of the leaves below every node
+        in every sample as a (nodes x samples) float32 matrix, in
+        node order. The matrix is built once, on first use. 
+        '''
+        if self.clade_matrix is None:
+            self.clade_matrix = self.build_clade_matrix()
+        return self.clade_matrix
+
+    @profiling.profiled()
+    def build_clade_matrix(self):
+        '''
+        Build the clade matrix with clade_matrix over the parents
+        of the nodes and the counts of the leaves.
+        '''
+        index = {}
+        for i, node in enumerate(self.nodes):
+            index[id(node)] = i
+        parents = [index.get(id(n.get_parent()), -1) for n in self.nodes]
+
+        leaves = [i for i in range(len(self.nodes)) if self.nodes[i].is_leaf()]
+        if len(leaves) > 0:
+            samples = min([len(self.nodes[i].get_counts_list()) for i in leaves])
+        else:
+            samples = 0
+        counts = numpy.zeros((len(leaves), samples))
+        for row, i in enumerate(leaves):
+            counts[row] = self.nodes[i].get_counts_list()[:samples]
+        return clade_matrix(parents, leaves, counts)
+
+    def get_lca_index(self):
+        '''
+        Get the LCAIndex of the tree (see lca.py), over the
+        nodes in node order. The index is built once, on
+        first use.
+        '''
+        if self.lca_index == None:
+            index = {}
+            for i, node in enumerate(self.nodes):
+                index[id(node)] = i
+            self.lca_index = LCAIndex([index.get(id(n.get_parent()), -1)
+                                       for n in self.nodes])
+        return self.lca_index
+
+    def get_clade_abundance(self, name, first=0, last=None):
+        '''
+        Get the abundance of the clade below the node with
+        the given name in the samples first up to last (every
+        sample from first on by default).
+        '''
+        i = self.get_node_index(name)
+        if i == None:
+            print('ERROR: no node named ' + name)
+            return None
+        return self.get_clade_matrix()[i, first:last]
+
     def get_sub_str(self, s, i):
         '''
         Get an organism name from the newick string. 
@@ -138,6 +249,7 @@ class NewickTree():
         #re-increment i immediately after. 
         return (sub_str, i-1)
 
+    @profiling.profiled()
     def parse_newick(self, newick):
         '''
         Parse the newick string, and build our binary
@@ -223,6 +335,8 @@ class NewickTree():
             #put leaf nodes on the unit circle
             node.set_coefficient((0.0, 0.0))
             const  = (2.0*math.pi*leaves_found)/self.total_leaves 
+            if self.leaf_index != None:
+                const = self.leaf_index.get_angle(node.get_name(), const)
             offset = (math.cos(const), math.sin(const))
             node.set_offset(offset)
             leaves_found += 1
@@ -289,6 +403,7 @@ class NewickTree():
         if node.get_right()!= None:
             self.preorder_circle(node.get_right())
 
+    @profiling.profiled()
     def init_sphere_coordinates(self):
         '''
         This is the circular tree algorithm noted in
@@ -307,6 +422,7 @@ class NewickTree():
         self.postorder_circle(self.root, leaves_found)
         self.preorder_circle(self.root)
 
+    @profiling.profiled()
     def finalize_coordinates(self):
         '''
         The initial coordinates end up on the unit circle. 
@@ -315,8 +431,13 @@ class NewickTree():
         Also, this is where the edge list is computed, as the
         edge coordinates must be computed after the node 
         coordinates are finalized. 
+        With a leaf index, the leaves of every tree share the
+        radius of the index.
         '''
-        self.radius = self.total_leaves*.1 
+        leaf_count = self.total_leaves
+        if self.leaf_index != None:
+            leaf_count = self.leaf_index.get_leaf_count()
+        self.radius = leaf_count*.1 
         size = len(self.nodes)
         for i in range(size):
             cur_node = self.nodes[i]
@@ -330,7 +451,7 @@ class NewickTree():
 
             x = cur_node.get_coord(0)
             y = cur_node.get_coord(1)
-            if self.total_leaves > 5:
+            if leaf_count > 5:
                 self.nodes[i].set_coord(0, x*self.radius)
                 self.nodes[i].set_coord(1, y*self.radius)
             else:
@@ -352,11 +473,20 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('newick_file', type=str)
     parser.add_argument('condensed_counts_file', type=str)
+    parser.add_argument('--clade', type=str,
+                        help="print the abundance of the clade below this node instead")
+    parser.add_argument('--samples', type=int, nargs=2, default=[0, None],
+                        help="the first and last (exclusive) samples of the clade")
+    profiling.add_arguments(parser)
     args  = parser.parse_args()
-    n_f   = open(args.newick_file, "r")
-
-    n_str = n_f.readlines()[0]
-    c_map = CountsMap(condensed_counts_file)
+    profiling.enable_from_args(args)
+    n_str = read_newick(args.newick_file)
+    c_map = CountsMap(args.condensed_counts_file)
     tree  = NewickTree(n_str, c_map)
-    tree.preorder()
+    if args.clade != None:
+        abundance = tree.get_clade_abundance(args.clade, args.samples[0], args.samples[1])
+        if abundance is not None:
+            print(' '.join(['%g' % a for a in abundance]))
+    else:
+        tree.preorder()
 
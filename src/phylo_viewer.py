@@ -9,36 +9,75 @@ In particular, we are aiming for a means of visualizing
 the results of microbiota studies, where samples of the 
 micriobiome populations are measured at different times. 
 '''
-from pylab import *
-from node import *
-from OpenGL.GLUT import *
-from OpenGL.GLU import *
-from OpenGL.GL import *
-from OpenGL.arrays import vbo
-from OpenGL.GL import shaders
 import sys
 import math
 from newick_tree import NewickTree
 from counts_map import CountsMap
+from scene import SceneBuilder, load_scene, leaf_meshes, tube_indices, tube_runs
+from scene import VERTEX_DTYPE, COLOR_OFFSET, SPACING, TUBE_RING, TUBE_STRIP, RESTART_INDEX
+from scene import SECTION_ORDER, SECTION_MODES, LEAF_SECTIONS, LEAF_SCALE, PRIMITIVE_SIZES
+from comparison import ComparisonBuilder, load_trees, tree_sample
+from tree_views import SampleViews, ViewBuilder
+from lod import CladeIndex, LOD_PIXELS
+from culling import SectionBuckets, LeafBuckets, frustum_visible
+from picking import Picker
+from frame_stats import FrameStats, CATEGORIES, SECTION_CATEGORIES
+from startup import SceneLoader, StartupTimes
+from input_files import read_newick
+from watch import InputWatcher, recount, same_geometry
 import numpy
 import argparse
+import atexit
 import ctypes
+import profiling
+import time
 
 MAX_LAYERS = 30
-SPACING    = 3
+SCALE_STEP = 1.25
+
+#map the scene's draw modes to GL primitives (set up by load_gl)
+GL_MODES = None
+
+def load_gl():
+    '''
+    Import GLUT, GLU and GL into the module. This is put off until a
+    GL context is set up, so that parsing the tree and building the
+    scene don't wait on PyOpenGL (and render.py can pick a platform).
+    '''
+    global GL_MODES, shaders
+    if GL_MODES != None:
+        return
+    from OpenGL import GL, GLU, GLUT
+    from OpenGL.GL import shaders
+
+    #as 'from OpenGL.GL import *', without replacing the module's own names
+    module_globals = globals()
+    for module in [GLUT, GLU, GL]:
+        for name in getattr(module, '__all__', dir(module)):
+            if not name.startswith('_') and name not in module_globals:
+                module_globals[name] = getattr(module, name)
+
+    GL_MODES = {'triangle_fan'   : GL.GL_TRIANGLE_FAN,
+                'triangle_strip' : GL.GL_TRIANGLE_STRIP,
+                'lines'          : GL.GL_LINES,
+                'line_loop'      : GL.GL_LINE_LOOP}
+
+def key_name(key):
+    '''
+    GLUT hands keyboard keys over as bytes under python 3.
+    '''
+    if isinstance(key, bytes):
+        return key.decode('latin-1')
+    return key
 
 class TreeViewer():
     '''
        A 3d pyholgenetic tree viewer (under construction) 
     '''
-    def __init__(self, tree, layers):
+    @profiling.profiled()
+    def __init__(self, scene=None):
     
-        self.layer_count = layers
-        self.num_samples = tree.get_num_samples()
-        self.num_leaves  = tree.get_num_leaves()
-        self.nodes       = tree.get_nodes()
-        self.edges       = tree.get_edges()
-        self.radius      = tree.get_radius()
+        self.scene       = None
         self.rot_y_left  = 0
         self.rot_y_right = 0
         self.rot_x_up    = 0
@@ -52,152 +91,73 @@ class TreeViewer():
         self.zoom_out    = 0
         self.zoom_val    = 0
         self.start_zoom  = 10
-        self.plate_count = 0
-        self.rim_count   = 0
-
-        #Create the circle geometry
-        start_z = -1*SPACING*(self.layer_count/2) #(self.num_samples/100)*-5
-        raw_points = []
-        self.num_circles = 0
-        self.num_edge_points = 0
-
-        colors = []
-        cyl_colors = []
-        cylinders  = [] 
-        self.num_cylinders = 0
-
-        color_map  = matplotlib.cm.get_cmap('rainbow')        
-        leaf_count = 0
-        
-        #Prototype for leaf interpolation. 
-        #TODO: we could probably make this signficantly more effecient
-        for node in self.nodes:
-            #FIXME: the leaf counter is still off for layered display
-            x, y, z = node.get_coords()
-            if node.is_leaf():
-                samples = node.get_counts_list() 
-                i = 0
-                 
-                #if we only have one layer, just create spheres. 
-                if self.layer_count == 1:
-                    self.num_circles += 1
-                    raw_points.extend(self.create_circle(20*samples[i], x, y, start_z + i*SPACING))
-                    colors.extend(color_map(float(leaf_count)/float(self.num_leaves))*360)
-
-                #if we have multiple layers, look for cylinders.  
-                while i < (self.layer_count-1):
-                    if samples[i] > 0 and samples[i+1] > 0:
-                        while (samples[i+1] > 0) and i < (self.layer_count-1):
-                            cylinders.extend(self.create_cylinder(20*samples[i], 20*samples[i+1],
-                                              x, y, start_z + i*SPACING, SPACING))
-                            cyl_colors.extend(color_map(float(leaf_count)/float(self.num_leaves))*722)
-                            self.num_cylinders += 1
-                            i += 1
-                    elif samples[i] > 0:
-                        self.num_circles += 1
-                        raw_points.extend(self.create_circle(20*samples[i], x, y, start_z + i*SPACING))
-                        colors.extend(color_map(float(leaf_count)/float(self.num_leaves))*360)
-                    i += 1
-                leaf_count += 1
-                
-            else:
-                for i in range(self.layer_count):
-                    self.num_circles += 1
-                    raw_points.extend(self.create_circle(.001, x, y, start_z + i*SPACING))
-                    colors.extend([0.4, 0.2, 0.2, 1.0]*360)
-       
-        #Previous method of creating a full tree for every layer
-        '''
-        cur_z = start_z
-        for i in range(self.layer_count):
-            for e in self.edges:
-                x1, y1, z1 = e.get_parent_coords()
-                x2, y2, z2 = e.get_child_coords()
-                raw_points.extend([x1, y1, cur_z+.2, 1, x2, y2, cur_z+.2, 1])
-                raw_points.extend([x1, y1, cur_z-.2, 1, x2, y2, cur_z-.2, 1])
-                #colors.extend([0.4, 0.2, 0.2, 1.0]*4)
-                colors.extend([1.0, 0.9, 0.41, 1.0]*4)
-                self.num_edge_points += 4
-            cur_z += SPACING
-        '''
-
-        #create the tree branches
-        cur_z = start_z
-        if self.layer_count > 1:
-            for i in range(2):
-                for e in self.edges:
-                    x1, y1, z1 = e.get_parent_coords()
-                    x2, y2, z2 = e.get_child_coords()
-                    raw_points.extend([x1, y1, cur_z+.2, 1, x2, y2, cur_z+.2, 1])
-                    raw_points.extend([x1, y1, cur_z-.2, 1, x2, y2, cur_z-.2, 1])
-                    #colors.extend([0.4, 0.2, 0.2, 1.0]*4)
-                    colors.extend([1.0, 0.9, 0.41, 1.0]*4)
-                    self.num_edge_points += 4
-                cur_z = (start_z + (self.layer_count - 1)*SPACING)
-       
-        else:
-            for e in self.edges:
-                x1, y1, z1 = e.get_parent_coords()
-                x2, y2, z2 = e.get_child_coords()
-                raw_points.extend([x1, y1, cur_z+.2, 1, x2, y2, cur_z+.2, 1])
-                raw_points.extend([x1, y1, cur_z-.2, 1, x2, y2, cur_z-.2, 1])
-                #colors.extend([0.4, 0.2, 0.2, 1.0]*4)
-                colors.extend([1.0, 0.9, 0.41, 1.0]*4)
-                self.num_edge_points += 4
-
-
-        raw_points.extend(cylinders)
-
-        plate_colors = []
-        plate_rims   = []
-        rim_colors   = []
-        
-        #Create the plates TODO: this can probably go in the
-        #branch loop
-        cur_z = start_z
-        if self.layer_count > 1:
-            for i in range(2): 
-                raw_points.extend(self.create_circle(self.radius-.1, 0, 0, cur_z))
-                plate_colors.extend([0.86, 0.92, 0.95, 1.0]*360)
-                self.plate_count += 1
-                cur_z = (start_z + (self.layer_count - 1)*SPACING)
-
-        else:
-            raw_points.extend(self.create_circle(self.radius-.1, 0, 0, cur_z))
-            plate_colors.extend([0.86, 0.92, 0.95, 1.0]*360)
-            self.plate_count += 1
-            
-        #Create the layer rings/rims
-        for i in range(self.layer_count):
-            plate_rims.extend(self.create_circle(self.radius, 0, 0, start_z + i*SPACING))
-            rim_colors.extend([0.0, 0.0, 0.0, 1.0]*360)
-            self.rim_count += 1
-           
-        #old method for creating plates and rims for every layer
-        '''
-        for i in range(self.layer_count):
-            raw_points.extend(self.create_circle(self.radius-.1, 0, 0, start_z + i*SPACING))
-            plate_rims.extend(self.create_circle(self.radius, 0, 0, start_z + i*SPACING))
-            #plate_colors.extend([0.77, 0.77, 0.77, 1.0]*360)
-            plate_colors.extend([0.86, 0.92, 0.95, 1.0]*360)
-            rim_colors.extend([0.0, 0.0, 0.0, 1.0]*360)
-        '''
-
-        #add the plate and rim geometry and colors to raw_points
-        raw_points.extend(plate_rims)
-        raw_points.extend(colors)
-        raw_points.extend(cyl_colors)
-        raw_points.extend(plate_colors)
-        raw_points.extend(rim_colors)
-
-        #convert all geometry to a numpy array
-        self.vertices = numpy.array(raw_points,
-                                    dtype=numpy.float32)
+        self.draw_ranges = []
 
         self.fragment_shader = None
         self.vertex_shader   = None
         self.shader_program  = None
+        self.leaf_shader     = None
+        self.branch_shader   = None
+        self.branch_program  = None
+        self.all_branches    = False
+        self.branch_fade     = 0.0
+        self.edge_buffer     = None
+        self.edge_texture    = None
         self.vao             = None
+        self.vbo             = None
+        self.leaf_program    = None
+        self.leaf_vao        = None
+        self.leaf_ranges     = {}
+        self.leaf_textures   = []
+        self.leaf_buffers    = []
+        self.mesh_buffers    = []
+        self.radii_buffer    = None
+        self.radii           = None
+        self.first_slot      = 0
+        self.tubes           = None
+        self.tube_buffer     = None
+        self.tube_shown      = None
+        self.tube_groups     = []
+        self.buckets         = {}
+        self.leaf_buckets    = None
+        self.leaf_bounds     = None
+        self.views           = None
+        self.view_masks      = {}
+        self.lod_pixels      = None
+        self.clades          = None
+        self.lod_starts      = None
+        self.lod_view        = None
+        self.lod_masks       = {}
+        self.full_abundance  = None
+        self.matrix          = None
+        self.picker          = None
+        self.picked          = None
+        self.windowed        = False
+        self.stats           = None
+        self.stats_time      = 0.0
+        self.buffer_bytes    = 0
+        self.loader          = None
+        self.startup         = None
+        self.watcher         = None
+        self.reload          = None
+        self.reloader        = None
+        if scene != None:
+            self.set_scene(scene)
+
+    def set_scene(self, scene):
+        '''
+        Set the scene to view. Without one, the viewer can set up
+        its window and shaders while a SceneLoader builds it.
+        '''
+        info              = scene.get_info()
+        self.scene        = scene
+        self.abundance    = scene.get_abundance()
+        self.layer_count  = info['layer_count']
+        self.num_leaves   = info['num_leaves']
+        self.radius       = info['radius']
+        self.start_z      = info['start_z']
+        self.first_sample = info.get('first_sample', 0)
+        self.scale        = info.get('scale', LEAF_SCALE)
 
 
 
@@ -230,6 +190,153 @@ class TreeViewer():
         elif self.rot_z_left:
             self.z_deg -= 1
             glutPostRedisplay()
+        if self.watcher != None:
+            self.check_watch()
+
+    def set_watch(self, watcher, reload):
+        '''
+        Rebuild the scene when the files of an InputWatcher change,
+        with reload(changed, times), which gets the changed files
+        and a StartupTimes and returns the new scene (see watch.py).
+        '''
+        self.watcher = watcher
+        self.reload  = reload
+
+    def check_watch(self):
+        '''
+        Start a reload in the background when the inputs have
+        changed, and swap its scene in once it's ready. A reload
+        that fails leaves the current scene up.
+        '''
+        if self.reloader == None:
+            changed = self.watcher.changed()
+            if len(changed) == 0:
+                return
+            times = StartupTimes()
+            self.reloader = SceneLoader(lambda times: self.reload(changed, times),
+                                        times, fork=False)
+            self.reloader.start()
+            self.set_title('TreeViewer: reloading')
+            return
+        if not self.reloader.poll():
+            return
+
+        scene = self.reloader.get_scene()
+        times = self.reloader.get_times()
+        self.reloader = None
+        if scene == None:
+            self.set_title('TreeViewer: reload failed')
+            return
+        times.begin('upload')
+        if same_geometry(scene, self.scene):
+            self.replace_abundance(scene)
+            kind = 'counts'
+        else:
+            self.replace_scene(scene)
+            kind = 'scene'
+        times.end('upload')
+        seconds = max([end for name, where, begin, end in times.get_phases()])
+        print('reloaded the %s in %.3f s' % (kind, seconds))
+        self.set_title('TreeViewer: reloaded the %s' % kind)
+        glutPostRedisplay()
+
+    @profiling.profiled()
+    def replace_abundance(self, scene):
+        '''
+        Swap in a scene that only differs from the current one in
+        its abundance. The leaves keep their rows (and so their
+        positions and colors), so only their radii are uploaded.
+        '''
+        self.scene     = scene
+        self.abundance = scene.get_abundance()
+        last = max(0, self.abundance.get_sample_count() - self.layer_count)
+        self.first_sample = min(self.first_sample, last)
+        self.radii        = self.abundance.get_radii(self.first_sample, self.layer_count)
+        self.tubes        = tube_runs(self.radii)
+        self.tube_shown   = None
+        self.leaf_bounds  = None
+        self.first_slot   = 0
+        glBindBuffer(GL_TEXTURE_BUFFER, self.radii_buffer)
+        glBufferSubData(GL_TEXTURE_BUFFER, 0, self.radii.nbytes, self.radii)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+        node_table  = scene.get_node_table()
+        self.picker = Picker(self.abundance, node_table, scene.get_info())
+        if self.views != None:
+            self.views = SampleViews(node_table, self.abundance)
+            self.update_views()
+        if self.clades != None:
+            self.full_abundance = self.abundance
+            self.clades         = CladeIndex(node_table, self.abundance)
+            self.clades.set_leaf_z(self.start_z + SPACING*(self.layer_count - 1)/2.0)
+            self.lod_starts     = None
+            self.lod_view       = None
+
+    @profiling.profiled()
+    def replace_scene(self, scene):
+        '''
+        Swap in a new scene: the buffers of the current one are
+        released, and the new one is uploaded in their place.
+        The samples on display are kept where possible.
+        '''
+        first = self.first_sample
+        self.release_buffers()
+        self.set_scene(scene)
+        if self.abundance != None:
+            last = max(0, self.abundance.get_sample_count() - self.layer_count)
+            self.first_sample = min(first, last)
+        self.init_buffers()
+        if self.stats != None:
+            self.stats.set_scene(self.scene_stats())
+
+    def release_buffers(self):
+        '''
+        Delete the scene's buffers and textures on the gpu, and
+        forget everything that was worked out from the scene.
+        '''
+        glDeleteVertexArrays(1, [self.vao])
+        if self.leaf_vao != None:
+            glDeleteVertexArrays(1, [self.leaf_vao])
+        buffers = [self.vbo] + self.leaf_buffers + self.mesh_buffers
+        if self.radii_buffer != None:
+            buffers += [self.radii_buffer, self.tube_buffer]
+        if self.edge_buffer != None:
+            buffers += [self.edge_buffer]
+        glDeleteBuffers(len(buffers), buffers)
+        if len(self.leaf_textures) > 0:
+            glDeleteTextures(self.leaf_textures)
+        if self.edge_texture != None:
+            glDeleteTextures([self.edge_texture])
+
+        self.vao            = None
+        self.vbo            = None
+        self.leaf_vao       = None
+        self.leaf_ranges    = {}
+        self.leaf_textures  = []
+        self.leaf_buffers   = []
+        self.mesh_buffers   = []
+        self.radii_buffer   = None
+        self.radii          = None
+        self.first_slot     = 0
+        self.tubes          = None
+        self.tube_buffer    = None
+        self.tube_shown     = None
+        self.edge_buffer    = None
+        self.edge_texture   = None
+        self.tube_groups    = []
+        self.buckets        = {}
+        self.leaf_buckets   = None
+        self.leaf_bounds    = None
+        self.views          = None
+        self.view_masks     = {}
+        self.clades         = None
+        self.lod_starts     = None
+        self.lod_view       = None
+        self.lod_masks      = {}
+        self.full_abundance = None
+        self.picker         = None
+        self.picked         = None
+        self.buffer_bytes   = 0
             
     def special_key_press(self, key, x, y):
         '''
@@ -250,12 +357,24 @@ class TreeViewer():
         '''
         Check for c or z key presses. These keys
         are corresponding to rotation around the 
-        z axis.  
+        z axis. '[' and ']' move through the samples,
+        and '+' and '-' scale the leaves.
         '''
+        key = key_name(key)
         if key == 'c' or key == 'C':
             self.rot_z_right = 1
         elif key == 'z' or key == 'Z':
             self.rot_z_left = 1
+        elif key == ']':
+            self.set_first_sample(self.first_sample + 1)
+        elif key == '[':
+            self.set_first_sample(self.first_sample - 1)
+        elif key == '+' or key == '=':
+            self.scale      *= SCALE_STEP
+            self.leaf_bounds = None
+        elif key == '-':
+            self.scale      /= SCALE_STEP
+            self.leaf_bounds = None
         glutPostRedisplay()
 
 
@@ -280,6 +399,7 @@ class TreeViewer():
         are corresponding to rotation around the 
         z axis.  
         '''
+        key = key_name(key)
         if key == 'c' or key == 'C':
             self.rot_z_right = 0
         elif key == 'z' or key == 'Z':
@@ -290,7 +410,8 @@ class TreeViewer():
     def mouse_button(self, button, state, x, y):
         '''
         Check for mouse clicks, and set the zoom trigger
-        on and off accordingly. 
+        on and off accordingly. A middle click picks the
+        node under the cursor and prints it.
         '''
         if (button == GLUT_LEFT_BUTTON and state == GLUT_DOWN):
             self.zoom_in = 1
@@ -300,6 +421,60 @@ class TreeViewer():
             self.zoom_out = 1
         elif (button == GLUT_RIGHT_BUTTON and state == GLUT_UP):
             self.zoom_out = 0
+        elif (button == GLUT_MIDDLE_BUTTON and state == GLUT_DOWN):
+            picked = self.pick(x, y)
+            if picked != None:
+                print(self.describe_pick(picked))
+
+    def mouse_motion(self, x, y):
+        '''
+        Show the node under the cursor in the window
+        title as the mouse moves.
+        '''
+        self.pick(x, y)
+
+    def pick(self, x, y):
+        '''
+        Find the node under the cursor at x, y. This uses the
+        view of the last frame drawn, so nothing is added to
+        the cost of drawing.
+        '''
+        if self.picker == None or self.matrix is None:
+            return None
+        picked = self.picker.pick(self.matrix, x, y, glutGet(GLUT_WINDOW_WIDTH),
+                                  glutGet(GLUT_WINDOW_HEIGHT), self.first_sample,
+                                  self.layer_count, self.scale)
+        if picked != self.picked:
+            self.picked = picked
+            if picked == None:
+                self.set_title('TreeViewer')
+            else:
+                self.set_title('TreeViewer: ' + self.describe_pick(picked))
+        return picked
+
+    def set_title(self, title):
+        '''
+        Set the window title, if there is a window.
+        '''
+        if self.windowed:
+            glutSetWindowTitle(title)
+
+    def describe_pick(self, picked):
+        if picked['leaf']:
+            kind = 'leaf'
+        else:
+            kind = 'clade of %d leaves' % picked['leaves']
+        name = picked['name']
+        if name == '':
+            name = 'node %d' % picked['node']
+
+        #the layers of a comparison scene each hold their own sample
+        sample  = picked['sample']
+        samples = self.scene.get_info().get('samples')
+        if samples != None and sample < len(samples):
+            sample = samples[sample]
+        return '%s (%s), sample %d, abundance %g' % (name, kind, sample + 1,
+                                                    picked['abundance'])
 
     def reshape(w, h):
         glViewport(0, 0, w, h)
@@ -312,6 +487,123 @@ class TreeViewer():
         '''
         Display the geometry. 
         '''
+        self.render()
+        glutSwapBuffers()
+
+        #report the startup once the first frame is up
+        if self.startup != None:
+            self.startup.mark('first frame')
+            print(self.startup.summary())
+            if self.stats != None:
+                self.stats.set_startup(self.startup.as_dict())
+            self.startup = None
+
+        #with --stats, show the frame statistics once a second
+        if self.stats != None and time.time() - self.stats_time > 1.0:
+            self.stats_time = time.time()
+            self.set_title('TreeViewer: ' + self.stats.summary())
+
+    def set_stats(self, stats):
+        '''
+        Record the statistics of every frame drawn in a FrameStats.
+        '''
+        self.stats = stats
+
+    def set_startup(self, times):
+        '''
+        Record the phases of the startup in a StartupTimes,
+        reported along with the first frame.
+        '''
+        self.startup = times
+
+    def display_loading(self):
+        '''
+        Show what the loader is doing until the scene is ready.
+        '''
+        glClearColor(1.0, 1.0, 1.0, 1.0)
+        glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+        glColor3f(0.2, 0.2, 0.2)
+        glRasterPos2f(-0.2, 0.0)
+        text = 'loading (%s)%s' % (self.loader.get_phase(), '.'*(int(time.time()*3) % 4))
+        for c in text:
+            glutBitmapCharacter(GLUT_BITMAP_HELVETICA_18, ord(c))
+        glutSwapBuffers()
+
+    def check_loader(self):
+        '''
+        Wait on the loader while the window is up. Once the
+        scene is ready, upload it and start viewing it.
+        '''
+        if not self.loader.poll():
+            time.sleep(.02)
+            glutPostRedisplay()
+            return
+        if self.startup != None:
+            self.startup.end('wait')
+            self.startup.begin('upload')
+        scene = self.loader.get_scene()
+        if scene == None:
+            sys.exit(1)
+        self.loader = None
+        self.set_scene(scene)
+        self.init_view(glutGet(GLUT_WINDOW_WIDTH), glutGet(GLUT_WINDOW_HEIGHT))
+        if self.startup != None:
+            self.startup.end('upload')
+        self.set_title('TreeViewer')
+        glutDisplayFunc(self.display)
+        glutIdleFunc(self.key_check)
+        glPushMatrix()
+        glutPostRedisplay()
+
+    def set_lod(self, pixels=LOD_PIXELS):
+        '''
+        Collapse the clades that span fewer than pixels on
+        screen into single leaves (see lod.py).
+        '''
+        self.lod_pixels = pixels
+
+    def set_branches(self, all_layers, fade=0.0):
+        '''
+        Draw the branches on every layer rather than only the
+        first and last, fading those past the first layer by up
+        to fade (0 to 1) into the background.
+        '''
+        self.all_branches = all_layers
+        self.branch_fade  = fade
+
+    def scene_stats(self):
+        '''
+        Get the size of the scene: the bytes of the gpu buffers and
+        the vertices and primitives of every category. Discs are
+        counted as every instance that could be drawn, and tubes as
+        the runs of the first samples on display.
+        '''
+        stats = {'buffer_bytes' : self.buffer_bytes}
+        for category in CATEGORIES:
+            stats[category + '_vertices']   = 0
+            stats[category + '_primitives'] = 0
+        for section in self.scene.get_sections():
+            category = SECTION_CATEGORIES[section.get_name()]
+            stats[category + '_vertices']   += section.get_vertex_count()
+            stats[category + '_primitives'] += section.get_primitive_count()
+        if self.abundance != None:
+            category  = SECTION_CATEGORIES['discs']
+            instances = self.layer_count*self.abundance.get_num_leaves()
+            stats[category + '_vertices']   += instances*PRIMITIVE_SIZES['discs']
+            stats[category + '_primitives'] += instances
+        if self.tubes != None:
+            category = SECTION_CATEGORIES['cylinders']
+            stats[category + '_vertices']   += int(self.tubes[2].sum())*TUBE_RING
+            stats[category + '_primitives'] += len(self.tubes[2])
+        return stats
+
+    @profiling.profiled()
+    def render(self):
+        '''
+        Draw the geometry into the current framebuffer.
+        '''
+        if self.stats != None:
+            self.stats.begin_frame()
         glLoadIdentity()
         gluLookAt(0,0, -1.0*self.num_leaves + self.start_zoom + self.zoom_val,
                   0,0,0,
@@ -327,97 +619,510 @@ class TreeViewer():
         glRotatef(self.z_deg, 0, 0, 1)
         glDisable(GL_CULL_FACE)
 
-
-        num_nodes = self.num_circles #len(self.nodes)*self.layer_count
-        #num_edges = len(self.edges)*self.layer_count
-        num_edges = self.num_edge_points/2
-
-        i = 0
-        while i < num_nodes:
-            glDrawArrays(GL_TRIANGLE_FAN, i*360, 360)
-            i += 1
-
-        #Draw the branches
-        edge_start = i*360
-        i = 0
-        while i < num_edges:
-            glDrawArrays(GL_LINES, i*2 + edge_start, 2)    
-            i += 1
-
-        #Draw cylinders
-        cyl_start = i*2 + edge_start
-        i = 0
-        while i < self.num_cylinders:
-            glDrawArrays(GL_TRIANGLE_STRIP, i*722 + cyl_start, 722)
-            i += 1
-
-        #Draw plates
-        plate_start = i*722 + cyl_start
-        i = 0
-        while i < self.plate_count:
-            glDrawArrays(GL_TRIANGLE_FAN, i*360 + plate_start, 360)
-            i += 1
-
-        #Draw plate rims
-        rim_start = plate_start + i*360
-        i = 0
-        while i < self.rim_count:
-            glDrawArrays(GL_LINE_LOOP, i*360 + rim_start, 360)
-            i += 1
+        self.draw_geometry()
 
         glPopMatrix()
         glBindVertexArray(0)
         glUseProgram(0)
-        glutSwapBuffers()
+        if self.stats != None:
+            self.stats.end_frame()
       
 
-    def create_circle(self, radius, x, y, z):
-        '''
-        Create the geometry for a single circle. 
-        An array filled with the geometry is returned. 
-        Each point consists of x, y, z, 1
-        '''
-        deg2rad = math.pi/180.0
-        points = [] 
-        for i in range(0, 360):
-            radian = float(i)*deg2rad
-            points.append(x + math.cos(radian)*radius) 
-            points.append(y + math.sin(radian)*radius)
-            points.append(z)
-            points.append(1)
-        return points
-
-
-    def create_cylinder(self, top_radius, bot_radius, x, y, z, h):
-        '''
-        Create the geometry for a cylinder and store this 
-        geometry in an array that is returned. Each point
-        is of the form x, y, z, 1
-        '''
-        deg2rad = math.pi/180.0
-        points = []
-        for i in range(361):
-            radian = float(i)*deg2rad
-            points.append(x + math.cos(radian)*top_radius)
-            points.append(y + math.sin(radian)*top_radius)
-            points.append(z)
-            points.append(1.0)
-            points.append(x + math.cos(radian)*bot_radius)
-            points.append(y + math.sin(radian)*bot_radius)
-            points.append(z + h)
-            points.append(1.0)
-        return points             
+    @profiling.profiled()
+    def init_buffers(self):
+        '''
+        Set up the vertex buffer on the gpu, and upload
+        the scene to it.
+        '''
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        self.vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.scene.get_nbytes(), None,
+                     GL_STATIC_DRAW)
+        self.buffer_bytes += self.scene.get_nbytes()
+
+        self.draw_ranges = self.upload_sections(self.scene.get_sections(), 0)
+        self.set_vertex_format()
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindVertexArray(0)
+        if self.abundance != None:
+            self.init_leaf_buffers()
+
+        #bucket the sections by layer and sector for culling
+        #(instanced branches are drawn whole)
+        for section in self.scene.get_sections():
+            if section.get_name() == 'branches' and self.instanced_branches():
+                continue
+            self.buckets[section.get_name()] = SectionBuckets(section,
+                self.layer_count, self.start_z, SPACING)
+
+        if self.abundance != None and self.scene.get_node_table() != None:
+            self.picker = Picker(self.abundance, self.scene.get_node_table(),
+                                 self.scene.get_info())
+            if self.scene.get_info().get('views', False):
+                self.views = SampleViews(self.scene.get_node_table(), self.abundance)
+                self.update_views()
+            if self.lod_pixels != None:
+                self.full_abundance = self.abundance
+                self.clades         = CladeIndex(self.scene.get_node_table(), self.abundance)
+                self.clades.set_leaf_z(self.start_z + SPACING*(self.layer_count - 1)/2.0)
+
+    def update_views(self):
+        '''
+        Mask the inner nodes and branches of every layer down to
+        the sample's view of the tree (see tree_views.py). The
+        mask over the edges of every layer goes into a texture
+        buffer that the branch shader looks up.
+        '''
+        if self.views == None:
+            return
+        masks           = self.views.section_masks(self.first_sample, self.layer_count)
+        self.view_masks = {'nodes' : masks['nodes']}
+        edges           = masks['branches']
+        if self.edge_buffer == None:
+            self.edge_buffer = glGenBuffers(1)
+            glBindBuffer(GL_TEXTURE_BUFFER, self.edge_buffer)
+            glBufferData(GL_TEXTURE_BUFFER, edges.nbytes, edges, GL_DYNAMIC_DRAW)
+            self.buffer_bytes += edges.nbytes
+            self.edge_texture  = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_BUFFER, self.edge_texture)
+            glTexBuffer(GL_TEXTURE_BUFFER, GL_R8, self.edge_buffer)
+            glBindTexture(GL_TEXTURE_BUFFER, 0)
+        else:
+            glBindBuffer(GL_TEXTURE_BUFFER, self.edge_buffer)
+            glBufferSubData(GL_TEXTURE_BUFFER, 0, edges.nbytes, edges)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+    @profiling.profiled()
+    def init_leaf_buffers(self):
+        '''
+        Set up the leaves. A unit disc and a unit tube (with the
+        indices of its strip) are uploaded once, and the leaf
+        positions, colors and radii are kept in texture buffers
+        that the leaf shader looks up for every instance. Tubes
+        are instanced once per run of layers a leaf is present
+        in, from a texture buffer of the runs in view.
+        '''
+        meshes = leaf_meshes(self.layer_count)
+        self.leaf_vao = glGenVertexArrays(1)
+        glBindVertexArray(self.leaf_vao)
+        mesh_vbo = glGenBuffers(1)
+        self.mesh_buffers.append(mesh_vbo)
+        glBindBuffer(GL_ARRAY_BUFFER, mesh_vbo)
+        glBufferData(GL_ARRAY_BUFFER, sum([m.nbytes for m in meshes.values()]),
+                     None, GL_STATIC_DRAW)
+        self.buffer_bytes += sum([m.nbytes for m in meshes.values()])
+        start = 0
+        for name in LEAF_SECTIONS:
+            glBufferSubData(GL_ARRAY_BUFFER, 12*start, meshes[name].nbytes, meshes[name])
+            self.leaf_ranges[name] = (start, len(meshes[name]))
+            start += len(meshes[name])
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 12, None)
+
+        #the tube's indices count from its first vertex
+        indices   = tube_indices(self.layer_count)
+        index_vbo = glGenBuffers(1)
+        self.mesh_buffers.append(index_vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_vbo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+        self.buffer_bytes += indices.nbytes
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+        self.radii_buffer = glGenBuffers(1)
+        self.radii        = self.abundance.get_radii(self.first_sample, self.layer_count)
+        self.tubes        = tube_runs(self.radii)
+        self.leaf_buckets = LeafBuckets(self.abundance)
+
+        #a leaf has at most one run for every other layer
+        self.tube_buffer = glGenBuffers(1)
+        max_runs         = self.abundance.get_num_leaves()*((self.layer_count + 1)//2)
+        tube_space       = numpy.zeros((max(max_runs, 1), 2), dtype=numpy.int32)
+        self.leaf_buffers = [glGenBuffers(1), glGenBuffers(1)]
+        for arr, fmt, buf in [(self.abundance.get_leaf_xy(), GL_RG32F, self.leaf_buffers[0]),
+                              (self.abundance.get_leaf_colors(), GL_RGBA8, self.leaf_buffers[1]),
+                              (self.radii, GL_R32F, self.radii_buffer),
+                              (tube_space, GL_RG32I, self.tube_buffer)]:
+            arr = numpy.ascontiguousarray(arr)
+            glBindBuffer(GL_TEXTURE_BUFFER, buf)
+            glBufferData(GL_TEXTURE_BUFFER, arr.nbytes, arr, GL_DYNAMIC_DRAW)
+            self.buffer_bytes += arr.nbytes
+            texture = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_BUFFER, texture)
+            glTexBuffer(GL_TEXTURE_BUFFER, fmt, buf)
+            self.leaf_textures.append(texture)
+        glBindTexture(GL_TEXTURE_BUFFER, 0)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+    def set_first_sample(self, first):
+        '''
+        Show the samples from first onwards. Only the
+        radii are uploaded again.
+        '''
+        if self.abundance == None:
+            return
+        last  = max(0, self.abundance.get_sample_count() - self.layer_count)
+        first = max(0, min(first, last))
+        if first == self.first_sample:
+            return
+        self.first_sample = first
+        self.leaf_bounds  = None
+
+        self.radii      = self.abundance.get_radii(first, self.layer_count)
+        self.tubes      = tube_runs(self.radii)
+        self.tube_shown = None
+        glBindBuffer(GL_TEXTURE_BUFFER, self.radii_buffer)
+        glBufferSubData(GL_TEXTURE_BUFFER, 0, self.radii.nbytes, self.radii)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+        self.update_views()
+
+        self.set_title('TreeViewer: samples %d-%d of %d' %
+                       (first + 1, first + self.layer_count,
+                        self.abundance.get_sample_count()))
+
+    def update_lod(self, matrix):
+        '''
+        Collapse the clades that are too small to see in the current
+        view, and swap the leaves on the gpu for the collapsed ones
+        when the groups of leaves change. The full table was uploaded
+        first, so the collapsed one always fits.
+        '''
+        if self.clades == None:
+            return
+
+        #the cut only changes along with the view
+        viewport = numpy.array(glGetIntegerv(GL_VIEWPORT))
+        if (self.lod_view != None and numpy.array_equal(matrix, self.lod_view[0])
+                and numpy.array_equal(viewport, self.lod_view[1])):
+            return
+        self.lod_view = (numpy.array(matrix), viewport)
+
+        starts = self.clades.cut(matrix, viewport, self.lod_pixels)
+        if self.lod_starts is not None and numpy.array_equal(starts, self.lod_starts):
+            return
+        self.lod_starts   = starts
+        self.abundance    = self.clades.table(starts)
+        nodes             = self.scene.get_section('nodes')
+        if nodes != None and (nodes.get_primitive_count()
+                              == self.clades.inner.sum()*self.layer_count):
+            self.lod_masks['nodes'] = self.clades.node_mask(starts, self.layer_count)
+        self.radii        = self.abundance.get_radii(self.first_sample, self.layer_count)
+        self.tubes        = tube_runs(self.radii)
+        self.tube_shown   = None
+        self.first_slot   = 0
+        self.leaf_buckets = LeafBuckets(self.abundance)
+        self.leaf_bounds  = None
+        for arr, buf in [(self.abundance.get_leaf_xy(), self.leaf_buffers[0]),
+                         (self.abundance.get_leaf_colors(), self.leaf_buffers[1]),
+                         (self.radii, self.radii_buffer)]:
+            arr = numpy.ascontiguousarray(arr)
+            glBindBuffer(GL_TEXTURE_BUFFER, buf)
+            glBufferSubData(GL_TEXTURE_BUFFER, 0, arr.nbytes, arr)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+    def set_vertex_format(self):
+        '''
+        Vertices are interleaved as float32 x, y, z followed
+        by a normalized uint8 rgba color.
+        '''
+        stride = VERTEX_DTYPE.itemsize
+        glEnableVertexAttribArray(0)
+        glEnableVertexAttribArray(1)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, None)
+        glVertexAttribPointer(1, 4, GL_UNSIGNED_BYTE, GL_TRUE, stride,
+                              ctypes.c_void_p(COLOR_OFFSET))
+
+    def upload_sections(self, sections, start):
+        '''
+        Upload scene sections to the bound vertex buffer, starting
+        at vertex index start. A list of (name, mode, firsts, counts)
+        draw ranges is returned for the non-empty sections.
+        '''
+        stride = VERTEX_DTYPE.itemsize
+        ranges = []
+        for section in sections:
+            vertices = section.get_vertices()
+            if len(vertices) > 0:
+                glBufferSubData(GL_ARRAY_BUFFER, stride*start, vertices.nbytes,
+                                numpy.ascontiguousarray(vertices))
+                ranges.append((section.get_name(), GL_MODES[section.get_mode()],
+                               section.get_firsts() + start, section.get_counts()))
+            start += len(vertices)
+        return ranges
+
+    def view_matrix(self):
+        '''
+        Get the current modelview-projection matrix, for
+        row vectors (v*matrix).
+        '''
+        modelview  = numpy.array(glGetFloatv(GL_MODELVIEW_MATRIX)).reshape((4, 4))
+        projection = numpy.array(glGetFloatv(GL_PROJECTION_MATRIX)).reshape((4, 4))
+        return numpy.dot(modelview, projection)
+
+    def draw_geometry(self):
+        '''
+        Draw the uploaded scene. The leaves are drawn in
+        between the other sections, in section order. Only
+        the buckets (layer and sector) of each section that
+        are within the view frustum are drawn, and with
+        per-sample views, only the nodes and branches in view.
+        With level of detail, the leaves are collapsed first, and
+        the inner nodes within collapsed clades aren't drawn.
+        '''
+        matrix      = self.view_matrix()
+        self.matrix = matrix    #kept for picking
+        ranges      = {}
+        for draw_range in self.draw_ranges:
+            ranges[draw_range[0]] = draw_range
+
+        self.update_lod(matrix)
+        leaf_visible = None
+        if self.leaf_buckets != None:
+            if self.leaf_bounds is None:
+                self.leaf_bounds = self.leaf_buckets.get_bounds(self.radii,
+                                   self.scale, self.start_z, SPACING)
+            leaf_visible = frustum_visible(self.leaf_bounds, matrix)
+
+        for name in SECTION_ORDER:
+            if name in LEAF_SECTIONS:
+                self.draw_leaves(name, leaf_visible)
+            elif name == 'branches' and name in ranges and self.instanced_branches():
+                self.draw_branches(*ranges[name][1:])
+            elif name in ranges:
+                name, mode, firsts, counts = ranges[name]
+                visible = None
+                if name in self.buckets:
+                    buckets = self.buckets[name]
+                    visible = buckets.select(frustum_visible(buckets.get_bounds(), matrix))
+                for masks in [self.view_masks, self.lod_masks]:
+                    if name not in masks:
+                        continue
+                    if visible is None:
+                        visible = masks[name]
+                    else:
+                        visible = visible & masks[name]
+                if visible is not None:
+                    firsts  = firsts[visible]
+                    counts  = counts[visible]
+                if len(counts) > 0:
+                    self.multi_draw(name, mode, firsts, counts)
+
+    def multi_draw(self, name, mode, firsts, counts):
+        '''
+        Draw primitives of a section with a single call.
+        '''
+        glMultiDrawArrays(mode, firsts, counts, len(counts))
+        if self.stats != None:
+            self.stats.count_draw(name, counts.sum(), len(counts))
+
+    def instanced_branches(self):
+        '''
+        Check whether the scene holds the branches of only its
+        first layer (see SceneBuilder.build_branches).
+        '''
+        return self.scene.get_info().get('instanced_branches', False)
+
+    def draw_branches(self, mode, firsts, counts):
+        '''
+        Draw the one layer of branches on the first and last
+        layers, or on every layer, as instances of a single draw.
+        The branch shader moves each instance up to its layer.
+        With per-sample views, every layer is drawn, and the
+        shader hides the edges out of the layer's view.
+        '''
+        if self.all_branches or self.edge_texture != None:
+            instances, step = self.layer_count, 1
+        else:
+            instances, step = min(self.layer_count, 2), self.layer_count - 1
+        fade = self.branch_fade/(instances - 1) if instances > 1 else 0.0
+
+        program = self.branch_program
+        glUseProgram(program)
+        glUniform1f(glGetUniformLocation(program, 'layer_step'), step*SPACING)
+        glUniform1f(glGetUniformLocation(program, 'fade'), fade)
+        #the branches are a single run of lines, 4 vertices to an edge
+        first, count = int(firsts[0]), int(counts.sum())
+        glUniform1i(glGetUniformLocation(program, 'masked'), int(self.edge_texture != None))
+        if self.edge_texture != None:
+            glBindTexture(GL_TEXTURE_BUFFER, self.edge_texture)
+            glUniform1i(glGetUniformLocation(program, 'edge_mask'), 0)
+            glUniform1i(glGetUniformLocation(program, 'first_vertex'), first)
+            glUniform1i(glGetUniformLocation(program, 'edges'), count//4)
+        glDrawArraysInstanced(mode, first, count, instances)
+        if self.edge_texture != None:
+            glBindTexture(GL_TEXTURE_BUFFER, 0)
+        if self.stats != None:
+            self.stats.count_draw('branches', count*instances, len(counts)*instances)
+        glUseProgram(self.shader_program)
+
+    def draw_leaves(self, name, visible):
+        '''
+        Draw a disc for every leaf on every layer within the
+        visible buckets (the leaf shader hides the instances
+        that aren't needed), or the tubes that reach into them.
+        '''
+        if self.leaf_vao == None:
+            return
+        if name == 'cylinders':
+            instances = self.select_tubes(visible)
+        else:
+            num_leaves = self.abundance.get_num_leaves()
+            instances  = self.leaf_buckets.instance_ranges(visible, num_leaves,
+                                                           self.layer_count*num_leaves)
+        if len(instances) == 0:
+            return
+
+        program = self.leaf_program
+        glUseProgram(program)
+        for unit, texture in enumerate(self.leaf_textures):
+            glActiveTexture(GL_TEXTURE0 + unit)
+            glBindTexture(GL_TEXTURE_BUFFER, texture)
+        glUniform1i(glGetUniformLocation(program, 'leaf_xy'), 0)
+        glUniform1i(glGetUniformLocation(program, 'leaf_color'), 1)
+        glUniform1i(glGetUniformLocation(program, 'radii'), 2)
+        glUniform1i(glGetUniformLocation(program, 'runs'), 3)
+        glUniform1i(glGetUniformLocation(program, 'num_leaves'),
+                    self.abundance.get_num_leaves())
+        glUniform1i(glGetUniformLocation(program, 'layer_count'), self.layer_count)
+        glUniform1i(glGetUniformLocation(program, 'first_slot'), self.first_slot)
+        glUniform1i(glGetUniformLocation(program, 'tubes'), int(name == 'cylinders'))
+        glUniform1f(glGetUniformLocation(program, 'scale'), self.scale)
+        glUniform1f(glGetUniformLocation(program, 'start_z'), self.start_z)
+        glUniform1f(glGetUniformLocation(program, 'spacing'), SPACING)
+
+        first, count = self.leaf_ranges[name]
+        location     = glGetUniformLocation(program, 'first_instance')
+        glBindVertexArray(self.leaf_vao)
+        if name == 'cylinders':
+            self.draw_tubes(location, first)
+        else:
+            for first_instance, instance_count in instances:
+                glUniform1i(location, first_instance)
+                glDrawArraysInstanced(GL_MODES[SECTION_MODES[name]], first, count,
+                                      instance_count)
+                if self.stats != None:
+                    self.stats.count_draw(name, count*instance_count, instance_count)
+        glBindVertexArray(self.vao)
+        glActiveTexture(GL_TEXTURE0)
+        glUseProgram(self.shader_program)
+
+    def select_tubes(self, visible):
+        '''
+        Upload the runs (leaf, first layer) of the tubes that reach
+        into the visible buckets, grouped by their length, and get
+        the (first run, run count, length) of every group.
+        '''
+        leaves, firsts, lengths = self.tubes
+        shown = self.leaf_buckets.select_runs(visible, leaves, firsts, lengths)
+        if self.tube_shown is None or not numpy.array_equal(shown, self.tube_shown):
+            self.tube_shown = shown
+            runs = numpy.ascontiguousarray(numpy.stack((leaves[shown], firsts[shown]),
+                                                       axis=1).astype(numpy.int32))
+            if len(runs) > 0:
+                glBindBuffer(GL_TEXTURE_BUFFER, self.tube_buffer)
+                glBufferSubData(GL_TEXTURE_BUFFER, 0, runs.nbytes, runs)
+                glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+            #the runs are sorted by length
+            lengths, starts, counts = numpy.unique(lengths[shown], return_index=True,
+                                                   return_counts=True)
+            self.tube_groups = list(zip(starts.tolist(), counts.tolist(), lengths.tolist()))
+        return self.tube_groups
+
+    def draw_tubes(self, location, base):
+        '''
+        Draw the selected tubes with one indexed strip per run,
+        and one draw for every run length.
+        '''
+        glEnable(GL_PRIMITIVE_RESTART)
+        glPrimitiveRestartIndex(RESTART_INDEX)
+        for first_run, run_count, length in self.tube_groups:
+            glUniform1i(location, first_run)
+            glDrawElementsInstancedBaseVertex(GL_TRIANGLE_STRIP,
+                                              (length - 1)*TUBE_STRIP - 1,
+                                              GL_UNSIGNED_INT, None, run_count, base)
+            if self.stats != None:
+                self.stats.count_draw('cylinders', length*TUBE_RING*run_count, run_count)
+        glDisable(GL_PRIMITIVE_RESTART)
 
     #TODO: this should probably be called 'set-up' or something
     #      along those lines.  
-    def execute(self):
+    def execute(self, loader=None):
+        '''
+        Open the window and view the scene. With a loader, the
+        window is opened and the shaders are compiled while the
+        loader builds the scene, which is shown once it's ready.
+        '''
+        #the span ends as the main loop starts, which never returns
+        setup = profiling.begin('TreeViewer.execute')
+        if self.startup != None:
+            self.startup.begin('window')
+        load_gl()
         glutInit(sys.argv)
 
         glutInitDisplayMode(GLUT_DOUBLE | GLUT_RGB | GLUT_DEPTH)
         glutInitWindowSize(1000,1000)
         glutCreateWindow('TreeViewer')
-        win_w = glutGet(GLUT_WINDOW_WIDTH)
-        win_h = glutGet(GLUT_WINDOW_HEIGHT)
+        self.windowed = True
+        if self.startup != None:
+            self.startup.end('window')
+            self.startup.begin('shaders')
+        self.init_shaders()
+        if self.startup != None:
+            self.startup.end('shaders')
+
+        self.loader = loader
+        if loader == None:
+            if self.startup != None:
+                self.startup.begin('upload')
+            self.init_view(glutGet(GLUT_WINDOW_WIDTH), glutGet(GLUT_WINDOW_HEIGHT))
+            if self.startup != None:
+                self.startup.end('upload')
+            glutDisplayFunc(self.display)
+        else:
+            if self.startup != None:
+                self.startup.begin('wait')
+            self.set_title('TreeViewer: loading')
+            glutDisplayFunc(self.display_loading)
+        #glutReshapeFunc(reshape)#TODO: for some reason, reshaping seems 
+                                 #      to work but throws a value error.
+                                 #      I'm not using it for now.
+
+        glutSpecialFunc(self.special_key_press)
+        glutKeyboardFunc(self.char_key_press)
+        glutIgnoreKeyRepeat(1)
+        glutSpecialUpFunc(self.special_key_release)
+        glutKeyboardUpFunc(self.char_key_release)
+        glutIdleFunc(self.key_check if loader == None else self.check_loader)
+    
+        glutMouseFunc(self.mouse_button)
+        glutPassiveMotionFunc(self.mouse_motion)
+
+        if loader == None:
+            glPushMatrix()
+        profiling.end(setup)
+        glutMainLoop()
+
+    def init_gl(self, w, h):
+        '''
+        Set up the shaders, buffers, lighting and perspective
+        for a w x h viewport in the current GL context. This
+        doesn't need a window (see render.py).
+        '''
+        self.init_shaders()
+        self.init_view(w, h)
+
+    @profiling.profiled()
+    def init_shaders(self):
+        '''
+        Compile and link the shaders. This doesn't need
+        the scene.
+        '''
+        load_gl()
 
         #create the shaders
         self.fragment_shader = shaders.compileShader("""#version 130
@@ -447,24 +1152,96 @@ class TreeViewer():
         glAttachShader(self.shader_program, self.fragment_shader)
         glLinkProgram(self.shader_program)
 
-        #set up buffers on the gpu
-        self.vao = glGenVertexArrays(1)
-        glBindVertexArray(self.vao)
-        vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.vertices.nbytes, self.vertices,
-                     GL_STATIC_DRAW)
-        glEnableVertexAttribArray(0)
-        glEnableVertexAttribArray(1)
-       
-        color_offset = 4*4*(self.num_circles*360 + self.num_edge_points + self.num_cylinders*722 +
-                            (self.plate_count+self.rim_count)*360)
+        #the branch shader moves every instance of the branches up
+        #by layer_step, and fades it towards the (white) background.
+        #When masked, the edges that are out of an instance's entry
+        #of edge_mask (layers x edges) are moved out of the view.
+        self.branch_shader = shaders.compileShader("""#version 150 compatibility
+        in  vec4 color;
+        out vec4 theColor;
+        uniform float layer_step;
+        uniform float fade;
+        uniform int masked;
+        uniform samplerBuffer edge_mask;
+        uniform int first_vertex;
+        uniform int edges;
+        void main() {
+            vec4 position = gl_Vertex + vec4(0.0, 0.0, float(gl_InstanceID)*layer_step, 0.0);
+            gl_Position   = gl_ModelViewProjectionMatrix * position;
+            theColor      = mix(color, vec4(1.0), min(float(gl_InstanceID)*fade, 1.0));
+            if (masked == 1) {
+                int edge = (gl_VertexID - first_vertex)/4;
+                if (texelFetch(edge_mask, gl_InstanceID*edges + edge).r == 0.0)
+                    gl_Position = vec4(2.0, 2.0, 2.0, 1.0);
+            }
+        }""", GL_VERTEX_SHADER)
 
-        glVertexAttribPointer(0, 4, GL_FLOAT, GL_FALSE, 0, None)
-        glVertexAttribPointer(1, 4, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(color_offset))
+        self.branch_program = glCreateProgram()
+        glBindAttribLocation(self.branch_program, 0, "position")
+        glBindAttribLocation(self.branch_program, 1, "color")
+        glAttachShader(self.branch_program, self.branch_shader)
+        glAttachShader(self.branch_program, self.fragment_shader)
+        glLinkProgram(self.branch_program)
 
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
-        glBindVertexArray(0)
+        #the leaf shader places a unit disc or cylinder for every
+        #leaf (instance % leaves) and layer (instance / leaves), and
+        #shrinks the instances that shouldn't be drawn down to nothing.
+        #A leaf gets a disc when it's present in neither neighbor. Each
+        #tube instance is a run of layers (see scene.tube_runs), and each
+        #of its rings lies on a layer of the run. The radii of layer i
+        #are kept in slot (i + first_slot) % layer_count of the radii.
+        self.leaf_shader = shaders.compileShader("""#version 150 compatibility
+        in  vec3 spoke;
+        out vec4 theColor;
+        uniform samplerBuffer leaf_xy;
+        uniform samplerBuffer leaf_color;
+        uniform samplerBuffer radii;
+        uniform isamplerBuffer runs;
+        uniform int   first_instance;
+        uniform int   num_leaves;
+        uniform int   layer_count;
+        uniform int   first_slot;
+        uniform int   tubes;
+        uniform float scale;
+        uniform float start_z;
+        uniform float spacing;
+        float radius(int layer, int leaf) {
+            if (layer < 0 || layer >= layer_count)
+                return 0.0;
+            return texelFetch(radii, ((layer + first_slot) % layer_count)*num_leaves + leaf).r;
+        }
+        void main() {
+            int   id    = gl_InstanceID + first_instance;
+            int   leaf  = id % num_leaves;
+            int   layer = id / num_leaves;
+            float size  = 0.0;
+            if (tubes == 1) {
+                ivec2 run = texelFetch(runs, id).rg;
+                leaf  = run.r;
+                layer = run.g + int(spoke.z);
+                size  = radius(layer, leaf);
+            }
+            else if (radius(layer, leaf) > 0.0 && radius(layer - 1, leaf) <= 0.0
+                     && radius(layer + 1, leaf) <= 0.0)
+                size = radius(layer, leaf);
+            vec2 xy     = texelFetch(leaf_xy, leaf).rg + spoke.xy*size*scale;
+            gl_Position = gl_ModelViewProjectionMatrix *
+                          vec4(xy, start_z + float(layer)*spacing, 1.0);
+            theColor    = texelFetch(leaf_color, leaf);
+        }""", GL_VERTEX_SHADER)
+
+        self.leaf_program = glCreateProgram()
+        glBindAttribLocation(self.leaf_program, 0, "spoke")
+        glAttachShader(self.leaf_program, self.leaf_shader)
+        glAttachShader(self.leaf_program, self.fragment_shader)
+        glLinkProgram(self.leaf_program)
+
+    def init_view(self, w, h):
+        '''
+        Upload the scene, and set up lighting and perspective
+        for a w x h viewport.
+        '''
+        self.init_buffers()
 
         #set up lighting and perspective
         glClearColor(1.,1.,1.,1.)
@@ -480,52 +1257,196 @@ class TreeViewer():
         glLightf(GL_LIGHT0, GL_CONSTANT_ATTENUATION, 0.1)
         glLightf(GL_LIGHT0, GL_LINEAR_ATTENUATION, 0.05)
         glEnable(GL_LIGHT0)
-        glutDisplayFunc(self.display)
-        #glutReshapeFunc(reshape)#TODO: for some reason, reshaping seems 
-                                 #      to work but throws a value error.
-                                 #      I'm not using it for now.
 
-        w = glutGet(GLUT_WINDOW_WIDTH)
-        h = glutGet(GLUT_WINDOW_HEIGHT)
         glViewport(0, 0, w, h)
         glFrustum(-1.0, 1.0, -1.0, 1.0, 1.0, 1000000000.0)
         glMatrixMode(GL_PROJECTION)
         gluPerspective(25.,float(w)/float(h),1.,1000000000.)
         glMatrixMode(GL_MODELVIEW)
 
-        glutSpecialFunc(self.special_key_press)
-        glutKeyboardFunc(self.char_key_press)
-        glutIgnoreKeyRepeat(1)
-        glutSpecialUpFunc(self.special_key_release)
-        glutKeyboardUpFunc(self.char_key_release)
-        glutIdleFunc(self.key_check)
-    
-        glutMouseFunc(self.mouse_button)
+        if self.stats != None:
+            self.stats.init_gl()
+            self.stats.set_scene(self.scene_stats())
 
-        glPushMatrix()
-        glutMainLoop()
+
+class StreamingTreeViewer(TreeViewer):
+    '''
+    A TreeViewer that keeps the radii of its window of samples
+    on the gpu in a ring of layer slots. Moving the window with
+    '[' and ']' only uploads the radii of the samples that enter
+    it, over the slots of the samples that leave it, and the leaf
+    shader reads the layers of the window from first_slot on.
+    Every TreeViewer scrolls through every sample without building
+    any geometry, so this only saves uploading the whole window.
+    '''
+
+    @profiling.profiled()
+    def set_first_sample(self, first):
+        '''
+        Show the samples from first onwards. The samples that
+        stay in the window keep their slots, and only the slots
+        of the samples that weren't already shown are uploaded.
+        '''
+        if self.abundance == None:
+            return
+        last  = max(0, self.abundance.get_sample_count() - self.layer_count)
+        first = max(0, min(first, last))
+        if first == self.first_sample:
+            return
+        shown             = set(range(self.first_sample, self.first_sample + self.layer_count))
+        self.first_slot   = (self.first_slot + first - self.first_sample) % self.layer_count
+        self.first_sample = first
+        self.leaf_bounds  = None
+
+        self.radii      = self.abundance.get_radii(first, self.layer_count)
+        self.tubes      = tube_runs(self.radii)
+        self.tube_shown = None
+        row_bytes       = self.radii[0].nbytes
+        glBindBuffer(GL_TEXTURE_BUFFER, self.radii_buffer)
+        for i in range(self.layer_count):
+            if first + i not in shown:
+                slot = (self.first_slot + i) % self.layer_count
+                glBufferSubData(GL_TEXTURE_BUFFER, slot*row_bytes, row_bytes, self.radii[i])
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+        self.update_views()
+
+        self.set_title('TreeViewer: samples %d-%d of %d' %
+                       (first + 1, first + self.layer_count,
+                        self.abundance.get_sample_count()))
 
 
 if __name__ == '__main__': 
+    times  = StartupTimes()
     parser = argparse.ArgumentParser()
-    parser.add_argument('newick_file', type=str)
-    parser.add_argument('condensed_counts_file', type=str)
+    parser.add_argument('newick_file', type=str, nargs='?')
+    parser.add_argument('condensed_counts_file', type=str, nargs='?')
     parser.add_argument('layer_count', type=int, help="the number of samples to display",
                          nargs='?', default=MAX_LAYERS)
+    parser.add_argument('--scene', type=str,
+                        help="a precomputed scene file (see scene.py), or the url of a "
+                             "scene served by scene_server.py")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used to build the inner node discs")
+    parser.add_argument('--stream', action='store_true',
+                        help="keep the samples on display in a ring of layer slots on the gpu, "
+                             "and only upload the samples that enter it when scrolling")
+    parser.add_argument('--trees', type=str, nargs='+',
+                        help="compare per-sample trees, one per layer, laid out "
+                             "against the leaf order of newick_file")
+    parser.add_argument('--views', action='store_true',
+                        help="show every sample's view of the tree (the leaves present "
+                             "and their ancestors) on its layer")
+    parser.add_argument('--lod', type=float, nargs='?', const=LOD_PIXELS,
+                        help="collapse clades narrower than this many pixels (%g by "
+                             "default) into single leaves" % LOD_PIXELS)
+    parser.add_argument('--all-branches', action='store_true',
+                        help="draw the branches on every layer, not only the first and last")
+    parser.add_argument('--fade', type=float, default=0.0,
+                        help="with --all-branches, fade the branches of the layers past "
+                             "the first by up to this much (0 to 1)")
+    parser.add_argument('--watch', action='store_true',
+                        help="rebuild the scene in the open window whenever the tree "
+                             "or counts files change")
+    parser.add_argument('--stats', action='store_true',
+                        help="record frame times and scene statistics, shown in the title")
+    parser.add_argument('--stats-file', type=str,
+                        help="write the statistics to a .csv or .json file on exit (implies --stats)")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
-    newick_file = args.newick_file
-    c_file      = args.condensed_counts_file
-    layers      = (args.layer_count if args.layer_count <= MAX_LAYERS 
-                  and args.layer_count > 0 else MAX_LAYERS)
-
-    newick_f = open(newick_file, 'r')
-
-    c_map    = CountsMap(c_file)
-    newick_s = newick_f.readlines()[0]
-    tree     = NewickTree(newick_s, c_map) 
-    #if tree == 0:
-    #   print('ERROR: failed to build tree')
-    #   sys.exit()
-    tv       = TreeViewer(tree, layers) 
-    tv.execute()
+    profiling.enable_from_args(args)
+
+    if args.trees != None and args.scene != None:
+        parser.error('--trees can\'t be used with --scene')
+    if args.views and (args.scene != None or args.trees != None):
+        parser.error('--views can\'t be used with --scene or --trees')
+    if args.watch and args.scene != None:
+        parser.error('--watch can\'t be used with --scene')
+
+    viewer = StreamingTreeViewer if args.stream else TreeViewer
+
+    loader = None
+    if args.scene != None:
+        times.begin('scene')
+        scene_path = args.scene
+        if scene_path.startswith('http://') or scene_path.startswith('https://'):
+            from scene_server import fetch_scene
+            scene_path = fetch_scene(scene_path)
+            if scene_path == None:
+                sys.exit(1)
+        scene = load_scene(scene_path)
+        if scene == None:
+            sys.exit(1)
+        times.end('scene')
+        tv = viewer(scene)
+    else:
+        if args.newick_file == None or args.condensed_counts_file == None:
+            parser.error('a newick file and a counts file are required without --scene')
+        newick_file = args.newick_file
+        c_file      = args.condensed_counts_file
+        layers      = (args.layer_count if args.layer_count <= MAX_LAYERS 
+                      and args.layer_count > 0 else MAX_LAYERS)
+
+        #read the inputs and build the scene while
+        #the window and the shaders are set up
+        def load(times, workers=args.workers):
+            times.begin('counts')
+            c_map = CountsMap(c_file)
+            times.end('counts')
+            times.begin('newick')
+            if args.trees != None:
+                leaf_index, trees = load_trees(args.trees, c_map, newick_file)
+                samples = [tree_sample(path, i) for i, path in enumerate(args.trees)]
+                builder = ComparisonBuilder(leaf_index, trees, samples, workers)
+            else:
+                tree = NewickTree(read_newick(newick_file), c_map)
+                if args.views:
+                    builder = ViewBuilder(tree, layers, workers)
+                else:
+                    builder = SceneBuilder(tree, layers, workers)
+            times.end('newick')
+            times.begin('build')
+            scene = builder.build()
+            times.end('build')
+            return scene
+
+        loader = SceneLoader(load, times)
+        loader.start()
+        tv     = viewer()
+
+        if args.watch:
+            #only the leaves change with the counts, unless
+            #a leaf of the tree is missing from them
+            def reload(changed, times):
+                if changed == [c_file]:
+                    times.begin('counts')
+                    scene = recount(tv.scene, CountsMap(c_file))
+                    times.end('counts')
+                    if scene != None:
+                        return scene
+                #reloads run on a thread of the viewer, which
+                #can't safely fork a pool of workers
+                return load(times, 1)
+
+            tv.set_watch(InputWatcher([newick_file, c_file] + (args.trees or [])),
+                         reload)
+
+    if args.all_branches:
+        tv.set_branches(True, min(max(args.fade, 0.0), 1.0))
+    elif args.fade != 0.0:
+        parser.error('--fade only applies with --all-branches')
+
+    if args.lod != None:
+        tv.set_lod(args.lod)
+
+    if args.stats or args.stats_file != None:
+        stats = FrameStats()
+        tv.set_stats(stats)
+
+        def report():
+            print(stats.summary())
+            if args.stats_file != None:
+                stats.dump(args.stats_file)
+        atexit.register(report)
 
+    tv.set_startup(times)
+    tv.execute(loader)
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+'''
+Picking for the TreeViewer: find the node under the cursor.
+
+The nodes of a tree are put in a 2d tree (KDTree) over their
+x, y coordinates once. A pick then unprojects the cursor into a
+ray through the scene, intersects the ray with the plane of every
+layer from front to back, and looks up the nearest node on each
+plane in O(log n). The first node close enough to the ray is the
+pick, which resolves to the node, its sample (layer) and its
+abundance in that sample.
+'''
+from newick_tree import clade_matrix
+import numpy
+
+#the number of points below which a 2d tree
+#node is searched directly
+KD_LEAF_SIZE = 16
+
+#how close (in scene units) the cursor must
+#come to a node for it to be picked
+PICK_RADIUS = .3
+
+
+class KDTree():
+    '''
+    A 2d tree over points for nearest neighbor queries. The tree is
+    kept implicitly in a single permutation of the points: each range
+    of the permutation is split at its middle point, along x and y in
+    turn, down to ranges of KD_LEAF_SIZE points.
+    '''
+
+    def __init__(self, points):
+        self.points = numpy.asarray(points, dtype=numpy.float64).reshape((-1, 2))
+        self.order  = numpy.arange(len(self.points))
+        self.build(0, len(self.points), 0)
+        self.sorted = self.points[self.order]
+
+    def build(self, lo, hi, axis):
+        if hi - lo <= KD_LEAF_SIZE:
+            return
+        mid  = (lo + hi)//2
+        part = numpy.argpartition(self.points[self.order[lo:hi], axis], mid - lo)
+        self.order[lo:hi] = self.order[lo:hi][part]
+        self.build(lo, mid, 1 - axis)
+        self.build(mid + 1, hi, 1 - axis)
+
+    def nearest(self, x, y):
+        '''
+        Get the index and distance of the point nearest
+        to x, y, or (-1, inf) for an empty tree.
+        '''
+        best = [-1, numpy.inf]
+        self.search(0, len(self.sorted), 0, numpy.array([x, y]), best)
+        if best[0] < 0:
+            return -1, numpy.inf
+        return int(self.order[best[0]]), float(numpy.sqrt(best[1]))
+
+    def search(self, lo, hi, axis, point, best):
+        if hi - lo <= KD_LEAF_SIZE:
+            if hi > lo:
+                dist = ((self.sorted[lo:hi] - point)**2).sum(axis=1)
+                i    = int(numpy.argmin(dist))
+                if dist[i] < best[1]:
+                    best[0], best[1] = lo + i, dist[i]
+            return
+
+        mid  = (lo + hi)//2
+        dist = ((self.sorted[mid] - point)**2).sum()
+        if dist < best[1]:
+            best[0], best[1] = mid, dist
+
+        #search the side of the split holding the point first, and
+        #the other side only if it could hold anything closer
+        diff = point[axis] - self.sorted[mid, axis]
+        if diff < 0:
+            near, far = (lo, mid), (mid + 1, hi)
+        else:
+            near, far = (mid + 1, hi), (lo, mid)
+        self.search(near[0], near[1], 1 - axis, point, best)
+        if diff*diff < best[1]:
+            self.search(far[0], far[1], 1 - axis, point, best)
+
+
+class Picker():
+    '''
+    Resolve cursor positions to nodes, samples and abundances
+    for a scene with an AbundanceTable and a NodeTable.
+    '''
+
+    def __init__(self, abundance, node_table, info):
+        self.abundance  = abundance
+        self.node_table = node_table
+        self.start_z    = info['start_z']
+        self.spacing    = info['spacing']
+        self.index      = KDTree(node_table.get_xy())
+
+        node_count     = node_table.get_node_count()
+        leaf_nodes     = abundance.get_leaf_nodes()
+        self.leaf_rows = numpy.full(node_count, -1, dtype=numpy.int64)
+        self.leaf_rows[leaf_nodes] = numpy.arange(abundance.get_num_leaves())
+
+        #the abundance of every clade in every sample, and
+        #the number of leaves below every node
+        parents          = node_table.get_parents()
+        self.clades      = clade_matrix(parents, leaf_nodes, abundance.get_counts())
+        self.clade_sizes = clade_matrix(parents, leaf_nodes,
+                                        numpy.ones(len(leaf_nodes)))[:, 0].astype(numpy.int64)
+
+    def ray(self, matrix, x, y, width, height):
+        '''
+        Unproject window coordinates (from the top left, as GLUT
+        hands them over) through a modelview-projection matrix
+        (row vectors) into a ray from the near plane into the
+        scene. The second point of the ray is taken just past the
+        near plane, as the viewer's far plane is too far off to
+        unproject accurately.
+        '''
+        ndc_x = 2.0*(x + .5)/width - 1.0
+        ndc_y = 1.0 - 2.0*(y + .5)/height
+        ends  = numpy.array([[ndc_x, ndc_y, -1.0, 1.0],
+                             [ndc_x, ndc_y, 0.0, 1.0]])
+        ends  = numpy.dot(ends, numpy.linalg.inv(matrix))
+        ends  = ends[:, :3]/ends[:, 3:4]
+        return ends[0], ends[1] - ends[0]
+
+    def pick(self, matrix, x, y, width, height, first_sample, layer_count, scale):
+        '''
+        Get the node under the cursor as a dictionary with the node,
+        its name, whether it's a leaf, the layer and sample it was
+        picked in, the abundance of the node (the total abundance of
+        its leaves for a clade) and its leaf count. None is returned
+        when nothing is close enough.
+        '''
+        origin, direction = self.ray(matrix, x, y, width, height)
+        if abs(direction[2]) < 1e-12:
+            return None
+
+        layers = numpy.arange(layer_count)
+        ts     = (self.start_z + layers*self.spacing - origin[2])/direction[2]
+        counts = self.abundance.get_counts()
+        for layer in layers[numpy.argsort(ts)]:
+            t = ts[layer]
+            if t < 0:
+                continue
+            hit_x, hit_y = origin[:2] + t*direction[:2]
+            node, dist   = self.index.nearest(hit_x, hit_y)
+            if node < 0:
+                return None
+
+            #a leaf is also picked anywhere on its disc
+            sample = first_sample + int(layer)
+            row    = self.leaf_rows[node]
+            reach  = PICK_RADIUS
+            if row >= 0 and sample < counts.shape[1]:
+                reach = max(reach, counts[row, sample]*scale)
+            if dist > reach:
+                continue
+
+            if sample < self.clades.shape[1]:
+                abundance = float(self.clades[node, sample])
+            else:
+                abundance = 0.0
+            return {'node'      : node,
+                    'name'      : self.node_table.get_names()[node],
+                    'leaf'      : bool(row >= 0),
+                    'layer'     : int(layer),
+                    'sample'    : sample,
+                    'abundance' : abundance,
+                    'leaves'    : int(self.clade_sizes[node])}
+        return None
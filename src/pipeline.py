@@ -0,0 +1,367 @@
+#!/usr/bin/python
+'''
+Run the steps from a study's OTU tables to its scenes as one
+incremental pipeline.
+
+The steps are the scripts in src, run as they would be by hand:
+    condense    -- condense.py, the OTU counts by genus
+    prune_N     -- prune_taxa.py, the taxa present in sample N
+    tree_N      -- request_newick_trees.py, the tree of sample N
+                   (from phyloT, only with --request-trees)
+    scene       -- scene.py, the scene of the full tree
+    compare     -- comparison.py, the scene of the sample trees
+
+Each stage records the files it reads and writes, and the stages
+form a DAG. A stage's key is a hash of its script, its arguments
+and the content of everything it reads, and the keys and output
+hashes of the stages that ran are kept in pipeline.json in the
+study directory. A stage whose key is unchanged and whose outputs
+are still as it left them is skipped. A sample's prune stage only
+reads the header and its own row of the OTU counts, so adding a few
+samples to a study only prunes (and requests trees for) those.
+The stages whose dependencies are done run in parallel. With
+--profile every stage is profiled too, and its trace is added to
+the pipeline's own.
+
+Every output goes to the study directory, and every stage is run
+from it.
+
+Ex:
+    python pipeline.py ../data/otu_counts.txt ../data/otu_rdp_taxa.txt study --exempt ../data/not_found.txt --tree ../trees/full_tree --jobs 4
+'''
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from input_files import open_input
+import argparse
+import hashlib
+import json
+import os
+import profiling
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR  = os.path.dirname(os.path.abspath(__file__))
+MANIFEST = 'pipeline.json'
+
+#files are hashed this many bytes at a time
+HASH_BLOCK = 1 << 20
+
+
+def file_digest(path, lines=None):
+    '''
+    Get the sha256 of a file, or of only some of its lines
+    (counted from 0). None is returned for a missing file.
+    '''
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    if lines == None:
+        in_f  = open(path, 'rb')
+        block = in_f.read(HASH_BLOCK)
+        while len(block) > 0:
+            digest.update(block)
+            block = in_f.read(HASH_BLOCK)
+    else:
+        #lines are those of the decompressed file
+        in_f   = open_input(path, binary=True)
+        wanted = set(lines)
+        for i, line in enumerate(in_f):
+            if i in wanted:
+                digest.update(line)
+    in_f.close()
+    return digest.hexdigest()
+
+
+class Input():
+    '''
+    A file a stage reads, or only some lines of it.
+    '''
+
+    def __init__(self, path, lines=None):
+        self.path  = path
+        self.lines = lines
+
+    def get_path(self):
+        return self.path
+
+    def digest(self, out_dir):
+        return file_digest(os.path.join(out_dir, self.path), self.lines)
+
+
+class Stage():
+    '''
+    A step of the pipeline: a script in src run with a list of
+    arguments, along with the inputs it reads, the outputs it
+    writes (relative to the study directory) and the names of
+    the stages it depends on.
+    '''
+
+    def __init__(self, name, script, args, inputs, outputs, deps=None):
+        self.name    = name
+        self.script  = script
+        self.args    = args
+        self.inputs  = inputs
+        self.outputs = outputs
+        self.deps    = list(deps or [])
+
+    def get_name(self):
+        return self.name
+
+    def get_outputs(self):
+        return self.outputs
+
+    def get_deps(self):
+        return self.deps
+
+    def key(self, out_dir):
+        '''
+        Hash the script, the arguments and every input. Inputs are
+        hashed by their content, so the arguments naming them are
+        left out (moving an input doesn't change the key). None is
+        returned when an input is missing.
+        '''
+        paths  = [i.get_path() for i in self.inputs]
+        args   = [('input %d' % paths.index(a)) if a in paths else a for a in self.args]
+        digest = hashlib.sha256()
+        digest.update(file_digest(os.path.join(SRC_DIR, self.script)).encode())
+        digest.update(json.dumps(args).encode())
+        for i in self.inputs:
+            input_digest = i.digest(out_dir)
+            if input_digest == None:
+                return None
+            digest.update(input_digest.encode())
+        return digest.hexdigest()
+
+    def run(self, out_dir):
+        '''
+        Run the stage from the study directory, and get its
+        exit status along with what it printed. While profiling,
+        the stage writes its own trace, which is then merged
+        into this process's.
+        '''
+        for path in self.outputs:
+            out_path = os.path.dirname(os.path.join(out_dir, path))
+            if not os.path.isdir(out_path):
+                os.makedirs(out_path)
+        env     = None
+        profile = None
+        if profiling.get_profiler() != None:
+            handle, profile = tempfile.mkstemp(suffix='.json')
+            os.close(handle)
+            env = dict(os.environ)
+            env[profiling.PROFILE_ENV] = profile
+            env[profiling.MEMORY_ENV]  = str(int(profiling.get_profiler().traces_memory()))
+        with profiling.span(self.name, script=self.script):
+            proc = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, self.script)]
+                                    + self.args, cwd=out_dir, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, universal_newlines=True,
+                                    env=env)
+            output = proc.communicate()[0]
+        if profile != None:
+            profiling.merge_trace(profile)
+        return proc.returncode, output
+
+
+class Pipeline():
+    '''
+    A DAG of stages run in a study directory, which also
+    holds the manifest of the stages that ran.
+    '''
+
+    def __init__(self, out_dir):
+        self.out_dir  = out_dir
+        self.stages   = OrderedDict()
+        self.manifest = {}
+        manifest_path = os.path.join(out_dir, MANIFEST)
+        if os.path.isfile(manifest_path):
+            manifest_f    = open(manifest_path, 'r')
+            self.manifest = json.load(manifest_f)
+            manifest_f.close()
+
+    def add(self, stage):
+        self.stages[stage.get_name()] = stage
+
+    def get_stages(self):
+        return list(self.stages.values())
+
+    def save_manifest(self):
+        '''
+        Write the manifest, through a temporary file so an
+        interrupted run never leaves half of one behind.
+        '''
+        path       = os.path.join(self.out_dir, MANIFEST)
+        manifest_f = open(path + '.tmp', 'w')
+        json.dump(self.manifest, manifest_f, indent=1, sort_keys=True)
+        manifest_f.close()
+        os.rename(path + '.tmp', path)
+
+    def up_to_date(self, stage, key):
+        '''
+        A stage is up to date when it last ran with the same key,
+        and its outputs haven't changed since.
+        '''
+        record = self.manifest.get(stage.get_name())
+        if record == None or record['key'] != key:
+            return False
+        for path in stage.get_outputs():
+            if file_digest(os.path.join(self.out_dir, path)) != record['outputs'].get(path):
+                return False
+        return True
+
+    def waves(self):
+        '''
+        Split the stages into waves, where every stage only
+        depends on the stages of earlier waves.
+        '''
+        done  = set()
+        left  = self.get_stages()
+        waves = []
+        while len(left) > 0:
+            wave = [s for s in left if all([d in done for d in s.get_deps()])]
+            if len(wave) == 0:
+                print('ERROR: the stages ' + ', '.join([s.get_name() for s in left])
+                      + ' depend on stages that never run')
+                return None
+            waves.append(wave)
+            done.update([s.get_name() for s in wave])
+            left = [s for s in left if s.get_name() not in done]
+        return waves
+
+    def run(self, jobs=1, force=False, dry_run=False):
+        '''
+        Run every stage that isn't up to date, wave by wave, with
+        up to jobs stages at once. The stages that depend on a
+        failed stage are skipped. True is returned when every
+        stage is up to date in the end.
+        '''
+        waves = self.waves()
+        if waves == None:
+            return False
+
+        failed  = set()
+        pending = set()
+        pool    = ThreadPool(max(jobs, 1))
+        try:
+            for wave in waves:
+                todo = []
+                for stage in wave:
+                    if any([d in failed for d in stage.get_deps()]):
+                        print('skipped     ' + stage.get_name())
+                        failed.add(stage.get_name())
+                        continue
+                    key = stage.key(self.out_dir)
+                    if dry_run and any([d in pending for d in stage.get_deps()]):
+                        todo.append((stage, key))
+                    elif key == None and not dry_run:
+                        print('ERROR: missing input for ' + stage.get_name())
+                        failed.add(stage.get_name())
+                    elif not force and key != None and self.up_to_date(stage, key):
+                        print('up to date  ' + stage.get_name())
+                    else:
+                        todo.append((stage, key))
+
+                if dry_run:
+                    for stage, key in todo:
+                        print('would run   ' + stage.get_name())
+                        pending.add(stage.get_name())
+                    continue
+
+                def run_stage(task):
+                    start = time.time()
+                    code, output = task[0].run(self.out_dir)
+                    return code, output, time.time() - start
+
+                for (stage, key), (code, output, seconds) in zip(todo,
+                        pool.map(run_stage, todo)):
+                    if code != 0:
+                        print('ERROR: %s failed (exit status %d)' % (stage.get_name(), code))
+                        print(output)
+                        failed.add(stage.get_name())
+                        self.manifest.pop(stage.get_name(), None)
+                        continue
+                    print('ran         %s (%.2f s)' % (stage.get_name(), seconds))
+                    outputs = {}
+                    for path in stage.get_outputs():
+                        outputs[path] = file_digest(os.path.join(self.out_dir, path))
+                    self.manifest[stage.get_name()] = {'key' : key, 'outputs' : outputs}
+                if len(todo) > 0:
+                    self.save_manifest()
+        finally:
+            pool.close()
+            pool.join()
+        return len(failed) == 0
+
+
+def study_pipeline(args):
+    '''
+    Lay out the stages of a study.
+    '''
+    counts    = os.path.abspath(args.otu_counts)
+    taxa      = os.path.abspath(args.otu_taxa)
+    exempt    = os.path.abspath(args.exempt)
+    condensed = 'condensed_counts.txt'
+
+    counts_f = open_input(counts)
+    samples  = max(sum([1 for line in counts_f]) - 1, 0)
+    counts_f.close()
+
+    pipeline = Pipeline(args.out_dir)
+    pipeline.add(Stage('condense', 'condense.py', [counts, taxa, '--out', condensed],
+                       [Input(counts), Input(taxa)], [condensed]))
+
+    trees = []
+    for n in range(1, samples + 1):
+        pruned = os.path.join('pruned', str(n))
+        sample = os.path.join(pruned, 'sample_' + str(n))
+        pipeline.add(Stage('prune_%d' % n, 'prune_taxa.py',
+                           [taxa, '--counts', counts, '--exempt', exempt,
+                            '--out-dir', pruned, '--rows', str(n)],
+                           [Input(taxa), Input(exempt), Input(counts, [0, n])], [sample]))
+        if args.request_trees:
+            tree = os.path.join('trees', 'tree_' + str(n))
+            pipeline.add(Stage('tree_%d' % n, 'request_newick_trees.py', [pruned, 'trees'],
+                               [Input(sample)], [tree], ['prune_%d' % n]))
+            trees.append(tree)
+
+    if args.tree != None:
+        tree = os.path.abspath(args.tree)
+        pipeline.add(Stage('scene', 'scene.py',
+                           [tree, condensed, str(args.layers), 'study.scene'],
+                           [Input(tree), Input(condensed)], ['study.scene'], ['condense']))
+        if len(trees) > 0:
+            pipeline.add(Stage('compare', 'comparison.py',
+                               [condensed, 'compare.scene', '--reference', tree, '--trees']
+                               + trees, [Input(tree), Input(condensed)]
+                               + [Input(t) for t in trees], ['compare.scene'],
+                               ['condense'] + ['tree_%d' % n for n in range(1, samples + 1)]))
+    return pipeline
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('otu_counts', type=str)
+    parser.add_argument('otu_taxa', type=str)
+    parser.add_argument('out_dir', type=str, help="the study directory")
+    parser.add_argument('--exempt', type=str, default='../data/not_found.txt',
+                        help="the taxa the tree builder doesn't know")
+    parser.add_argument('--tree', type=str, help="the full tree, to build a scene of")
+    parser.add_argument('--layers', type=int, default=15,
+                        help="the number of layers of the scene")
+    parser.add_argument('--request-trees', action='store_true',
+                        help="request a tree for every sample from phyloT")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="the number of stages run at once")
+    parser.add_argument('--force', action='store_true', help="run every stage")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only show the stages that would run")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    pipeline = study_pipeline(args)
+    if not pipeline.run(args.jobs, args.force, args.dry_run):
+        sys.exit(1)
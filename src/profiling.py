@@ -0,0 +1,347 @@
+#!/usr/bin/python
+'''
+Time nested spans of work (and, optionally, the memory they take)
+across the viewer and its scripts, and write them out as a trace.
+
+Profiling is off unless PHYLO_PROFILE names a trace file, or a
+script is run with --profile [file] (profile.json by default). While
+it's off, span() hands back one shared span that does nothing, and a
+profiled function only checks a global before it runs, so the spans
+can stay in place. With PHYLO_PROFILE_MEMORY=1 (or --profile-memory)
+tracemalloc follows every allocation as well, and the memory traced
+at the start and end of every span is recorded along with it.
+
+The trace is written when the process exits, in the Chrome trace
+event format: a complete event for every span (which nest by their
+times), a 'memory' counter when memory is traced, and the names of
+the process and its threads. It opens in chrome://tracing or
+https://ui.perfetto.dev. A SceneLoader's process sends its spans back
+to the viewer, and pipeline.py gathers the traces of the stages it
+runs, so each of them ends up with a single trace of every process.
+
+Ex:
+    PHYLO_PROFILE=viewer.json python phylo_viewer.py ../trees/full_tree ../data/condensed_counts.txt 15
+    python scene.py ../trees/full_tree ../data/condensed_counts.txt 15 out.scene --profile --profile-memory
+'''
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+PROFILE_ENV   = 'PHYLO_PROFILE'
+MEMORY_ENV    = 'PHYLO_PROFILE_MEMORY'
+DEFAULT_TRACE = 'profile.json'
+
+#the profiler of this process, while profiling is on
+PROFILER = None
+
+
+def now():
+    '''
+    Get the time in microseconds. Wall clock time is used so
+    that the spans of different processes line up.
+    '''
+    return time.time()*1e6
+
+
+class Profiler():
+    '''
+    Record the spans of a process as trace events, to be
+    written to path. The whole run is a span of its own,
+    named after the script.
+    '''
+
+    def __init__(self, path, memory=False):
+        self.path        = path
+        self.pid         = os.getpid()
+        self.events      = []
+        self.processes   = set()
+        self.threads     = set()
+        self.tracemalloc = None
+        if memory:
+            self.trace_memory()
+        self.root = self.begin(os.path.basename(sys.argv[0]) or 'python')
+
+    def get_path(self):
+        return self.path
+
+    def set_path(self, path):
+        self.path = path
+
+    def get_events(self):
+        return self.events
+
+    def traces_memory(self):
+        return self.tracemalloc != None
+
+    def trace_memory(self):
+        '''
+        Start following allocations with tracemalloc.
+        '''
+        try:
+            import tracemalloc
+        except ImportError:
+            print('WARNING: memory profiling needs tracemalloc (python 3)')
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.tracemalloc = tracemalloc
+
+    def count_memory(self, ts, current):
+        self.events.append({'name' : 'memory', 'ph' : 'C', 'ts' : ts, 'pid' : os.getpid(),
+                            'tid' : self.name_thread(),
+                            'args' : {'traced_mb' : current/1048576.0}})
+
+    def name_thread(self):
+        '''
+        Name the current process and thread in the trace the
+        first time they record an event, and get the thread id.
+        '''
+        pid = os.getpid()
+        if pid not in self.processes:
+            self.processes.add(pid)
+            name = ' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:])
+            if pid != self.pid:
+                name += ' (forked)'
+            self.events.append({'name' : 'process_name', 'ph' : 'M', 'pid' : pid,
+                                'args' : {'name' : name}})
+        thread = threading.current_thread()
+        key    = (pid, thread.ident)
+        if key not in self.threads:
+            self.threads.add(key)
+            self.events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : key[0],
+                                'tid' : key[1], 'args' : {'name' : thread.name}})
+        return key[1]
+
+    def begin(self, name, args=None):
+        '''
+        Start a span, and get the token that ends it.
+        '''
+        memory = None
+        start  = now()
+        if self.tracemalloc != None:
+            memory = self.tracemalloc.get_traced_memory()[0]
+            self.count_memory(start, memory)
+        return (name, args, start, memory)
+
+    def end(self, token):
+        '''
+        End the span that token began, recording it as a complete
+        event (with the memory traced at its end, how much that
+        grew during the span, and the peak so far).
+        '''
+        name, args, start, memory = token
+        finish = now()
+        args   = dict(args or {})
+        if self.tracemalloc != None and memory != None:
+            current, peak = self.tracemalloc.get_traced_memory()
+            args['traced_bytes'] = current
+            args['traced_delta'] = current - memory
+            args['traced_peak']  = peak
+            self.count_memory(finish, current)
+        self.events.append({'name' : name, 'cat' : 'span', 'ph' : 'X', 'ts' : start,
+                            'dur' : finish - start, 'pid' : os.getpid(),
+                            'tid' : self.name_thread(), 'args' : args})
+
+    def instant(self, name):
+        self.events.append({'name' : name, 'cat' : 'mark', 'ph' : 'i', 's' : 't',
+                            'ts' : now(), 'pid' : os.getpid(), 'tid' : self.name_thread()})
+
+    def write(self):
+        '''
+        End the span of the whole run, and write the trace. Only
+        the process that started profiling writes it (forked
+        workers inherit the profiler, but not the trace file).
+        '''
+        if os.getpid() != self.pid:
+            return
+        if self.root != None:
+            self.end(self.root)
+            self.root = None
+        #write through a temporary file so an interrupted
+        #run never leaves half of a trace behind
+        trace_f = open(self.path + '.tmp', 'w')
+        json.dump({'traceEvents' : self.events, 'displayTimeUnit' : 'ms'}, trace_f)
+        trace_f.close()
+        os.rename(self.path + '.tmp', self.path)
+        print('wrote %d profiling events to %s' % (len(self.events), self.path))
+
+
+class Span():
+    '''
+    A span of a Profiler, as a context manager.
+    '''
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name     = name
+        self.args     = args
+        self.token    = None
+
+    def __enter__(self):
+        self.token = self.profiler.begin(self.name, self.args)
+        return self
+
+    def __exit__(self, kind, value, trace):
+        self.profiler.end(self.token)
+        return False
+
+
+class NullSpan():
+    '''
+    The span handed out while profiling is off.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, trace):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+def enable(path=DEFAULT_TRACE, memory=False):
+    '''
+    Turn profiling on, writing the trace to path when the process
+    exits. When it's already on, the trace is moved to path (and
+    memory tracing is turned on as needed).
+    '''
+    global PROFILER
+    if PROFILER == None:
+        PROFILER = Profiler(path, memory)
+        atexit.register(write_profile)
+    else:
+        PROFILER.set_path(path)
+        if memory and not PROFILER.traces_memory():
+            PROFILER.trace_memory()
+    return PROFILER
+
+
+def get_profiler():
+    return PROFILER
+
+
+def write_profile():
+    if PROFILER != None:
+        PROFILER.write()
+
+
+def span(name, **args):
+    '''
+    Get a context manager that records a span named name,
+    with any keyword arguments attached to it.
+    '''
+    if PROFILER == None:
+        return NULL_SPAN
+    return Span(PROFILER, name, args)
+
+
+def begin(name, **args):
+    '''
+    Start a span that ends with end(token). None is
+    returned while profiling is off.
+    '''
+    if PROFILER == None:
+        return None
+    return PROFILER.begin(name, args)
+
+
+def end(token):
+    if PROFILER != None and token != None:
+        PROFILER.end(token)
+
+
+def instant(name):
+    if PROFILER != None:
+        PROFILER.instant(name)
+
+
+def profiled(name=None):
+    '''
+    Decorate a function so that every call to it is a
+    span (named after the function by default).
+    '''
+    def decorate(func):
+        label = name if name != None else getattr(func, '__qualname__', func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if PROFILER == None:
+                return func(*args, **kwargs)
+            token = PROFILER.begin(label)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PROFILER.end(token)
+        return wrapper
+    return decorate
+
+
+def event_count():
+    if PROFILER == None:
+        return 0
+    return len(PROFILER.get_events())
+
+
+def events_since(count):
+    '''
+    Get the events recorded since event_count() was count
+    (to hand the events of a forked process back to its
+    parent).
+    '''
+    if PROFILER == None:
+        return []
+    return PROFILER.get_events()[count:]
+
+
+def add_events(events):
+    if PROFILER != None:
+        PROFILER.get_events().extend(events)
+
+
+def merge_trace(path):
+    '''
+    Add the events of the trace another process wrote to
+    path, and remove the file.
+    '''
+    if not os.path.isfile(path):
+        return
+    trace_f = open(path, 'r')
+    try:
+        add_events(json.load(trace_f).get('traceEvents', []))
+    except ValueError:
+        print('WARNING: unable to read the profile in ' + path)
+    trace_f.close()
+    os.remove(path)
+
+
+def add_arguments(parser):
+    '''
+    Add --profile and --profile-memory to a script's
+    ArgumentParser.
+    '''
+    parser.add_argument('--profile', type=str, nargs='?', const=DEFAULT_TRACE,
+                        help="write a Chrome trace of where the time goes to this file "
+                             "(%s by default)" % DEFAULT_TRACE)
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="also trace the memory allocated in every span (implies --profile)")
+
+
+def enable_from_args(args):
+    '''
+    Turn profiling on for a script run with --profile
+    or --profile-memory.
+    '''
+    if args.profile != None or args.profile_memory:
+        path = args.profile
+        if path == None:
+            path = PROFILER.get_path() if PROFILER != None else DEFAULT_TRACE
+        enable(path, args.profile_memory)
+
+
+if os.environ.get(PROFILE_ENV):
+    enable(os.environ[PROFILE_ENV], os.environ.get(MEMORY_ENV, '') not in ('', '0'))
@@ -10,7 +10,9 @@ using, so I also check each organism against
 an 'exempt list'. 
 '''
 
+from input_files import open_input
 import argparse
+import profiling
 
 def is_number(s):
     try:
@@ -23,12 +25,19 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("taxa")
     #parser.add_argument("out_file")
+    parser.add_argument("--counts", default="../data/otu_counts.txt")
+    parser.add_argument("--exempt", default="../data/not_found.txt")
+    parser.add_argument("--out-dir", default="pruning_out")
+    parser.add_argument("--rows", type=int, nargs="+",
+                        help="only prune these samples (rows of the counts, from 1)")
+    profiling.add_arguments(parser)
     args     = parser.parse_args()
+    profiling.enable_from_args(args)
     taxa     = args.taxa
     #out_file = args.out_file
-    exempt_file = open("../files/not_found.txt", "r")
-    counts_file = open("../files/otu_counts.txt", "r")
-    taxa_file   = open(taxa, "r")
+    exempt_file = open_input(args.exempt)
+    counts_file = open_input(args.counts)
+    taxa_file   = open_input(taxa)
 
     taxa_list = []
     exempt = {}
@@ -39,16 +48,20 @@ if __name__ == "__main__":
     for line in taxa_file:
         taxa_list.append(line) 
 
-    counts_lines = counts_file.readlines()
-    IDs          = counts_lines[0].split()
-    counts_size  = len(counts_lines)
+    #the samples are pruned as their rows are read
+    IDs  = counts_file.readline().split()
+    rows = None
+    if args.rows != None:
+        rows = set(args.rows)
 
-    for c_idx in range(1, counts_size):    
+    for c_idx, counts_line in enumerate(counts_file, 1):
+        if rows != None and c_idx not in rows:
+            continue
         taxa_count = {}    
-        counts_data  = counts_lines[c_idx].split()
+        counts_data  = counts_line.split()
         size         = len(counts_data)
         #this out_file path used to be "out_files/out_" + c_idx
-        out_file     = "pruning_out/sample_" + str(c_idx)
+        out_file     = args.out_dir + "/sample_" + str(c_idx)
         out          = open(out_file, "w+")
 
         for i in range(1, size):
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+'''
+Render figures of a tree without a window.
+
+A GL context is created offscreen, through EGL (which needs no
+display, and falls back to Mesa's software renderer on machines
+without a gpu) or OSMesa, and a TreeViewer draws into a framebuffer
+object. The scene is uploaded once; for every frame only the sample
+window and the view change. Each frame is written as a PNG, and the
+throughput is reported in frames/second.
+
+Frames are given as a list of first samples and a list of x, y, z
+view angles (every angle is rendered for every sample window), or
+as a json file holding a list of views:
+
+    [{"sample" : 0, "x" : 60, "y" : 20, "z" : 0, "zoom" : 100}, ...]
+
+Ex:
+    python render.py ../trees/full_tree ../data/condensed_counts.txt 10 \
+        --out-dir figures --samples 0 10 20 --angles 0,0,0 60,20,0
+'''
+import argparse
+import ctypes
+import json
+import os
+import profiling
+import struct
+import sys
+import time
+import zlib
+
+#PyOpenGL picks its platform when it is first imported, so
+#the viewer (and OpenGL) are only imported once it is chosen.
+PLATFORMS = ['egl', 'osmesa']
+
+#EGL_PLATFORM_SURFACELESS_MESA
+EGL_PLATFORM_SURFACELESS = 0x31DD
+
+
+@profiling.profiled()
+def write_png(path, pixels):
+    '''
+    Write rows x columns x 3 uint8 pixels (top row first)
+    as an RGB PNG.
+    '''
+    height, width = pixels.shape[:2]
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    #every row starts with its filter type (0, none)
+    rows = b''.join([b'\x00' + pixels[r].tobytes() for r in range(height)])
+    out_f = open(path, 'wb')
+    out_f.write(b'\x89PNG\r\n\x1a\n')
+    out_f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    out_f.write(chunk(b'IDAT', zlib.compress(rows, 6)))
+    out_f.write(chunk(b'IEND', b''))
+    out_f.close()
+
+
+def create_egl_context():
+    '''
+    Create an EGL context without a surface. Mesa's surfaceless
+    platform is tried first, then the default display.
+    '''
+    from OpenGL import EGL
+    display = EGL.EGL_NO_DISPLAY
+    try:
+        from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+        display = eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS, None, None)
+    except Exception:
+        display = EGL.EGL_NO_DISPLAY
+    if not display or not EGL.eglInitialize(display, None, None):
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        if not EGL.eglInitialize(display, None, None):
+            print('ERROR: unable to initialize an EGL display')
+            return None
+
+    attribs = (EGL.EGLint*3)(EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+    config  = EGL.EGLConfig()
+    count   = EGL.EGLint()
+    #without a surface, no config is needed (EGL_KHR_no_config_context),
+    #and the surfaceless platform may not offer one
+    EGL.eglChooseConfig(display, attribs, ctypes.pointer(config), 1, ctypes.pointer(count))
+    if count.value == 0:
+        config = EGL.EGLConfig()
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    if context == EGL.EGL_NO_CONTEXT or not EGL.eglMakeCurrent(display,
+            EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+        print('ERROR: unable to create an EGL context')
+        return None
+    return (display, context)
+
+
+def create_osmesa_context(width, height):
+    '''
+    Create an OSMesa software rendering context.
+    '''
+    from OpenGL import osmesa
+    from OpenGL.GL import GL_UNSIGNED_BYTE
+    import numpy
+    context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+    if not context:
+        print('ERROR: unable to create an OSMesa context')
+        return None
+    buf = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    if not osmesa.OSMesaMakeCurrent(context, buf, GL_UNSIGNED_BYTE, width, height):
+        print('ERROR: unable to make the OSMesa context current')
+        return None
+    return (context, buf)
+
+
+class OffscreenRenderer():
+    '''
+    Render a scene through a TreeViewer into a framebuffer
+    object, one view at a time.
+    '''
+
+    def __init__(self, viewer, width, height):
+        from OpenGL import GL
+        self.GL     = GL
+        self.viewer = viewer
+        self.width  = width
+        self.height = height
+
+        self.fbo = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.fbo)
+        color, depth = GL.glGenRenderbuffers(2)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, color)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_RGBA8, width, height)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0,
+                                     GL.GL_RENDERBUFFER, color)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, depth)
+        GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_DEPTH_COMPONENT24, width, height)
+        GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT,
+                                     GL.GL_RENDERBUFFER, depth)
+        if (GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER)
+                != GL.GL_FRAMEBUFFER_COMPLETE):
+            print('ERROR: the offscreen framebuffer is incomplete')
+
+        viewer.init_gl(width, height)
+        GL.glPushMatrix()
+
+    @profiling.profiled()
+    def render(self, view):
+        '''
+        Render a view (a dictionary with any of sample, x, y, z
+        and zoom) and get its pixels, top row first.
+        '''
+        import numpy
+        GL = self.GL
+        self.viewer.set_first_sample(view.get('sample', 0))
+        self.viewer.x_deg    = view.get('x', 0)
+        self.viewer.y_deg    = view.get('y', 0)
+        self.viewer.z_deg    = view.get('z', 0)
+        self.viewer.zoom_val = view.get('zoom', 0)
+        self.viewer.render()
+
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        data = GL.glReadPixels(0, 0, self.width, self.height, GL.GL_RGB,
+                               GL.GL_UNSIGNED_BYTE)
+        pixels = numpy.frombuffer(data, dtype=numpy.uint8)
+        return pixels.reshape((self.height, self.width, 3))[::-1]
+
+
+def parse_views(args):
+    '''
+    Get the list of views to render from the command line.
+    '''
+    if args.views != None:
+        views_f = open(args.views, 'r')
+        views   = json.load(views_f)
+        views_f.close()
+        return views
+
+    views = []
+    for sample in args.samples:
+        for angle in args.angles:
+            x, y, z = [float(a) for a in angle.split(',')]
+            views.append({'sample' : sample, 'x' : x, 'y' : y, 'z' : z,
+                          'zoom' : args.zoom})
+    return views
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('newick_file', type=str, nargs='?')
+    parser.add_argument('condensed_counts_file', type=str, nargs='?')
+    parser.add_argument('layer_count', type=int, help="the number of samples to display",
+                         nargs='?', default=30)
+    parser.add_argument('--out-dir', type=str, default='.',
+                        help="the directory to write the PNGs to")
+    parser.add_argument('--scene', type=str, help="a precomputed scene file (see scene.py)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used to build the inner node discs")
+    parser.add_argument('--samples', type=int, nargs='+', default=[0],
+                        help="the first sample of every sample window to render")
+    parser.add_argument('--angles', type=str, nargs='+', default=['0,0,0'],
+                        help="x,y,z rotations (degrees) to render every window from")
+    parser.add_argument('--zoom', type=int, default=0)
+    parser.add_argument('--views', type=str,
+                        help="a json file with a list of views, used in place of "
+                             "--samples, --angles and --zoom")
+    parser.add_argument('--size', type=int, nargs=2, default=[1000, 1000],
+                        metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--platform', type=str, choices=PLATFORMS, default='egl',
+                        help="create the GL context through EGL or OSMesa")
+    parser.add_argument('--prefix', type=str, default='frame')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    os.environ['PYOPENGL_PLATFORM'] = args.platform
+    from phylo_viewer import TreeViewer, MAX_LAYERS
+    from scene import SceneBuilder, load_scene
+    from newick_tree import NewickTree
+    from counts_map import CountsMap
+    from input_files import read_newick
+
+    if args.scene != None:
+        scene = load_scene(args.scene)
+        if scene == None:
+            sys.exit(1)
+    else:
+        if args.newick_file == None or args.condensed_counts_file == None:
+            parser.error('a newick file and a counts file are required without --scene')
+        layers   = (args.layer_count if args.layer_count <= MAX_LAYERS
+                    and args.layer_count > 0 else MAX_LAYERS)
+        c_map    = CountsMap(args.condensed_counts_file)
+        tree     = NewickTree(read_newick(args.newick_file), c_map)
+        scene    = SceneBuilder(tree, layers, args.workers).build()
+
+    width, height = args.size
+    if args.platform == 'egl':
+        context = create_egl_context()
+    else:
+        context = create_osmesa_context(width, height)
+    if context == None:
+        sys.exit(1)
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    views    = parse_views(args)
+    renderer = OffscreenRenderer(TreeViewer(scene), width, height)
+
+    from OpenGL.GL import glFinish
+    render_time = 0.0
+    start       = time.time()
+    for i, view in enumerate(views):
+        frame_start = time.time()
+        pixels      = renderer.render(view)
+        glFinish()
+        render_time += time.time() - frame_start
+
+        path = os.path.join(args.out_dir, '%s_%04d.png' % (args.prefix, i))
+        write_png(path, pixels)
+        print('%s: sample %d, rotation %g, %g, %g, zoom %g' % (path, view.get('sample', 0),
+              view.get('x', 0), view.get('y', 0), view.get('z', 0), view.get('zoom', 0)))
+    total = time.time() - start
+
+    if len(views) > 0:
+        print('rendered %d frames in %.3f s (%.2f frames/sec, %.2f frames/sec '
+              'including PNG output)' % (len(views), total,
+              len(views)/max(render_time, 1e-9), len(views)/max(total, 1e-9)))
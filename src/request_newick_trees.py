@@ -9,6 +9,7 @@ import mechanize
 import cookielib
 import argparse
 import glob
+import profiling
 
 
 if __name__ == "__main__":
@@ -17,7 +18,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('input_dir')
     parser.add_argument('out_path')
+    profiling.add_arguments(parser)
     args     = parser.parse_args()
+    profiling.enable_from_args(args)
     out_path = args.out_path
     in_path  = args.input_dir
     
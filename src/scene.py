@@ -0,0 +1,876 @@
+#!/usr/bin/python
+'''
+A GL-free scene builder for the TreeViewer.
+
+The geometry that makes up the structure of a cylinder of trees
+(inner nodes, branches, plates and rims) is built here as a set
+of named numpy buffers. The leaves are kept apart in a small
+AbundanceTable of positions, colors and per-sample counts, which
+the viewer turns into leaf discs and cylinders on the gpu.
+Nothing in this module touches OpenGL or GLUT, so scenes can be
+built on machines without a display and saved to a single binary
+scene file. The viewer then memory-maps the file and uploads
+the buffers as they are.
+
+Scene file layout:
+    magic (8 bytes) | version (uint32) | header length (uint32)
+    json header (padded) | section arrays (each 64 byte aligned)
+
+The json header records the scene info and, for every section,
+its draw mode along with the dtype, shape and file offset of
+each of its arrays. The arrays of the abundance and node tables
+are recorded the same way, along with the node names.
+
+Vertices are stored interleaved as float32 x, y, z followed by
+a uint8 rgba color (16 bytes per vertex), which is also the
+layout of the viewer's vertex buffer.
+'''
+from counts_map import CountsMap
+from newick_tree import NewickTree
+from colormap import leaf_colors
+from input_files import read_newick
+from collections import OrderedDict
+import argparse
+import json
+import math
+import mmap
+import multiprocessing
+import profiling
+import struct
+import numpy
+
+try:
+    FORK = multiprocessing.get_context('fork')
+except ValueError:
+    #no fork (windows); scenes are always built serially
+    FORK = None
+
+#the vertex arena being filled, which forked workers
+#inherit along with its shared mapping (see fill_worker)
+BUILD_ARENA = None
+
+SPACING       = 3
+SCENE_MAGIC   = b'PHYLOSCN'
+SCENE_VERSION = 4
+ALIGNMENT     = 64
+
+#The order in which the sections are laid out
+#in the vertex buffer and drawn.
+SECTION_ORDER = ['nodes', 'discs', 'branches', 'cylinders', 'plates', 'rims']
+
+#The draw mode of each section. These are names rather than
+#GL enums so that this module stays free of OpenGL.
+SECTION_MODES = {'nodes'     : 'triangle_fan',
+                 'discs'     : 'triangle_fan',
+                 'branches'  : 'lines',
+                 'cylinders' : 'triangle_strip',
+                 'plates'    : 'triangle_fan',
+                 'rims'      : 'line_loop'}
+
+#The sections that the viewer draws from a scene's
+#AbundanceTable rather than from its vertex buffer.
+LEAF_SECTIONS = ['discs', 'cylinders']
+
+VERTEX_DTYPE = numpy.dtype([('position', numpy.float32, (3,)),
+                          ('color', numpy.uint8, (4,))])
+COLOR_OFFSET = VERTEX_DTYPE.fields['color'][1]
+
+LEAF_SCALE     = 20
+NODE_RADIUS    = .001
+BRANCH_OFFSET  = .2
+NODE_COLOR     = [0.4, 0.2, 0.2, 1.0]
+BRANCH_COLOR   = [1.0, 0.9, 0.41, 1.0]
+PLATE_COLOR    = [0.86, 0.92, 0.95, 1.0]
+RIM_COLOR      = [0.0, 0.0, 0.0, 1.0]
+
+CIRCLE_ANGLES   = numpy.arange(360)*(math.pi/180.0)
+CYLINDER_ANGLES = numpy.arange(361)*(math.pi/180.0)
+CIRCLE_COS      = numpy.cos(CIRCLE_ANGLES)
+CIRCLE_SIN      = numpy.sin(CIRCLE_ANGLES)
+CYLINDER_COS    = numpy.cos(CYLINDER_ANGLES)
+CYLINDER_SIN    = numpy.sin(CYLINDER_ANGLES)
+
+#vertices per primitive and planned parameters per primitive
+#for the sections that are built from a plan
+PRIMITIVE_SIZES  = {'nodes' : 360, 'discs' : 360, 'cylinders' : 722}
+PRIMITIVE_PARAMS = {'nodes' : 4, 'discs' : 4, 'cylinders' : 6}
+
+#leaf tubes: the points in a ring, the indices of the strip
+#between two rings (ending in a restart), and the restart index
+TUBE_RING     = len(CYLINDER_ANGLES)
+TUBE_STRIP    = 2*TUBE_RING + 1
+RESTART_INDEX = 0xFFFFFFFF
+
+#the number of primitives filled at a time (bounds the
+#size of the temporary arrays), and the number of work
+#ranges handed to each worker process
+FILL_CHUNK        = 4096
+CHUNKS_PER_WORKER = 4
+
+
+class SceneSection():
+    '''
+    A single category of geometry. Every vertex is an x, y, z
+    position with an rgba color (see VERTEX_DTYPE). The section is
+    made up of primitives that all share the same draw mode, and
+    the primitive at index i covers counts[i] vertices starting
+    at firsts[i].
+    '''
+
+    def __init__(self, name, mode, vertices, firsts, counts):
+        self.name     = name
+        self.mode     = mode
+        self.vertices = vertices
+        self.firsts   = firsts
+        self.counts   = counts
+
+    def get_name(self):
+        return self.name
+
+    def get_mode(self):
+        return self.mode
+
+    def get_vertices(self):
+        return self.vertices
+
+    def get_positions(self):
+        return self.vertices['position']
+
+    def get_colors(self):
+        return self.vertices['color']
+
+    def get_firsts(self):
+        return self.firsts
+
+    def get_counts(self):
+        return self.counts
+
+    def get_vertex_count(self):
+        return len(self.vertices)
+
+    def get_primitive_count(self):
+        return len(self.counts)
+
+    def get_arrays(self):
+        return {'vertices' : self.vertices,
+                'firsts'   : self.firsts,
+                'counts'   : self.counts}
+
+
+class AbundanceTable():
+    '''
+    The position and color of every leaf along with its
+    abundance in every sample (leaves x samples). The viewer
+    draws the leaf discs and cylinders from this table, so only
+    the radii of the samples on display need to be sent to the
+    gpu when the samples or their scale change.
+    '''
+
+    def __init__(self, leaf_xy, leaf_colors, counts, leaf_nodes):
+        self.leaf_xy     = leaf_xy
+        self.leaf_colors = leaf_colors
+        self.counts      = counts
+        self.leaf_nodes  = leaf_nodes
+
+    def get_leaf_xy(self):
+        return self.leaf_xy
+
+    def get_leaf_colors(self):
+        return self.leaf_colors
+
+    def get_counts(self):
+        return self.counts
+
+    def get_leaf_nodes(self):
+        '''
+        Get the index (into the tree's nodes) of the
+        leaf in every row of the table.
+        '''
+        return self.leaf_nodes
+
+    def get_num_leaves(self):
+        return len(self.leaf_xy)
+
+    def get_sample_count(self):
+        return self.counts.shape[1]
+
+    def get_radii(self, first, layers):
+        '''
+        Get the unscaled radii of the leaves for the samples
+        first to first + layers, laid out layer by layer
+        (layers x leaves). Samples past the end are empty.
+        '''
+        radii = numpy.zeros((layers, self.get_num_leaves()), dtype=numpy.float32)
+        last  = min(first + layers, self.get_sample_count())
+        if last > first:
+            radii[:last - first] = self.counts[:, first:last].T
+        return radii
+
+    def get_arrays(self):
+        return {'leaf_xy'     : self.leaf_xy,
+                'leaf_colors' : self.leaf_colors,
+                'counts'      : self.counts,
+                'leaf_nodes'  : self.leaf_nodes}
+
+
+class NodeTable():
+    '''
+    The position, parent and name of every node in the tree,
+    in the tree's node order. The root's parent is -1.
+    '''
+
+    def __init__(self, xy, parents, names):
+        self.xy      = xy
+        self.parents = parents
+        self.names   = names
+
+    def get_xy(self):
+        return self.xy
+
+    def get_parents(self):
+        return self.parents
+
+    def get_names(self):
+        return self.names
+
+    def get_node_count(self):
+        return len(self.xy)
+
+    def get_arrays(self):
+        return {'xy'      : self.xy,
+                'parents' : self.parents}
+
+
+class Scene():
+    '''
+    A collection of named scene sections along with
+    the information the viewer needs to frame them
+    (layer count, number of leaves, radius, ...). Scenes
+    built by the SceneBuilder also carry an AbundanceTable
+    and a NodeTable.
+    '''
+
+    def __init__(self, sections, info, abundance=None, node_table=None):
+        self.sections = {}
+        for section in sections:
+            self.sections[section.get_name()] = section
+        self.info       = info
+        self.abundance  = abundance
+        self.node_table = node_table
+
+    def get_info(self):
+        return self.info
+
+    def get_abundance(self):
+        return self.abundance
+
+    def get_node_table(self):
+        return self.node_table
+
+    def get_section(self, name):
+        if name in self.sections:
+            return self.sections[name]
+        return None
+
+    def get_sections(self):
+        '''
+        Get the sections in drawing order.
+        '''
+        return [self.sections[name] for name in SECTION_ORDER
+                if name in self.sections]
+
+    def get_vertex_count(self):
+        return sum([s.get_vertex_count() for s in self.get_sections()])
+
+    def get_nbytes(self):
+        return sum([s.get_vertices().nbytes for s in self.get_sections()])
+
+
+class SceneBuilder():
+    '''
+    Build the scene for a NewickTree with a given number of
+    layers (samples). The tree structure (inner nodes, branches,
+    plates and rims) is built as static geometry. The leaves are
+    described by an AbundanceTable instead, so that the samples
+    shown and their scale can change without rebuilding anything.
+    The branches are the same on every layer, so only one layer of
+    them is built. That leaves the inner node discs (a disc for
+    every inner node on every layer) as the only geometry that
+    grows with both the tree and the layer count, and the only
+    section that can be split between several worker processes;
+    the other sections are small and always built in this one.
+    '''
+    #the branches are one layer, for the viewer to instance
+    instanced_branches = True
+
+    def __init__(self, tree, layers, workers=1):
+        self.layer_count = layers
+        self.workers     = workers
+        self.num_leaves  = tree.get_num_leaves()
+        self.nodes       = tree.get_nodes()
+        self.edges       = tree.get_edges()
+        self.radius      = tree.get_radius()
+        self.start_z     = -1*SPACING*(self.layer_count//2)
+
+    @profiling.profiled()
+    def build(self):
+        '''
+        Build the static sections and the abundance table
+        of the scene, and return the resulting Scene. The
+        sections are counted first, and then filled in place
+        in one arena of vertices allocated up front.
+        '''
+        with profiling.span('count_sections'):
+            sizes = self.count_sections()
+        shared = self.workers > 1 and FORK != None
+        if self.workers > 1 and not shared:
+            print('WARNING: processes can\'t be forked; building the scene serially')
+        arena  = allocate_arena(sum([c*s for c, s in sizes.values()]), shared)
+        views  = {}
+        start  = 0
+        for name, (count, size) in sizes.items():
+            views[name] = arena[start:start + count*size]
+            start += count*size
+
+        builders = [('nodes', self.build_nodes), ('branches', self.build_branches),
+                    ('plates', self.build_plates), ('rims', self.build_rims)]
+        sections = []
+        for name, build_section in builders:
+            with profiling.span('build_' + name, vertices=len(views[name])):
+                sections.append(build_section(views[name]))
+        info = {'layer_count'  : self.layer_count,
+                'num_leaves'   : self.num_leaves,
+                'radius'       : self.radius,
+                'start_z'      : self.start_z,
+                'spacing'      : SPACING,
+                'first_sample' : 0,
+                'scale'        : LEAF_SCALE}
+        if self.instanced_branches:
+            info['instanced_branches'] = True
+        with profiling.span('build_abundance'):
+            abundance = self.build_abundance()
+        with profiling.span('build_node_table'):
+            node_table = self.build_node_table()
+        return Scene(sections, info, abundance, node_table)
+
+    def count_sections(self):
+        '''
+        Count the primitives of every static section (without
+        building anything), and get the primitive count and size
+        of each section in drawing order.
+        '''
+        counts = {'nodes'    : (self.count_nodes(), PRIMITIVE_SIZES['nodes']),
+                  'branches' : (self.count_branches(), 2),
+                  'plates'   : (self.count_plates(), 360),
+                  'rims'     : (self.count_rims(), 360)}
+        return OrderedDict([(name, counts[name]) for name in SECTION_ORDER
+                            if name in counts])
+
+    def frame_layers(self):
+        '''
+        Get the z of the first and last layers, which
+        hold the plates.
+        '''
+        layer_z = [self.start_z]
+        if self.layer_count > 1:
+            layer_z.append(self.start_z + (self.layer_count - 1)*SPACING)
+        return layer_z
+
+    def count_nodes(self):
+        return len([n for n in self.nodes if not n.is_leaf()])*self.layer_count
+
+    def count_branches(self):
+        return len(self.edges)*2
+
+    def count_plates(self):
+        return len(self.frame_layers())
+
+    def count_rims(self):
+        return self.layer_count
+
+    def plan_nodes(self):
+        '''
+        Work out the small disc that marks every inner node on
+        every layer without creating any vertices. A disc is
+        planned as x, y, z, radius. Each planned disc also records
+        its color and the index of the node it belongs to.
+        '''
+        inner  = numpy.array([i for i, n in enumerate(self.nodes) if not n.is_leaf()],
+                             dtype=numpy.int32)
+        xy     = numpy.array([self.nodes[i].get_coords()[:2] for i in inner],
+                             dtype=numpy.float64).reshape((-1, 2))
+        params = numpy.empty((len(inner), self.layer_count, PRIMITIVE_PARAMS['nodes']))
+        params[:, :, 0:2] = xy[:, None, :]
+        params[:, :, 2]   = self.start_z + SPACING*numpy.arange(self.layer_count)
+        params[:, :, 3]   = NODE_RADIUS
+        count  = len(inner)*self.layer_count
+        return (params.reshape((count, PRIMITIVE_PARAMS['nodes'])),
+                numpy.repeat(to_rgba8(NODE_COLOR), count, axis=0),
+                numpy.repeat(inner, self.layer_count))
+
+    def build_nodes(self, out=None):
+        '''
+        Build the inner node discs. With more than one worker,
+        the geometry is filled in by a pool of forked processes
+        that write straight into the (shared) arena.
+        '''
+        params, colors, owners = self.plan_nodes()
+        vertices = section_vertices(out, len(params)*PRIMITIVE_SIZES['nodes'])
+        if self.workers <= 1 or FORK == None or len(params) == 0:
+            fill_vertices('nodes', params, colors, vertices)
+        else:
+            fill_forked('nodes', params, colors, owners, vertices, self.workers)
+        return arena_section('nodes', vertices, PRIMITIVE_SIZES['nodes'])
+
+    def build_abundance(self):
+        '''
+        Build the AbundanceTable for the leaves. Leaves are colored
+        by their node order, and are kept in order of their angle
+        around the tree (the order in which postorder_circle places
+        them) so that an angular sector is a run of leaves.
+        '''
+        leaf_nodes = numpy.array([i for i, n in enumerate(self.nodes) if n.is_leaf()],
+                                 dtype=numpy.int32)
+        leaves     = [self.nodes[i] for i in leaf_nodes]
+        if len(leaves) > 0:
+            samples = min([len(n.get_counts_list()) for n in leaves])
+        else:
+            samples = 0
+
+        leaf_xy = numpy.array([n.get_coords()[:2] for n in leaves],
+                              dtype=numpy.float32).reshape((-1, 2))
+        colors  = leaf_colors(len(leaves), self.num_leaves)
+        counts  = numpy.array([n.get_counts_list()[:samples] for n in leaves],
+                              dtype=numpy.float32).reshape((-1, samples))
+        order   = numpy.argsort(angles(leaf_xy[:, 0], leaf_xy[:, 1]), kind='mergesort')
+        return AbundanceTable(leaf_xy[order], colors[order], counts[order],
+                              leaf_nodes[order])
+
+    def build_node_table(self):
+        '''
+        Build the NodeTable of the tree.
+        '''
+        index = {}
+        for i, node in enumerate(self.nodes):
+            index[id(node)] = i
+        xy      = numpy.array([n.get_coords()[:2] for n in self.nodes],
+                              dtype=numpy.float32).reshape((-1, 2))
+        parents = numpy.array([index.get(id(n.get_parent()), -1) for n in self.nodes],
+                              dtype=numpy.int32)
+        return NodeTable(xy, parents, [n.get_name() for n in self.nodes])
+
+    def build_branches(self, out=None):
+        '''
+        Build the tree branches of the first layer only. The
+        viewer instances them onto the other layers it draws
+        them on (the last one, or every one). Every edge is drawn
+        as a pair of lines slightly above and below its layer.
+        '''
+        vertices = section_vertices(out, self.count_branches()*2)
+        points   = vertices['position'].reshape((len(self.edges), 2, 2, 3))
+        points[:, :, :, 0:2] = edge_ends(self.edges)[:, None, :, :]
+        points[:, 0, :, 2]   = self.start_z + BRANCH_OFFSET
+        points[:, 1, :, 2]   = self.start_z - BRANCH_OFFSET
+        vertices['color'] = to_rgba8(BRANCH_COLOR)[0]
+        return arena_section('branches', vertices, 2)
+
+    def build_plates(self, out=None):
+        '''
+        Build the plates that sit beneath the first
+        and last layers.
+        '''
+        layer_z  = self.frame_layers()
+        vertices = section_vertices(out, len(layer_z)*360)
+        fill_circles(numpy.array([[0, 0, z, self.radius-.1] for z in layer_z]).reshape((-1, 4)),
+                     vertices['position'])
+        vertices['color'] = to_rgba8(PLATE_COLOR)[0]
+        return arena_section('plates', vertices, 360)
+
+    def build_rims(self, out=None):
+        '''
+        Build the rims that outline every layer.
+        '''
+        vertices = section_vertices(out, self.layer_count*360)
+        fill_circles(numpy.array([[0, 0, self.start_z + i*SPACING, self.radius]
+                                  for i in range(self.layer_count)]).reshape((-1, 4)),
+                     vertices['position'])
+        vertices['color'] = to_rgba8(RIM_COLOR)[0]
+        return arena_section('rims', vertices, 360)
+
+
+def angles(x, y):
+    '''
+    The angles of points around the center of the tree,
+    from 0 up to 2 pi.
+    '''
+    return numpy.arctan2(y, x) % (2.0*math.pi)
+
+
+def fill_circles(params, positions):
+    '''
+    Fill positions with one 360 point circle for every
+    x, y, z, radius row of params.
+    '''
+    points = positions.reshape((len(params), 360, 3))
+    for s in range(0, len(params), FILL_CHUNK):
+        p   = params[s:s+FILL_CHUNK]
+        out = points[s:s+FILL_CHUNK]
+        out[:, :, 0] = p[:, 0:1] + CIRCLE_COS*p[:, 3:4]
+        out[:, :, 1] = p[:, 1:2] + CIRCLE_SIN*p[:, 3:4]
+        out[:, :, 2] = p[:, 2:3]
+
+
+def fill_cylinders(params, positions):
+    '''
+    Fill positions with one 722 point triangle strip for every
+    x, y, z, top radius, bottom radius, height row of params.
+    '''
+    points = positions.reshape((len(params), 361, 2, 3))
+    for s in range(0, len(params), FILL_CHUNK):
+        p   = params[s:s+FILL_CHUNK]
+        out = points[s:s+FILL_CHUNK]
+        out[:, :, 0, 0] = p[:, 0:1] + CYLINDER_COS*p[:, 3:4]
+        out[:, :, 0, 1] = p[:, 1:2] + CYLINDER_SIN*p[:, 3:4]
+        out[:, :, 0, 2] = p[:, 2:3]
+        out[:, :, 1, 0] = p[:, 0:1] + CYLINDER_COS*p[:, 4:5]
+        out[:, :, 1, 1] = p[:, 1:2] + CYLINDER_SIN*p[:, 4:5]
+        out[:, :, 1, 2] = p[:, 2:3] + p[:, 5:6]
+
+
+FILLERS = {'nodes'     : fill_circles,
+           'discs'     : fill_circles,
+           'cylinders' : fill_cylinders}
+
+
+def leaf_meshes(layer_count):
+    '''
+    Create a unit disc and a unit tube, which the viewer instances
+    for the leaves. Each vertex is a cos, sin, ring triple. The disc
+    is a single ring; the tube is a ring of TUBE_RING points for every
+    layer, so the layers of a tube share their rings.
+    '''
+    disc = numpy.empty((PRIMITIVE_SIZES['discs'], 3), dtype=numpy.float32)
+    fill_circles(numpy.array([[0, 0, 0, 1]], dtype=numpy.float64), disc)
+
+    rings = max(layer_count, 2)
+    tube  = numpy.empty((rings, TUBE_RING, 3), dtype=numpy.float32)
+    tube[:, :, 0] = CYLINDER_COS
+    tube[:, :, 1] = CYLINDER_SIN
+    tube[:, :, 2] = numpy.arange(rings)[:, None]
+    return {'discs' : disc, 'cylinders' : tube.reshape((-1, 3))}
+
+
+def tube_indices(layer_count):
+    '''
+    Get the indices of the unit tube's triangle strip. Each pair of
+    neighboring rings is a strip of 2*TUBE_RING indices followed by
+    the restart index, so a tube over n layers is drawn with the
+    first (n - 1)*TUBE_STRIP - 1 indices.
+    '''
+    rings = max(layer_count, 2)
+    ring  = numpy.arange(rings - 1)[:, None]*TUBE_RING + numpy.arange(TUBE_RING)
+    strip = numpy.empty((rings - 1, TUBE_STRIP), dtype=numpy.uint32)
+    strip[:, 0:-1:2] = ring
+    strip[:, 1:-1:2] = ring + TUBE_RING
+    strip[:, -1]     = RESTART_INDEX
+    return strip.ravel()
+
+
+def tube_runs(radii):
+    '''
+    Find the runs of consecutive layers that leaves are present in,
+    for radii (layers x leaves). Every run of two or more layers is
+    drawn as a single tube. Get the leaf, first layer and length of
+    every run, sorted by length and then by leaf and first layer.
+    Layers past either end of radii are empty.
+    '''
+    layers, leaves = radii.shape
+    present = numpy.zeros((leaves, layers + 2), dtype=numpy.int8)
+    present[:, 1:-1] = (radii > 0).T
+
+    #the runs start and end (exclusive) at the steps
+    #up and down, one pair of steps per run
+    steps       = numpy.diff(present, axis=1)
+    leaf, first = numpy.nonzero(steps == 1)
+    last        = numpy.nonzero(steps == -1)[1]
+    length      = last - first
+    runs        = length >= 2
+    leaf, first, length = leaf[runs], first[runs], length[runs]
+
+    order = numpy.argsort(length, kind='mergesort')
+    return (leaf[order].astype(numpy.int32), first[order].astype(numpy.int32),
+            length[order].astype(numpy.int32))
+
+
+def to_rgba8(colors):
+    '''
+    Convert float rgba colors in [0, 1] to normalized uint8.
+    '''
+    colors = numpy.array(colors, dtype=numpy.float64).reshape((-1, 4))
+    return numpy.round(numpy.clip(colors, 0.0, 1.0)*255.0).astype(numpy.uint8)
+
+
+def fill_vertices(name, params, colors, vertices):
+    '''
+    Fill the interleaved vertices of planned discs or cylinders,
+    repeating each primitive's uint8 color over its vertices.
+    '''
+    size = PRIMITIVE_SIZES[name]
+    FILLERS[name](params, vertices['position'])
+    vertices['color'].reshape((len(colors), size, 4))[:] = colors[:, None, :]
+
+
+def partition(owners, parts):
+    '''
+    Split the planned primitives into at most parts contiguous
+    ranges of about the same length. The primitives that belong
+    to a single node are never split between two ranges.
+    '''
+    total  = len(owners)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(owners)) + 1, [total]))
+    goals  = numpy.linspace(0, total, parts + 1)[1:-1]
+    cuts   = starts[numpy.searchsorted(starts, goals)]
+    cuts   = numpy.unique(numpy.concatenate(([0], cuts, [total])))
+    return [(int(cuts[i]), int(cuts[i+1])) for i in range(len(cuts) - 1)]
+
+
+@profiling.profiled()
+def allocate_arena(vertex_count, shared=False):
+    '''
+    Allocate the vertices of a whole scene at once. A shared arena
+    lives in an anonymous shared mapping, which worker processes
+    forked after it was allocated write into directly.
+    '''
+    if not shared:
+        return numpy.empty(vertex_count, dtype=VERTEX_DTYPE)
+    block = mmap.mmap(-1, max(vertex_count*VERTEX_DTYPE.itemsize, 1))
+    return numpy.frombuffer(block, dtype=VERTEX_DTYPE, count=vertex_count)
+
+
+def section_vertices(out, vertex_count):
+    '''
+    Get the vertices a section is filled in: its part of a
+    scene's arena, or a new array when it's built on its own.
+    '''
+    if out is None:
+        return numpy.empty(vertex_count, dtype=VERTEX_DTYPE)
+    if len(out) != vertex_count:
+        raise ValueError('section of %d vertices counted as %d' % (vertex_count, len(out)))
+    return out
+
+
+def arena_section(name, vertices, size):
+    '''
+    Create a SceneSection over filled vertices, where every
+    primitive has size vertices.
+    '''
+    firsts, counts = primitive_ranges(len(vertices)//size, size)
+    return SceneSection(name, SECTION_MODES[name], vertices, firsts, counts)
+
+
+def edge_ends(edges):
+    '''
+    Get the x, y of the parent and child ends of
+    every edge (edges x 2 x 2).
+    '''
+    ends = numpy.empty((len(edges), 2, 2))
+    for j, e in enumerate(edges):
+        ends[j, 0] = e.get_parent_coords()[:2]
+        ends[j, 1] = e.get_child_coords()[:2]
+    return ends
+
+
+def fill_worker(task):
+    '''
+    Fill one range of planned primitives in a forked worker,
+    straight into the arena it inherited.
+    '''
+    name, params, colors, start = task
+    size = PRIMITIVE_SIZES[name]
+    end  = start + len(params)
+    fill_vertices(name, params, colors, BUILD_ARENA[start*size:end*size])
+    return end - start
+
+
+def fill_forked(name, params, colors, owners, vertices, workers):
+    '''
+    Fill planned discs or cylinders into vertices (a part of a
+    shared arena) with a pool of forked worker processes. Every
+    primitive has a fixed size, so its offset is known ahead of
+    time, and each worker fills its own range in place.
+    '''
+    global BUILD_ARENA
+    BUILD_ARENA = vertices
+    pool = FORK.Pool(workers)
+    try:
+        tasks = [(name, params[a:b], colors[a:b], a)
+                 for a, b in partition(owners, workers*CHUNKS_PER_WORKER)]
+        pool.map(fill_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+        BUILD_ARENA = None
+
+
+def primitive_ranges(count, size):
+    firsts = numpy.arange(count, dtype=numpy.int32)*size
+    counts = numpy.full(count, size, dtype=numpy.int32)
+    return firsts, counts
+
+
+def dtype_to_json(dtype):
+    '''
+    Describe a (possibly structured) dtype in a json friendly way.
+    '''
+    if dtype.names == None:
+        return dtype.str
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)]
+            for name in dtype.names]
+
+
+def dtype_from_json(desc):
+    if isinstance(desc, list):
+        return numpy.dtype([(name, base, tuple(shape)) for name, base, shape in desc])
+    return numpy.dtype(desc)
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1)//ALIGNMENT*ALIGNMENT
+
+
+@profiling.profiled()
+def save_scene(scene, path):
+    '''
+    Write a scene to a single binary scene file.
+    '''
+    out_f = open(path, 'wb')
+    write_scene(scene, out_f)
+    out_f.close()
+
+
+def write_scene(scene, out_f):
+    '''
+    Write a scene in the scene file layout to a seekable file
+    object, and get its json header along with the offset of
+    the arrays (the header's offsets are relative to it).
+    '''
+    header   = {'info' : scene.get_info(), 'sections' : []}
+    arrays   = []
+
+    def add_arrays(named):
+        descs = {}
+        for key, arr in sorted(named.items()):
+            arr = numpy.ascontiguousarray(arr)
+            if len(arrays) > 0:
+                offset = align(arrays[-1][0] + arrays[-1][1].nbytes)
+            else:
+                offset = 0
+            descs[key] = {'dtype'  : dtype_to_json(arr.dtype),
+                          'shape'  : list(arr.shape),
+                          'offset' : offset}
+            arrays.append((offset, arr))
+        return descs
+
+    for section in scene.get_sections():
+        header['sections'].append({'name'   : section.get_name(),
+                                   'mode'   : section.get_mode(),
+                                   'arrays' : add_arrays(section.get_arrays())})
+    if scene.get_abundance() != None:
+        header['abundance'] = add_arrays(scene.get_abundance().get_arrays())
+    if scene.get_node_table() != None:
+        header['node_table'] = {'arrays' : add_arrays(scene.get_node_table().get_arrays()),
+                                'names'  : scene.get_node_table().get_names()}
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start   = align(len(SCENE_MAGIC) + 8 + len(header_bytes))
+    header_bytes = header_bytes.ljust(data_start - len(SCENE_MAGIC) - 8)
+
+    out_f.write(SCENE_MAGIC)
+    out_f.write(struct.pack('<II', SCENE_VERSION, len(header_bytes)))
+    out_f.write(header_bytes)
+    for arr_offset, arr in arrays:
+        out_f.seek(data_start + arr_offset)
+        out_f.write(arr.tobytes())
+    return header, data_start
+
+
+@profiling.profiled()
+def load_scene(path, use_mmap=True):
+    '''
+    Load a scene that was written by save_scene. By default
+    the section arrays are memory-mapped rather than read
+    into memory.
+    '''
+    in_f  = open(path, 'rb')
+    magic = in_f.read(len(SCENE_MAGIC))
+    if magic != SCENE_MAGIC:
+        in_f.close()
+        print('ERROR: ' + path + ' is not a scene file')
+        return None
+
+    version, header_len = struct.unpack('<II', in_f.read(8))
+    if version != SCENE_VERSION:
+        in_f.close()
+        print('ERROR: unsupported scene version ' + str(version))
+        return None
+
+    header     = json.loads(in_f.read(header_len).decode('utf-8'))
+    data_start = len(SCENE_MAGIC) + 8 + header_len
+
+    def read_arrays(descs):
+        arrays = {}
+        for key, desc in descs.items():
+            dtype = dtype_from_json(desc['dtype'])
+            shape = tuple(desc['shape'])
+            if use_mmap and numpy.prod(shape) > 0:
+                arrays[key] = numpy.memmap(path, dtype=dtype, mode='r', shape=shape,
+                                           offset=data_start + desc['offset'])
+            else:
+                in_f.seek(data_start + desc['offset'])
+                count = int(numpy.prod(shape))
+                arrays[key] = numpy.fromfile(in_f, dtype=dtype,
+                                             count=count).reshape(shape)
+        return arrays
+
+    sections = []
+    for entry in header['sections']:
+        arrays = read_arrays(entry['arrays'])
+        sections.append(SceneSection(entry['name'], entry['mode'],
+                                     arrays['vertices'], arrays['firsts'],
+                                     arrays['counts']))
+    abundance = None
+    if 'abundance' in header:
+        arrays    = read_arrays(header['abundance'])
+        abundance = AbundanceTable(arrays['leaf_xy'], arrays['leaf_colors'],
+                                   arrays['counts'], arrays['leaf_nodes'])
+    node_table = None
+    if 'node_table' in header:
+        arrays     = read_arrays(header['node_table']['arrays'])
+        node_table = NodeTable(arrays['xy'], arrays['parents'],
+                               header['node_table']['names'])
+    in_f.close()
+    return Scene(sections, header['info'], abundance, node_table)
+
+
+if __name__ == '__main__':
+    '''
+    Build a scene offline and write it to a scene file
+    that phylo_viewer.py can load with --scene.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('newick_file', type=str)
+    parser.add_argument('condensed_counts_file', type=str)
+    parser.add_argument('layer_count', type=int, help="the number of samples to display")
+    parser.add_argument('out_file', type=str)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used to build the inner node discs")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    c_map    = CountsMap(args.condensed_counts_file)
+    tree     = NewickTree(read_newick(args.newick_file), c_map)
+    scene    = SceneBuilder(tree, args.layer_count, args.workers).build()
+    save_scene(scene, args.out_file)
+    print('wrote ' + str(scene.get_vertex_count()) + ' vertices ('
+          + str(scene.get_nbytes()) + ' bytes) to ' + args.out_file)
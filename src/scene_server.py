@@ -0,0 +1,346 @@
+#!/usr/bin/python
+'''
+Serve the scenes of a study to many viewers from one warm process.
+
+The server parses a study's tree and counts once, and keeps them in
+memory along with every scene it has built from them, so viewers on
+other machines (or many viewers on one) needn't each rebuild the same
+geometry. A scene is served as the bytes of a scene file (see
+scene.save_scene), built the first time it is asked for:
+
+    GET /                   a json index of the study and its scenes
+    GET /scenes/<layers>    the scene of the full tree with that many
+                            layers (up to MAX_LAYERS)
+    GET /scenes/<name>      a scene file given with --scene
+    GET /tree               the newick string of the tree
+
+The index records the json header of every scene that has been built,
+along with the offset of its arrays, so a client can fetch any single
+array (the vertices of one section, say) with a range request. Every
+response has a strong ETag (the sha256 of its bytes), a client that
+sends If-None-Match with it gets back 304 Not Modified, and single
+byte ranges are served as 206 Partial Content. Responses allow any
+origin, so a viewer in a browser can fetch them.
+
+phylo_viewer.py loads a served scene with --scene <url>, keeping a
+copy in the temp directory that is only fetched again when its ETag
+changes (see fetch_scene).
+
+Ex:
+    python scene_server.py ../trees/full_tree ../data/condensed_counts.txt --port 8765
+    curl -s http://localhost:8765/
+    curl -s -r 0-63 http://localhost:8765/scenes/15 | xxd
+'''
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    #python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen, HTTPError
+from counts_map import CountsMap
+from newick_tree import NewickTree
+from input_files import read_newick
+from scene import SceneBuilder, write_scene, load_scene
+import argparse
+import hashlib
+import io
+import json
+import os
+import profiling
+import re
+import tempfile
+import threading
+
+MAX_LAYERS = 30
+
+#a single byte range: first-last, first- or -suffix length
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class Payload():
+    '''
+    The bytes of a response along with their content type
+    and ETag.
+    '''
+
+    def __init__(self, data, content_type):
+        self.data         = data
+        self.content_type = content_type
+        self.etag         = '"' + hashlib.sha256(data).hexdigest() + '"'
+
+    def get_data(self):
+        return self.data
+
+    def get_content_type(self):
+        return self.content_type
+
+    def get_etag(self):
+        return self.etag
+
+
+@profiling.profiled()
+def scene_payload(scene):
+    '''
+    Serialize a scene to a Payload of its scene file bytes, and
+    get it along with the scene's header (with the offsets of
+    its arrays made absolute).
+    '''
+    out_f = io.BytesIO()
+    header, data_start = write_scene(scene, out_f)
+    header['data_start'] = data_start
+    return Payload(out_f.getvalue(), 'application/octet-stream'), header
+
+
+class Study():
+    '''
+    A study held in memory: its tree and counts, parsed once, and
+    the payloads of the scenes built from them so far. Scenes are
+    built on a first request, outside of the lock, so other
+    requests are answered in the meantime.
+    '''
+
+    def __init__(self, newick_s, counts_map):
+        self.newick_s   = newick_s
+        self.counts_map = counts_map
+        self.tree       = NewickTree(newick_s, counts_map)
+        self.payloads   = {'tree' : Payload(newick_s.encode('utf-8'), 'text/plain')}
+        self.headers    = {}
+        self.lock       = threading.Lock()
+
+    def add_scene(self, name, scene):
+        '''
+        Serialize a scene and publish it as /scenes/<name>. A scene
+        already published under the name (by a concurrent build)
+        is kept.
+        '''
+        payload, header = scene_payload(scene)
+        with self.lock:
+            if 'scenes/' + name not in self.payloads:
+                self.payloads['scenes/' + name], self.headers[name] = payload, header
+
+    def get_payload(self, path, workers=1):
+        '''
+        Get the Payload at a path (without its leading slash),
+        building a scene of the full tree when needed. None is
+        returned for a path that names nothing. Scenes built on a
+        request's thread use a single worker, as a threaded server
+        can't safely fork a pool.
+        '''
+        if path == '':
+            return self.index()
+        with self.lock:
+            if path in self.payloads:
+                return self.payloads[path]
+        layers = path[len('scenes/'):]
+        if not path.startswith('scenes/') or not layers.isdigit():
+            return None
+        if int(layers) < 1 or int(layers) > MAX_LAYERS:
+            return None
+        self.add_scene(layers, SceneBuilder(self.tree, int(layers), workers).build())
+        with self.lock:
+            return self.payloads[path]
+
+    def index(self):
+        with self.lock:
+            index = {'num_leaves' : self.tree.get_num_leaves(),
+                     'samples'    : len(self.counts_map.counts_lst),
+                     'max_layers' : MAX_LAYERS,
+                     'scenes'     : {}}
+            for name, header in self.headers.items():
+                payload = self.payloads['scenes/' + name]
+                index['scenes'][name] = {'url'    : '/scenes/' + name,
+                                         'bytes'  : len(payload.get_data()),
+                                         'etag'   : payload.get_etag(),
+                                         'header' : header}
+        return Payload(json.dumps(index).encode('utf-8'), 'application/json')
+
+
+def byte_range(header, length):
+    '''
+    Get the first and last (inclusive) bytes of a Range header
+    over length bytes. None is returned for a header that isn't
+    a valid single byte range (the whole payload is sent instead,
+    as RFC 9110 asks), and False for a valid range that none of
+    the payload falls in.
+    '''
+    match = RANGE_PATTERN.match(header.strip()) if header != None else None
+    if match == None or match.group(1) + match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        if int(match.group(2)) == 0 or length == 0:
+            return False
+        return max(length - int(match.group(2)), 0), length - 1
+    first = int(match.group(1))
+    if match.group(2) != '' and int(match.group(2)) < first:
+        return None
+    if first >= length:
+        return False
+    if match.group(2) == '':
+        return first, length - 1
+    return first, min(int(match.group(2)), length - 1)
+
+
+class SceneHandler(BaseHTTPRequestHandler):
+    '''
+    Answer GET and HEAD requests for the payloads of
+    the server's study.
+    '''
+
+    def do_GET(self):
+        self.send_payload(True)
+
+    def do_HEAD(self):
+        self.send_payload(False)
+
+    def send_payload(self, body):
+        with profiling.span(self.command + ' ' + self.path):
+            self.send_path(self.path.split('?')[0].strip('/'), body)
+
+    def send_path(self, path, body):
+        payload = self.server.study.get_payload(path)
+        if payload == None:
+            self.send_error(404)
+            return
+
+        data = payload.get_data()
+        if self.headers.get('If-None-Match') in (payload.get_etag(), '*'):
+            self.send_response(304)
+            self.send_common(payload)
+            self.end_headers()
+            return
+
+        span = byte_range(self.headers.get('Range'), len(data))
+        if self.headers.get('If-Range') not in (None, payload.get_etag()):
+            span = None
+        if span == False:
+            self.send_response(416)
+            self.send_common(payload)
+            self.send_header('Content-Range', 'bytes */%d' % len(data))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if span == None:
+            first, last = 0, len(data) - 1
+            self.send_response(200)
+        else:
+            first, last = span
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, len(data)))
+        self.send_common(payload)
+        self.send_header('Content-Type', payload.get_content_type())
+        self.send_header('Content-Length', str(last - first + 1))
+        self.end_headers()
+        if body:
+            self.wfile.write(data[first:last + 1])
+
+    def send_common(self, payload):
+        self.send_header('ETag', payload.get_etag())
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag, Content-Range, Content-Length')
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class SceneServer(ThreadingMixIn, HTTPServer):
+    '''
+    An HTTP server for a Study, with a thread per request.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, study, quiet=False):
+        HTTPServer.__init__(self, address, SceneHandler)
+        self.study = study
+        self.quiet = quiet
+
+
+@profiling.profiled()
+def fetch_scene(url, cache_dir=None):
+    '''
+    Download a served scene to a file in cache_dir (the temp
+    directory by default), and get the path of the file. The
+    file is kept along with its ETag, and only downloaded again
+    when the server has a different scene. None is returned when
+    the scene can't be fetched.
+    '''
+    if cache_dir == None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'phylo_scenes')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path      = os.path.join(cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest()
+                             + '.scene')
+    etag_path = path + '.etag'
+
+    request = Request(url)
+    if os.path.isfile(path) and os.path.isfile(etag_path):
+        etag_f = open(etag_path, 'r')
+        request.add_header('If-None-Match', etag_f.read().strip())
+        etag_f.close()
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code == 304:
+            return path
+        print('ERROR: unable to fetch %s (%d %s)' % (url, e.code, e.reason))
+        return None
+    except IOError as e:
+        print('ERROR: unable to fetch %s (%s)' % (url, e))
+        return None
+
+    #write through a temporary file so an interrupted
+    #download never leaves half of a scene behind
+    out_f = open(path + '.tmp', 'wb')
+    block = response.read(1 << 20)
+    while len(block) > 0:
+        out_f.write(block)
+        block = response.read(1 << 20)
+    out_f.close()
+    os.rename(path + '.tmp', path)
+    etag_f = open(etag_path, 'w')
+    etag_f.write(response.headers.get('ETag', ''))
+    etag_f.close()
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('newick_file', type=str)
+    parser.add_argument('condensed_counts_file', type=str)
+    parser.add_argument('--host', type=str, default='localhost',
+                        help="the address to listen on (only this machine by default)")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--scene', type=str, nargs='+', default=[],
+                        help="scene files to serve as /scenes/<file name>")
+    parser.add_argument('--layers', type=int, nargs='+', default=[],
+                        help="layer counts of the full tree to build before serving")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used to build the --layers scenes")
+    parser.add_argument('--quiet', action='store_true', help="don't log every request")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    study    = Study(read_newick(args.newick_file), CountsMap(args.condensed_counts_file))
+    for path in args.scene:
+        scene = load_scene(path)
+        if scene != None:
+            study.add_scene(os.path.splitext(os.path.basename(path))[0], scene)
+    #only the scenes built before serving use the workers
+    for layers in args.layers:
+        study.get_payload('scenes/%d' % layers, args.workers)
+
+    server = SceneServer((args.host, args.port), study, args.quiet)
+    print('serving %s on http://%s:%d/' % (args.newick_file, args.host,
+                                             server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+'''
+Overlap building a scene with setting up the viewer's window.
+
+Reading the counts, parsing and laying out the tree and building the
+geometry all happen before there is anything to draw, but none of it
+needs a GL context, and creating the window and compiling the shaders
+don't need the scene. A SceneLoader runs the first in a forked process
+(started before any GL is set up) while the viewer does the second,
+and the viewer shows what the loader is doing until the scene is ready.
+The loader writes the scene it built to a scene file (in shared memory
+where there is any), which the viewer memory-maps (see load_scene).
+
+StartupTimes records when every phase of the startup began and ended,
+on both sides, from the launch of the viewer up to its first frame.
+
+Every phase is also a profiling span (see profiling.py), and the
+loader's process sends its spans back along with its phases.
+'''
+from scene import FORK, save_scene, load_scene
+import multiprocessing
+import os
+import profiling
+import tempfile
+import threading
+import time
+import traceback
+
+#scene files handed from the loader to the viewer are
+#written here when there is such a (memory backed) directory
+SHARED_DIR = '/dev/shm'
+
+
+class StartupTimes():
+    '''
+    The begin and end times (in seconds from start) of the
+    phases of a startup, along with where each phase ran. A
+    conn (one end of a Pipe) is sent the name of every phase
+    as it begins.
+    '''
+
+    def __init__(self, start=None, where='viewer', conn=None):
+        self.start  = time.time() if start == None else start
+        self.where  = where
+        self.conn   = conn
+        self.phases = []
+        self.begun  = {}
+        self.spans  = {}
+
+    def get_start(self):
+        return self.start
+
+    def get_phases(self):
+        return self.phases
+
+    def begin(self, name):
+        self.begun[name] = time.time() - self.start
+        self.spans[name] = profiling.begin(name, where=self.where)
+        if self.conn != None:
+            self.conn.send(('phase', name))
+
+    def end(self, name):
+        profiling.end(self.spans.pop(name))
+        self.phases.append((name, self.where, self.begun.pop(name),
+                            time.time() - self.start))
+
+    def mark(self, name):
+        '''
+        Record a moment (a phase that takes no time).
+        '''
+        now = time.time() - self.start
+        self.phases.append((name, self.where, now, now))
+        profiling.instant(name)
+
+    def extend(self, phases):
+        self.phases.extend([tuple(p) for p in phases])
+
+    def elapsed(self, where):
+        return sum([end - begin for name, at, begin, end in self.phases if at == where])
+
+    def summary(self):
+        '''
+        Describe every phase, in the order they began, along with
+        how much of the loader's time was hidden behind the viewer's
+        own setup.
+        '''
+        lines = ['startup (seconds from launch):']
+        for name, where, begin, end in sorted(self.phases, key=lambda p: p[2]):
+            if end > begin:
+                lines.append('  %-7s %-12s %7.3f - %7.3f  (%.3f)' % (where, name, begin,
+                                                                  end, end - begin))
+            else:
+                lines.append('  %-7s %-12s %7.3f' % (where, name, begin))
+        waited = sum([end - begin for name, where, begin, end in self.phases
+                      if name == 'wait'])
+        hidden = max(self.elapsed('loader') - waited, 0.0)
+        lines.append('  %.3f s of %.3f s loading overlapped with the viewer\'s setup'
+                     % (hidden, self.elapsed('loader')))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return [{'phase' : name, 'where' : where, 'begin' : begin, 'end' : end}
+                for name, where, begin, end in self.phases]
+
+
+def run_loader(loader, conn):
+    '''
+    Build the loader's scene and hand it over through conn. In a
+    forked process, the scene is handed over as a scene file,
+    along with the profiling events recorded by the process.
+    '''
+    times = StartupTimes(loader.get_times().get_start(), 'loader', conn)
+    mark  = profiling.event_count()
+    try:
+        scene = loader.load(times)
+        if scene == None:
+            conn.send(('error', None))
+            return
+        if loader.forked:
+            times.begin('write')
+            out_dir = SHARED_DIR if os.path.isdir(SHARED_DIR) else tempfile.gettempdir()
+            handle, path = tempfile.mkstemp(suffix='.scene', dir=out_dir)
+            os.close(handle)
+            save_scene(scene, path)
+            times.end('write')
+            conn.send(('done', path, times.get_phases(), profiling.events_since(mark)))
+        else:
+            loader.scene = scene
+            conn.send(('done', None, times.get_phases(), []))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class SceneLoader():
+    '''
+    Build a scene in the background with load(times), a function
+    that gets a StartupTimes to record its phases in and returns
+    the scene (or None). The scene is built in a forked process,
+    or in a thread when fork is False or processes can't be forked
+    (once a GL context is set up, say).
+    '''
+
+    def __init__(self, load, times, fork=True):
+        self.load    = load
+        self.times   = times
+        self.forked  = fork and FORK != None
+        self.phase   = 'starting'
+        self.scene   = None
+        self.error   = None
+        self.done    = False
+        self.conn    = None
+        self.worker  = None
+
+    def get_times(self):
+        return self.times
+
+    def get_phase(self):
+        return self.phase
+
+    def start(self):
+        '''
+        Start the loader. This has to happen before any GL is set
+        up, as a forked process can't share a GL context.
+        '''
+        if self.forked:
+            self.conn, child_conn = FORK.Pipe(False)
+            self.worker = FORK.Process(target=run_loader, args=(self, child_conn))
+        else:
+            self.conn, child_conn = multiprocessing.Pipe(False)
+            self.worker = threading.Thread(target=run_loader, args=(self, child_conn))
+            self.worker.daemon = True
+        self.worker.start()
+        if self.forked:
+            child_conn.close()
+
+    def poll(self):
+        '''
+        Read whatever the loader has sent, without waiting. True
+        is returned once it's done (or has failed).
+        '''
+        try:
+            while not self.done and self.conn.poll():
+                self.receive(self.conn.recv())
+        except EOFError:
+            self.error = 'the loader exited before the scene was built'
+            self.done  = True
+        return self.done
+
+    def receive(self, message):
+        if message[0] == 'phase':
+            self.phase = message[1]
+            return
+        self.done = True
+        if message[0] == 'error':
+            self.error = message[1]
+            return
+        self.times.extend(message[2])
+        profiling.add_events(message[3])
+        if message[1] != None:
+            self.scene = load_scene(message[1])
+            #the arrays are memory-mapped, so the
+            #file is only gone once they're released
+            os.remove(message[1])
+            if self.scene == None:
+                self.error = 'the loader wrote an unreadable scene'
+
+    def wait(self):
+        '''
+        Wait for the loader to finish, and get its scene
+        (or None when it failed).
+        '''
+        while not self.poll():
+            self.conn.poll(0.05)
+        return self.get_scene()
+
+    def get_scene(self):
+        if self.worker != None:
+            self.worker.join()
+            self.worker = None
+            self.conn.close()
+        if self.error != None:
+            print('ERROR: unable to load the scene')
+            print(self.error)
+        return self.scene
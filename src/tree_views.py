@@ -0,0 +1,138 @@
+#!/usr/bin/python
+'''
+Per-sample views of one tree, as masks over its nodes.
+
+Every sample's tree is a subtree of the full tree: the leaves
+present in the sample along with their ancestors. Rather than
+parsing and laying out a tree for every sample, the full tree is
+laid out once (its NodeTable and AbundanceTable, which scene files
+also keep), and a sample's view is a boolean mask over its nodes.
+
+The nodes are put in preorder once, so the nodes below any node are
+a single range of the order. A node is then in a sample's view when
+the count of present leaves over its range is above zero, which is
+a cumulative sum over the leaves, and switching samples costs one
+vectorized pass over the nodes with no parsing or layout.
+
+The ViewBuilder draws the full tree's inner nodes on every layer,
+and the branches of the first layer only, as the SceneBuilder does.
+The viewer only draws the inner nodes in view on each layer, and
+instances the one layer of branches onto every layer along with a
+mask of the edges in view (see TreeViewer.update_views).
+'''
+from counts_map import CountsMap
+from newick_tree import NewickTree
+from input_files import read_newick
+from scene import SceneBuilder, save_scene
+import argparse
+import numpy
+import profiling
+
+
+class SampleViews():
+    '''
+    Masks over the nodes of a NodeTable for the samples
+    of an AbundanceTable.
+    '''
+
+    def __init__(self, node_table, abundance):
+        self.parents   = numpy.asarray(node_table.get_parents(), dtype=numpy.int64)
+        self.abundance = abundance
+        node_count     = len(self.parents)
+
+        children = [[] for i in range(node_count)]
+        for child, parent in enumerate(self.parents):
+            if parent >= 0:
+                children[parent].append(child)
+
+        #put the nodes in preorder, and find the range of
+        #the order that every node's subtree covers
+        self.preorder = numpy.empty(node_count, dtype=numpy.int64)
+        self.sizes    = numpy.ones(node_count, dtype=numpy.int64)
+        position = 0
+        stack    = list(numpy.nonzero(self.parents < 0)[0][::-1])
+        while len(stack) > 0:
+            cur = stack.pop()
+            self.preorder[cur] = position
+            position += 1
+            stack.extend(reversed(children[cur]))
+        for node in numpy.argsort(self.preorder)[::-1]:
+            if self.parents[node] >= 0:
+                self.sizes[self.parents[node]] += self.sizes[node]
+
+        self.inner = numpy.array([len(c) > 0 for c in children], dtype=bool)
+
+        #the preorder position of every row of the abundance table
+        self.leaf_positions = self.preorder[numpy.asarray(abundance.get_leaf_nodes())]
+
+    def get_inner_nodes(self):
+        return numpy.nonzero(self.inner)[0]
+
+    def get_child_nodes(self):
+        '''
+        Get the nodes that have a parent, one for every
+        branch of the tree.
+        '''
+        return numpy.nonzero(self.parents >= 0)[0]
+
+    def node_masks(self, first, layers):
+        '''
+        Get the nodes in view for the samples first to first
+        + layers (nodes x layers). Samples past the end of the
+        abundance table show nothing.
+        '''
+        radii   = self.abundance.get_radii(first, layers)
+        present = numpy.zeros((layers, len(self.parents) + 1), dtype=numpy.int64)
+        present[:, self.leaf_positions + 1] = radii > 0
+        present = numpy.cumsum(present, axis=1)
+        below   = present[:, self.preorder + self.sizes] - present[:, self.preorder]
+        return (below > 0).T
+
+    def section_masks(self, first, layers):
+        '''
+        Get the mask over the primitives of the node section
+        built by a ViewBuilder, and the mask over the edges of
+        every layer (layers x edges, one byte each) that the
+        viewer instances the branches with.
+        '''
+        masks = self.node_masks(first, layers)
+        edges = masks[self.get_child_nodes()]
+        return {'nodes'    : masks[self.get_inner_nodes()].ravel(),
+                'branches' : numpy.ascontiguousarray(edges.T, dtype=numpy.uint8)}
+
+
+class ViewBuilder(SceneBuilder):
+    '''
+    Build the scene of a tree with the full tree's inner nodes
+    on every layer, to be masked by SampleViews. The inner nodes
+    are planned node by node (every layer of a node in turn) as
+    the SceneBuilder does.
+    '''
+
+    def build(self):
+        scene = SceneBuilder.build(self)
+        scene.get_info()['views'] = True
+        return scene
+
+if __name__ == '__main__':
+    '''
+    Build a scene of per-sample views offline and write it
+    to a scene file that phylo_viewer.py can load with --scene.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('newick_file', type=str)
+    parser.add_argument('condensed_counts_file', type=str)
+    parser.add_argument('layer_count', type=int, help="the number of samples to display")
+    parser.add_argument('out_file', type=str)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes used to build the inner node discs")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.enable_from_args(args)
+
+    c_map    = CountsMap(args.condensed_counts_file)
+    tree     = NewickTree(read_newick(args.newick_file), c_map)
+    scene    = ViewBuilder(tree, args.layer_count, args.workers).build()
+    save_scene(scene, args.out_file)
+    print('wrote ' + str(scene.get_vertex_count()) + ' vertices ('
+          + str(scene.get_nbytes()) + ' bytes) to ' + args.out_file)
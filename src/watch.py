@@ -0,0 +1,108 @@
+#!/usr/bin/python
+'''
+Watch a viewer's inputs, and work out how little of its scene has
+to be rebuilt when they change.
+
+An InputWatcher polls the size and modification time of every input
+(as inotify isn't everywhere), and only reports a file once it has
+stopped changing, so a file that is still being written is never read
+half way. When only the counts changed, the tree and its geometry are
+as they were: recount builds a new AbundanceTable for the same leaf
+rows (looked up by the leaf names kept in the NodeTable), and the
+viewer only swaps the leaves on the gpu. A changed tree is laid out
+and built again from scratch.
+'''
+from scene import Scene, AbundanceTable
+import os
+import time
+import numpy
+
+#seconds between looks at the inputs
+WATCH_INTERVAL = 0.5
+
+
+def file_signature(path):
+    '''
+    Get the size and modification time of a file, or
+    None for a missing file.
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+
+class InputWatcher():
+    '''
+    Poll a list of files for changes.
+    '''
+
+    def __init__(self, paths, interval=WATCH_INTERVAL):
+        self.paths      = list(paths)
+        self.interval   = interval
+        self.signatures = dict([(p, file_signature(p)) for p in self.paths])
+        self.pending    = {}
+        self.last_check = time.time()
+
+    def get_paths(self):
+        return self.paths
+
+    def changed(self):
+        '''
+        Get the files that changed since they were last reported,
+        and have since stayed the same for a whole interval. Files
+        are only looked at once every interval.
+        '''
+        if time.time() - self.last_check < self.interval:
+            return []
+        self.last_check = time.time()
+
+        settled = []
+        for path in self.paths:
+            signature = file_signature(path)
+            if signature == self.signatures[path]:
+                self.pending.pop(path, None)
+            elif signature != None and self.pending.get(path) == signature:
+                del self.pending[path]
+                self.signatures[path] = signature
+                settled.append(path)
+            else:
+                self.pending[path] = signature
+        return settled
+
+
+def same_geometry(scene, other):
+    '''
+    Check whether two scenes share their sections (as a
+    scene and its recount do).
+    '''
+    sections = scene.get_sections()
+    others   = other.get_sections()
+    return (len(sections) == len(others)
+            and all([s is o for s, o in zip(sections, others)]))
+
+
+def recount(scene, counts_map):
+    '''
+    Get a copy of scene with the abundance of its leaves taken from
+    counts_map. The geometry is shared with scene. None is returned
+    when the counts don't cover every leaf (or the scene has no leaf
+    names), and the scene has to be built again.
+    '''
+    abundance  = scene.get_abundance()
+    node_table = scene.get_node_table()
+    if abundance == None or node_table == None or 'samples' in scene.get_info():
+        return None
+
+    names  = node_table.get_names()
+    counts = [counts_map.get_counts(names[n]) for n in abundance.get_leaf_nodes()]
+    if any([c == None for c in counts]):
+        return None
+    samples = min([len(c) for c in counts]) if len(counts) > 0 else 0
+    counts  = numpy.array([c[:samples] for c in counts],
+                          dtype=numpy.float32).reshape((-1, samples))
+
+    recounted = AbundanceTable(abundance.get_leaf_xy(), abundance.get_leaf_colors(),
+                               counts, abundance.get_leaf_nodes())
+    return Scene(scene.get_sections(), scene.get_info(), recounted, node_table)